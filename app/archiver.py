@@ -0,0 +1,213 @@
+import json
+import logging
+import os
+import re
+import shutil
+from datetime import datetime
+from .catalog import find_backups
+
+ARCHIVE_PREFIX = "archive_"
+
+# A WAL segment is named after its timeline and position, 24 hex digits
+WAL_SEGMENT = re.compile(r"^[0-9A-F]{24}$")
+# A binary log is numbered, such as `binlog.000042`
+BINLOG_FILE = re.compile(r"^.+\.\d{6,}$")
+
+
+def archive_index_name(database):
+    return f"{ARCHIVE_PREFIX}{database}.json"
+
+
+def batch_name(database, segment, extension, partial=False):
+    """
+    Returns:
+    str: The name of a batch of archived segments, after its first segment, or
+    of the snapshot of a segment still being written.
+    """
+    return f"{ARCHIVE_PREFIX}{database}_{segment}{'.partial' if partial else ''}{extension}"
+
+
+def read_archive_index(destination, database):
+    """
+    Reads the index of the WAL or binary logs archived for a database: the
+    batches of completed segments in the order they were uploaded, with the
+    time each was archived, and the snapshot of the segment being written.
+    Returns:
+    dict: The index, empty when nothing was archived yet.
+    """
+    content = destination.read_from_destination(archive_index_name(database))
+    if content is None:
+        return {"batches": [], "partial": None}
+    return json.loads(content)
+
+
+def write_archive_index(destination, database, index):
+    return destination.upload_to_destination(
+        archive_index_name(database), json.dumps(index, indent=2).encode()
+    )
+
+
+def add_batch(index, file_name, segments, archived_at):
+    """
+    Records a batch in the index. A batch uploaded again after a failure on
+    another destination replaces its previous record.
+    """
+    index["batches"] = [
+        batch for batch in index["batches"] if batch["file"] != file_name
+    ] + [{"file": file_name, "segments": segments, "archived_at": archived_at}]
+
+
+def segment_name(file_name):
+    return (
+        file_name[: -len(".partial")] if file_name.endswith(".partial") else file_name
+    )
+
+
+def spool_files(spool, database_type):
+    """
+    Splits the files written by the receiver into the completed segments and
+    the one still being written. `pg_receivewal` marks the latter with a
+    `.partial` suffix, `mysqlbinlog` only ever writes to the newest file.
+    Parameters:
+    spool (str): The directory the receiver writes to.
+    database_type (str): 'postgres' or 'mysql'.
+    Returns:
+    tuple: The completed segments oldest first, and the file being written or None.
+    """
+    names = sorted(os.listdir(spool))
+    if database_type == "postgres":
+        complete = [
+            name
+            for name in names
+            if WAL_SEGMENT.match(name) or name.endswith(".history")
+        ]
+        partial = [name for name in names if name.endswith(".partial")]
+        return complete, partial[-1] if partial else None
+    names = [name for name in names if BINLOG_FILE.match(name)]
+    return names[:-1], names[-1] if names else None
+
+
+def snapshot_partial(spool, partial, scratch):
+    """
+    Copies the segment being written, so it can be archived while the receiver
+    keeps writing to it.
+    Returns:
+    str: The directory holding the copy.
+    """
+    os.makedirs(scratch, exist_ok=True)
+    shutil.copyfile(os.path.join(spool, partial), os.path.join(scratch, partial))
+    return scratch
+
+
+def base_backups(destination, database, database_type):
+    """
+    Lists the backups that archived logs can be replayed on top of: physical
+    base backups on PostgreSQL, and on MySQL the sharded backups whose catalog
+    entry records the binary log position of their snapshot.
+    Returns:
+    list: The catalog entries, oldest first.
+    """
+    if database_type == "postgres":
+        return [
+            entry
+            for entry in find_backups(destination, database)
+            if entry["format"] == "base" and entry["label"] is None
+        ]
+    return [
+        entry
+        for entry in find_backups(destination, database)
+        if entry["format"] == "sharded"
+        and entry["label"] is None
+        and entry.get("binlog")
+    ]
+
+
+def plan_recovery(index, since, until):
+    """
+    Picks the archived batches needed to replay from a base backup taken at
+    `since` up to `until`. A segment the base backup needs was still being
+    written when it started, so it was archived after it: only the batches
+    archived from then on are needed, up to the first one archived after
+    `until`. When none was, the snapshot of the segment being written is the
+    last one.
+    Parameters:
+    index (dict): The archive index.
+    since (str): The timestamp of the base backup, 'YYYYmmddHHMMSS'.
+    until (str): The recovery target, 'YYYYmmddHHMMSS'.
+    Returns:
+    tuple: The batches in order, and the partial snapshot to use or None.
+    """
+    batches = []
+    for batch in sorted(index["batches"], key=lambda batch: batch["archived_at"]):
+        if batch["archived_at"] < since:
+            continue
+        batches.append(batch)
+        if batch["archived_at"] >= until:
+            return batches, None
+    partial = index.get("partial")
+    if partial and partial["archived_at"] >= since:
+        return batches, partial
+    return batches, None
+
+
+def prune_archive(destination, database):
+    """
+    Deletes the batches archived before the oldest remaining base backup, which
+    no recovery can start early enough to need.
+    Returns:
+    list: The deleted batches.
+    """
+    index = read_archive_index(destination, database)
+    if not index["batches"]:
+        return []
+    bases = base_backups(destination, database, index.get("database_type"))
+    if not bases:
+        return []
+    oldest = bases[0]["timestamp"]
+    expired = [batch for batch in index["batches"] if batch["archived_at"] < oldest]
+    if not expired:
+        return []
+    deleted, failures = destination.delete_files_from_destination(
+        [batch["file"] for batch in expired]
+    )
+    for file, error in failures.items():
+        logging.error(f"[prune_archive] Error deleting file: {file}, Error: {error}")
+    index["batches"] = [
+        batch for batch in index["batches"] if batch["file"] not in deleted
+    ]
+    write_archive_index(destination, database, index)
+    logging.info(f"[prune_archive] Deleted {len(deleted)} archived batches")
+    return deleted
+
+
+def write_recovery_config(data_directory, wal_directory, target_time):
+    """
+    Sets up a restored PostgreSQL data directory to replay the archived WAL up
+    to `target_time` when the server starts, then to open for writes.
+    Parameters:
+    data_directory (str): The data directory extracted from the base backup.
+    wal_directory (str): The directory holding the archived WAL segments.
+    target_time (datetime): The recovery target.
+    """
+    wal_directory = os.path.abspath(wal_directory)
+    with open(os.path.join(data_directory, "postgresql.auto.conf"), "a") as config:
+        config.write(
+            f'\nrestore_command = \'cp "{wal_directory}/%f" "%p"\'\n'
+            f"recovery_target_time = '{target_time.strftime('%Y-%m-%d %H:%M:%S')}'\n"
+            "recovery_target_action = 'promote'\n"
+        )
+    open(os.path.join(data_directory, "recovery.signal"), "w").close()
+
+
+def parse_target_time(text):
+    """
+    Parses a recovery target, 'YYYY-mm-dd HH:MM:SS' or 'YYYYmmddHHMMSS'.
+    Raises:
+    ValueError: If the time is in neither format.
+    """
+    for time_format in ("%Y-%m-%d %H:%M:%S", "%Y%m%d%H%M%S"):
+        try:
+            return datetime.strptime(text, time_format)
+        except ValueError:
+            continue
+    raise ValueError(f"Invalid recovery target time: {text}")
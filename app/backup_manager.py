@@ -1,14 +1,131 @@
-from flask import Flask, request, current_app
+from flask import Flask, request, current_app, jsonify, url_for
 import os
 import sys
 import logging
-from .util import compress_backup, parse_connection_url, send_email_notification
-from .destinations import s3, ftp
-from .db_backups import DB_BACKUP_FUNCTIONS
+from .util import (
+    compress_backup,
+    parse_connection_url,
+    send_email_notification,
+    stream_compressed_backup,
+    open_tar_stream,
+    discover_database_vars,
+)
+from .destinations import (
+    DESTINATIONS,
+    destination_session,
+    primary_target,
+    upload_targets,
+)
+from .db_backups import (
+    DB_BACKUP_FUNCTIONS,
+    DB_QUERY_FUNCTIONS,
+    DB_STREAM_FUNCTIONS,
+    create_backup_postgres_directory,
+    open_base_backup_postgres,
+    open_binlog_receiver_mysql,
+    open_wal_receiver_postgres,
+    replay_binlogs_mysql,
+)
+from .archiver import (
+    add_batch,
+    base_backups,
+    batch_name,
+    parse_target_time,
+    plan_recovery,
+    prune_archive,
+    read_archive_index,
+    segment_name,
+    snapshot_partial,
+    spool_files,
+    write_archive_index,
+    write_recovery_config,
+)
 from .config import get_config_vars
+from .cache import get_cache
+from .catalog import (
+    StreamDigest,
+    find_backups,
+    new_entry,
+    rebuild_catalog,
+    update_catalog,
+)
+from .fanout import fan_out_upload
+from .integrity import (
+    SIDECAR_SUFFIX,
+    count_tables,
+    reset_scratch_database,
+    sidecar_name,
+    verify_backup,
+    write_sidecar,
+)
+from .jobs import get_job_queue, report_progress
+from .resumable import resume_or_start
+from . import metrics, throttle
+from .restore import (
+    find_latest_backup,
+    is_restorable,
+    iter_backup_data,
+    pipe_to_process,
+    restore_directory_archive,
+    restore_shards,
+    restore_stream,
+)
+from .retention import (
+    parse_policy,
+    parse_storage_classes,
+    plan_retention,
+    resolve_policy,
+    validate_policies,
+    retention_units,
+)
+from .dedup import MANIFEST_SUFFIX, collect_garbage, store_stream
+from .compression import get_compressor, get_extension
+from .encryption import (
+    check_encryption_config,
+    encrypt_stream,
+    encryption_suffix,
+    is_encrypted,
+    plain_name,
+)
+from .incremental import (
+    CHAIN_SUFFIX,
+    add_chain_entry,
+    chain_files,
+    find_latest_chain,
+    get_database_marker,
+    get_table_markers,
+    new_chain,
+    open_increment_stream,
+    plan_backup,
+    protected_chain_files,
+    save_chain,
+)
+from .sharding import (
+    SHARDS_SUFFIX,
+    exported_snapshot,
+    is_selected,
+    list_tables,
+    open_part_stream,
+    plan_parts,
+    plan_shards,
+    shard_files,
+    table_filter,
+    table_filter_args,
+)
 import time
+import contextvars
+import random
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import re
+import json
+import hashlib
 
 app = Flask(__name__)
 
@@ -38,7 +155,1393 @@ log_level = log_level_dict.get(
 logging.basicConfig(level=log_level)
 
 
-def manual_backup(db_var, label=None):
+def track_progress(chunks, stage):
+    """
+    Passes a stream of chunks through, reporting the bytes seen so far as the
+    progress of the current job.
+    """
+    total = 0
+    for chunk in chunks:
+        total += len(chunk)
+        report_progress(stage, bytes=total)
+        yield chunk
+
+
+def file_backup(
+    db_url,
+    database_type,
+    backup_filename,
+    digest=None,
+    targets=None,
+    results=None,
+    file_name=None,
+    journal=None,
+):
+    """
+    Dumps the database to a local file, compresses it with the configured codec
+    and uploads the compressed copy to the configured destination, encrypted
+    when ENCRYPTION_KEY is set.
+    Parameters:
+    db_url (str): The database connection URL.
+    database_type (str): The database type, as parsed from the connection URL.
+    backup_filename (str): The filename to use for the uncompressed backup.
+    digest (StreamDigest): Records the size and checksum of the uploaded file.
+    targets (list): The destination targets to upload to. Defaults to the
+    configured destination.
+    results (dict): Filled with whether the upload succeeded, by target name.
+    file_name (str): The name to upload the backup as. Defaults to the name of
+    the compressed file.
+    journal (UploadJournal): Makes the upload resumable by a later run.
+    Returns:
+    tuple: The name of the uploaded backup file and whether the upload
+    succeeded on every target.
+    """
+    backup_file = None
+    extra_args, tables = table_filter_args(current_app.config, db_url, database_type)
+    report_progress("dump")
+    for attempt in range(3):
+        try:
+            with metrics.stage("dump"):
+                backup_file = DB_BACKUP_FUNCTIONS[database_type](
+                    db_url, backup_filename, extra_args, tables
+                )
+            logging.debug(
+                f"[file_backup] Backup file created on attempt {attempt+1}: {backup_file}"
+            )
+            break
+        except Exception as e:
+            logging.error(
+                f"[file_backup] Error creating backup on attempt {attempt+1}: {str(e)}"
+            )
+            if attempt < 2:  # Don't sleep on the last attempt
+                metrics.count("retries")
+                time.sleep(5)
+            else:
+                backup_file = None
+                break
+
+    if backup_file is None:
+        logging.error("[file_backup] Backup creation failed")
+        sys.exit(1)
+
+    try:
+        logging.debug(f"[file_backup] Compressing backup file: {backup_file}")
+        report_progress("compress")
+        with metrics.stage("compress"):
+            compression_success = compress_backup(
+                backup_file,
+                current_app.config["COMPRESSION_CODEC"],
+                current_app.config["COMPRESSION_LEVEL"],
+                current_app.config["COMPRESSION_THREADS"],
+            )
+        if not compression_success:
+            raise Exception("[file_backup] Compression failed")
+    except Exception as e:
+        logging.error(f"[file_backup] Error compressing backup: {str(e)}")
+        sys.exit(1)
+
+    compressed_backup_file = backup_file + get_extension(
+        current_app.config["COMPRESSION_CODEC"]
+    )
+    logging.debug(
+        f"[file_backup] Backup file compressed successfully: {compressed_backup_file}"
+    )
+    metrics.count("bytes_dumped", os.path.getsize(backup_file))
+    metrics.count("bytes_compressed", os.path.getsize(compressed_backup_file))
+
+    upload_success = False
+    report_progress("upload")
+    uploaded_file = file_name or compressed_backup_file + encryption_suffix(
+        current_app.config
+    )
+    targets = targets or [primary_target(current_app.config)]
+    results = {} if results is None else results
+    results.update(dict.fromkeys([target.name for target in targets], False))
+    cache = get_cache(current_app.config)
+    writer = None
+    try:
+        logging.debug(
+            f"[file_backup] Uploading compressed backup file: {compressed_backup_file}"
+        )
+        with open(compressed_backup_file, "rb") as file:
+            # Read a slice at a time, so memory use does not grow with the backup
+            chunks = iter(
+                lambda: file.read(current_app.config["STREAM_CHUNK_SIZE"]), b""
+            )
+            if is_encrypted(uploaded_file):
+                chunks = encrypt_stream(chunks, current_app.config)
+            chunks = throttle.limit(chunks, throttle.get_bucket("upload"))
+            if digest is not None:
+                chunks = digest.wrap(chunks)
+            if cache is not None:
+                writer = cache.writer(targets[0], uploaded_file)
+                if writer is not None:
+                    chunks = writer.wrap(chunks)
+            with metrics.stage("upload"):
+                results.update(
+                    fan_out_upload(
+                        targets,
+                        uploaded_file,
+                        track_progress(chunks, "upload"),
+                        current_app.config["FANOUT_BUFFER_CHUNKS"],
+                        journal=journal,
+                    )
+                )
+        if digest is not None:
+            digest.record(name for name, success in results.items() if success)
+        if writer is not None and results[targets[0].name]:
+            writer.commit_stored(targets[0], uploaded_file)
+        upload_success = all(results.values())
+    except Exception as e:
+        logging.error(f"[file_backup] Error uploading backup: {str(e)}")
+        sys.exit(1)
+    finally:
+        if writer is not None:
+            writer.discard()
+
+    return uploaded_file, upload_success
+
+
+def stream_backup(
+    db_url,
+    database_type,
+    file_name,
+    open_stream=None,
+    digest=None,
+    journal=None,
+    targets=None,
+    results=None,
+    cache_copy=True,
+):
+    """
+    Pipes the dump process's output through the configured compression codec,
+    and encryption for `.enc` files, straight into the configured
+    destination. Nothing is written to disk and memory use is bounded by the
+    stream chunk size, whatever the size of the database. A failed attempt is
+    retried from the start with a fresh dump.
+    Parameters:
+    db_url (str): The database connection URL.
+    database_type (str): The database type, as parsed from the connection URL.
+    file_name (str): The name of the object to create at the destination.
+    open_stream (callable): Starts the dump process. Defaults to a full dump of
+    the tables selected by the table filters.
+    digest (StreamDigest): Records the size and checksum of the uploaded stream.
+    journal (UploadJournal): Makes the upload resumable, by this run's own
+    retries as well as by a later run after a restart.
+    targets (list): The destination targets to upload to, all from the same
+    dump. Defaults to the configured destination. A retry only uploads to the
+    targets that failed.
+    results (dict): Filled with whether the upload succeeded, by target name.
+    cache_copy (bool): Keep a copy of what the first target stored in the local
+    cache, when CACHE_DIR is set.
+    Returns:
+    bool: True if the backup was streamed and uploaded successfully, False otherwise.
+    """
+    pending = targets or [primary_target(current_app.config)]
+    primary = pending[0]
+    cache = get_cache(current_app.config) if cache_copy else None
+    results = {} if results is None else results
+    results.update(dict.fromkeys([target.name for target in pending], False))
+    if open_stream is None:
+        extra_args, tables = table_filter_args(
+            current_app.config, db_url, database_type
+        )
+        open_stream = lambda: DB_STREAM_FUNCTIONS[database_type](
+            db_url, extra_args, tables
+        )
+    for attempt in range(3):
+        process = None
+        writer = None
+        try:
+            process = open_stream()
+            compressor = get_compressor(
+                current_app.config["COMPRESSION_CODEC"],
+                current_app.config["COMPRESSION_LEVEL"],
+                current_app.config["COMPRESSION_THREADS"],
+            )
+            chunks = stream_compressed_backup(
+                process,
+                current_app.config["STREAM_CHUNK_SIZE"],
+                compressor=compressor,
+                rate_limiter=throttle.get_bucket("dump"),
+            )
+            if is_encrypted(file_name):
+                chunks = encrypt_stream(chunks, current_app.config)
+            chunks = throttle.limit(chunks, throttle.get_bucket("upload"))
+            if digest is not None:
+                chunks = digest.wrap(chunks)
+            if cache is not None and primary in pending:
+                writer = cache.writer(primary, file_name)
+                if writer is not None:
+                    chunks = writer.wrap(chunks)
+            ends = []
+            attempt_results = fan_out_upload(
+                pending,
+                file_name,
+                metrics.mark_end(track_progress(chunks, "upload"), ends),
+                current_app.config["FANOUT_BUFFER_CHUNKS"],
+                journal=journal,
+            )
+            if ends:
+                # The last part is only sent once the stream ended, after the
+                # time the upload held up the stream was recorded
+                metrics.add_time("upload", time.monotonic() - ends[0])
+            results.update(attempt_results)
+            if digest is not None:
+                digest.record(
+                    name for name, success in attempt_results.items() if success
+                )
+            if writer is not None and attempt_results.get(primary.name):
+                writer.commit_stored(primary, file_name)
+            pending = [target for target in pending if not attempt_results[target.name]]
+            if not pending:
+                logging.debug(
+                    f"[stream_backup] Backup streamed on attempt {attempt+1}: {file_name}"
+                )
+                return True
+            logging.error(
+                f"[stream_backup] Streaming upload to {', '.join(target.name for target in pending)} failed on attempt {attempt+1}"
+            )
+        except Exception as e:
+            logging.error(
+                f"[stream_backup] Error streaming backup on attempt {attempt+1}: {str(e)}"
+            )
+        finally:
+            # Don't leave the dump running if the upload gave up early
+            if process is not None and process.poll() is None:
+                process.kill()
+                process.wait()
+            if writer is not None:
+                writer.discard()
+        if attempt < 2:  # Don't sleep on the last attempt
+            metrics.count("retries")
+            time.sleep(5)
+    return False
+
+
+def directory_backup(db_url, backup_filename, digest=None, targets=None, results=None):
+    """
+    Dumps a PostgreSQL database in directory format with parallel `pg_dump` jobs,
+    then streams the directory to the configured destination as a tar archive.
+    The table files are already compressed by `pg_dump`, so the tar is not
+    compressed again, only encrypted when ENCRYPTION_KEY is set. The local
+    directory is removed once the upload is done.
+    Parameters:
+    db_url (str): The database connection URL.
+    backup_filename (str): The name of the backup directory, without extension.
+    digest (StreamDigest): Records the size and checksum of the uploaded archive.
+    targets (list): The destination targets to upload to. Defaults to the
+    configured destination.
+    results (dict): Filled with whether the upload succeeded, by target name.
+    Returns:
+    tuple: The name of the uploaded archive and whether the upload succeeded
+    on every target.
+    """
+    archive_name = backup_filename + ".tar" + encryption_suffix(current_app.config)
+    jobs = current_app.config["POSTGRES_DUMP_JOBS"]
+    extra_args, tables = table_filter_args(current_app.config, db_url, "postgres")
+
+    backup_directory = None
+    report_progress("dump")
+    for attempt in range(3):
+        with metrics.stage("dump"):
+            backup_directory = create_backup_postgres_directory(
+                db_url, backup_filename, jobs, extra_args, tables
+            )
+        if backup_directory:
+            logging.debug(
+                f"[directory_backup] Backup directory created with {jobs} jobs on attempt {attempt+1}: {backup_directory}"
+            )
+            break
+        logging.error(
+            f"[directory_backup] Error creating backup on attempt {attempt+1}"
+        )
+        if attempt < 2:  # Don't sleep on the last attempt
+            metrics.count("retries")
+            time.sleep(5)
+
+    if not backup_directory:
+        logging.error("[directory_backup] Backup creation failed")
+        sys.exit(1)
+
+    targets = targets or [primary_target(current_app.config)]
+    results = {} if results is None else results
+    results.update(dict.fromkeys([target.name for target in targets], False))
+    process = None
+    try:
+        process = open_tar_stream(backup_directory)
+        # The archive is both what is read and what is uploaded, so it is only
+        # limited by the lower of the two rates
+        chunks = throttle.limit(
+            stream_compressed_backup(
+                process,
+                current_app.config["STREAM_CHUNK_SIZE"],
+                compress=False,
+                rate_limiter=throttle.get_bucket("dump"),
+            ),
+            throttle.get_bucket("upload"),
+        )
+        if is_encrypted(archive_name):
+            chunks = encrypt_stream(chunks, current_app.config)
+        if digest is not None:
+            chunks = digest.wrap(chunks)
+        # The table files are compressed by pg_dump, the tar is sent as is
+        results.update(
+            fan_out_upload(
+                targets,
+                archive_name,
+                track_progress(
+                    metrics.count_bytes(chunks, "bytes_compressed"), "upload"
+                ),
+                current_app.config["FANOUT_BUFFER_CHUNKS"],
+            )
+        )
+    except Exception as e:
+        logging.error(f"[directory_backup] Error uploading backup: {str(e)}")
+    finally:
+        if process is not None and process.poll() is None:
+            process.kill()
+            process.wait()
+        shutil.rmtree(backup_directory, ignore_errors=True)
+
+    return archive_name, all(results.values())
+
+
+def incremental_backup(db_url, details, backup_filename, label=None):
+    """
+    Backs up only the tables that changed since the previous run, as a data-only
+    increment on top of the latest full base. Changes are detected with cheap
+    per-table markers. A new full base is taken when there is no chain yet, the
+    schema changed, or the chain reached INCREMENTAL_MAX_CHAIN increments.
+    A chain manifest (`<base name>.chain.json`) links the base to its increments.
+    Parameters:
+    db_url (str): The database connection URL.
+    details (dict): The parsed connection URL.
+    backup_filename (str): The backup name, without extension.
+    label (str): The label of the backup, or None.
+    Returns:
+    tuple: The name of the uploaded backup (or of the chain manifest when no table
+    changed) and whether the backup succeeded.
+    """
+    database_type = details["database_type"]
+    extension = get_extension(
+        current_app.config["COMPRESSION_CODEC"]
+    ) + encryption_suffix(current_app.config)
+    digest = StreamDigest()
+    markers, fingerprint = get_table_markers(
+        db_url, database_type, current_app.config["INCREMENTAL_MYSQL_CHECKSUM"]
+    )
+    include, exclude = table_filter(current_app.config)
+    markers = {
+        table: marker
+        for table, marker in markers.items()
+        if is_selected(table, include, exclude)
+    }
+    chain_name, chain = find_latest_chain(
+        find_backups(
+            DESTINATIONS[current_app.config["UPLOAD_DESTINATION"]],
+            details["database_name"],
+        ),
+        label,
+    )
+    tables = plan_backup(
+        chain, markers, fingerprint, current_app.config["INCREMENTAL_MAX_CHAIN"]
+    )
+
+    if tables is None:
+        logging.info("[incremental_backup] Taking a new full base backup")
+        file_name = backup_filename + extension
+        chain_name = backup_filename + CHAIN_SUFFIX
+        chain = new_chain(database_type, details["database_name"], fingerprint)
+        success = stream_backup(db_url, database_type, file_name, digest=digest)
+        entry_type = "full"
+    elif not tables:
+        logging.info("[incremental_backup] No table changed since the last backup")
+        file_name = None
+        success = True
+        entry_type = "incremental"
+    else:
+        logging.info(f"[incremental_backup] Backing up changed tables: {tables}")
+        file_name = backup_filename + ".inc" + extension
+        success = stream_backup(
+            db_url,
+            database_type,
+            file_name,
+            open_stream=lambda: open_increment_stream(db_url, database_type, tables),
+            digest=digest,
+        )
+        entry_type = "incremental"
+
+    if not success:
+        return file_name, False
+    add_chain_entry(chain, entry_type, file_name, markers, tables)
+    if not save_chain(chain_name, chain):
+        logging.error(f"[incremental_backup] Error saving chain manifest {chain_name}")
+        return file_name, False
+
+    entries = [
+        new_entry(
+            chain_name, details["database_name"], database_type, label=label or ""
+        )
+    ]
+    if file_name:
+        entries.append(
+            new_entry(
+                file_name,
+                details["database_name"],
+                database_type,
+                digest.size,
+                digest.hexdigest(),
+                "plain" if entry_type == "full" else "incremental",
+                label=label or "",
+            )
+        )
+    record_backups(details["database_name"], entries)
+    return file_name or chain_name, True
+
+
+def dedup_backup(db_url, database_type, backup_filename):
+    """
+    Streams the dump into the deduplicated chunk store: only chunks that are not
+    already stored are uploaded, and a small manifest records the backup.
+    Parameters:
+    db_url (str): The database connection URL.
+    database_type (str): The database type, as parsed from the connection URL.
+    backup_filename (str): The backup name, without extension.
+    Returns:
+    tuple: The name of the manifest and whether the backup succeeded.
+    """
+    destination = DESTINATIONS[current_app.config["UPLOAD_DESTINATION"]]
+    manifest_name = backup_filename + MANIFEST_SUFFIX
+    extra_args, tables = table_filter_args(current_app.config, db_url, database_type)
+    for attempt in range(3):
+        process = None
+        try:
+            process = DB_STREAM_FUNCTIONS[database_type](db_url, extra_args, tables)
+            manifest = store_stream(
+                destination,
+                track_progress(
+                    stream_compressed_backup(
+                        process,
+                        current_app.config["STREAM_CHUNK_SIZE"],
+                        compress=False,
+                        rate_limiter=throttle.get_bucket("dump"),
+                    ),
+                    "upload",
+                ),
+                manifest_name,
+                codec=current_app.config["COMPRESSION_CODEC"],
+                level=current_app.config["COMPRESSION_LEVEL"],
+                average_size=current_app.config["DEDUP_CHUNK_SIZE"],
+                concurrency=current_app.config["DEDUP_UPLOAD_CONCURRENCY"],
+                metadata={"database_type": database_type},
+                rate_limiter=throttle.get_bucket("upload"),
+            )
+            metrics.count("chunks_new", manifest["new_chunks"])
+            metrics.count("chunks_reused", manifest["reused_chunks"])
+            logging.debug(
+                f"[dedup_backup] Stored {manifest['size']} bytes with {manifest['new_chunks']} new chunks on attempt {attempt+1}"
+            )
+            return manifest_name, True
+        except Exception as e:
+            logging.error(
+                f"[dedup_backup] Error storing backup on attempt {attempt+1}: {str(e)}"
+            )
+        finally:
+            if process is not None and process.poll() is None:
+                process.kill()
+                process.wait()
+        if attempt < 2:  # Don't sleep on the last attempt
+            metrics.count("retries")
+            time.sleep(5)
+    return manifest_name, False
+
+
+def sharded_backup(
+    db_url, details, backup_filename, targets=None, results=None, label=None
+):
+    """
+    Dumps the database as several parts streamed in parallel, each uploaded as its
+    own object: the schema, the rows of the tables that are not sharded, one part
+    per primary key range of each table larger than SHARD_TABLE_SIZE, then the
+    indexes and constraints. On PostgreSQL every part is read from one exported
+    snapshot, so together they are as consistent as a single dump. On MySQL
+    every table is its own part, and the rows are read over MYSQL_DUMP_JOBS
+    connections, at least 2, that share one snapshot. A manifest
+    (`<backup>.shards.json`) lists the parts in restore order.
+    Parameters:
+    db_url (str): The database connection URL.
+    details (dict): The parsed connection URL.
+    backup_filename (str): The backup name, without extension.
+    targets (list): The destination targets to upload to. Defaults to the
+    configured destination.
+    results (dict): Filled with whether the upload succeeded, by target name.
+    label (str): The label of the backup, or None.
+    Returns:
+    tuple: The name of the manifest and whether the backup succeeded on every
+    target.
+    """
+    database_type = details["database_type"]
+    extension = get_extension(
+        current_app.config["COMPRESSION_CODEC"]
+    ) + encryption_suffix(current_app.config)
+    manifest_name = backup_filename + SHARDS_SUFFIX
+    targets = targets or [primary_target(current_app.config)]
+    results = {} if results is None else results
+    results.update(dict.fromkeys([target.name for target in targets], False))
+
+    extra_args, tables = table_filter_args(current_app.config, db_url, database_type)
+    include, exclude = table_filter(current_app.config)
+    shards = []
+    if current_app.config["SHARD_TABLE_SIZE"]:
+        shards = plan_shards(
+            db_url,
+            database_type,
+            current_app.config["SHARD_TABLE_SIZE"],
+            include,
+            exclude,
+        )
+    sharded = sorted({shard["table"] for shard in shards})
+    logging.info(f"[sharded_backup] Sharding {len(shards)} ranges of {sharded}")
+    # mysqldump processes can't share a snapshot, so the parts of a MySQL
+    # backup are always read by the parallel engine, which dumps every table on
+    # its own over connections that share one
+    connections = 0
+    whole_tables = None
+    if database_type == "mysql":
+        connections = max(2, current_app.config["MYSQL_DUMP_JOBS"])
+        whole_tables = list_tables(db_url, database_type, include, exclude)
+    parts = plan_parts(database_type, shards, tables, whole_tables)
+    for number, part in enumerate(parts):
+        part["file"] = f"{backup_filename}.shard{number:04d}{extension}"
+    digests = [StreamDigest() for _ in parts]
+    part_results = [{} for _ in parts]
+
+    with exported_snapshot(db_url, database_type, connections) as snapshot:
+
+        def dump_part(index):
+            part = parts[index]
+            return stream_backup(
+                db_url,
+                database_type,
+                part["file"],
+                open_stream=lambda: open_part_stream(
+                    db_url, database_type, part, sharded, snapshot, extra_args, tables
+                ),
+                digest=digests[index],
+                targets=targets,
+                results=part_results[index],
+            )
+
+        with ThreadPoolExecutor(
+            max_workers=max(1, connections or current_app.config["SHARD_JOBS"])
+        ) as executor:
+            futures = [
+                executor.submit(contextvars.copy_context().run, dump_part, index)
+                for index in range(len(parts))
+            ]
+            for future in futures:
+                future.result()
+
+    # The binary log position of a MySQL snapshot, if it can be read
+    position = getattr(snapshot, "position", None)
+    manifest = json.dumps(
+        {
+            "database_type": database_type,
+            "database": details["database_name"],
+            "snapshot": getattr(snapshot, "position", snapshot),
+            "include": include,
+            "exclude": exclude,
+            "parts": parts,
+        },
+        indent=2,
+    ).encode()
+    for target in targets:
+        # The parts that made it are recorded either way, so trims remove them
+        entries = [
+            new_entry(
+                part["file"],
+                details["database_name"],
+                database_type,
+                *digest.of(target.name),
+                label=label or "",
+            )
+            for part, digest, part_result in zip(parts, digests, part_results)
+            if part_result.get(target.name)
+        ]
+        if len(entries) == len(parts):
+            results[target.name] = target.upload_to_destination(manifest_name, manifest)
+        else:
+            logging.error(
+                f"[sharded_backup] {len(parts) - len(entries)} parts could not be uploaded to {target.name}"
+            )
+        if results[target.name]:
+            entry = new_entry(
+                manifest_name,
+                details["database_name"],
+                database_type,
+                label=label or "",
+            )
+            if position:
+                # Marks the backups binary logs can be replayed on top of
+                entry["binlog"] = position
+            entries.append(entry)
+        if entries:
+            record_backups(details["database_name"], entries, target)
+    return manifest_name, all(results.values())
+
+
+def archive_segments(targets, indexes, database, database_type, spool):
+    """
+    Runs one cycle of the log archiver: the segments completed since the last
+    cycle are uploaded as one compressed batch, and the segment still being
+    written as a snapshot that replaces the previous one. Completed segments
+    are removed from the spool once every target stored them.
+    Parameters:
+    targets (list): The destination targets to upload to.
+    indexes (dict): The archive index of each target, by target name.
+    database (str): The name of the database.
+    database_type (str): 'postgres' or 'mysql'.
+    spool (str): The directory the receiver writes the segments to.
+    Returns:
+    bool: True if everything was archived on every target.
+    """
+    extension = (
+        ".tar"
+        + get_extension(current_app.config["COMPRESSION_CODEC"])
+        + encryption_suffix(current_app.config)
+    )
+    archived_at = datetime.now().strftime("%Y%m%d%H%M%S")
+    complete, partial = spool_files(spool, database_type)
+    success = True
+
+    if complete:
+        file_name = batch_name(database, complete[0], extension)
+        results = {}
+        stream_backup(
+            None,
+            database_type,
+            file_name,
+            open_stream=lambda: open_tar_stream(spool, complete),
+            targets=targets,
+            results=results,
+            cache_copy=False,
+        )
+        for target in targets:
+            if not results.get(target.name):
+                continue
+            index = indexes[target.name]
+            add_batch(index, file_name, complete, archived_at)
+            # The snapshot of a segment that is now complete is not needed
+            if index["partial"] and index["partial"]["segment"] in complete:
+                target.delete_file_from_destination(index["partial"]["file"])
+                index["partial"] = None
+            write_archive_index(target, database, index)
+        if all(results.values()):
+            logging.info(f"[archive_segments] Archived {len(complete)} segments")
+            for name in complete:
+                os.remove(os.path.join(spool, name))
+        else:
+            success = False
+
+    if partial:
+        path = os.path.join(spool, partial)
+        modified = os.path.getmtime(path)
+        pending = [
+            target
+            for target in targets
+            if (indexes[target.name]["partial"] or {}).get("modified") != modified
+        ]
+        if pending:
+            file_name = batch_name(database, segment_name(partial), extension, True)
+            scratch = tempfile.mkdtemp(prefix="archive_")
+            try:
+                snapshot_partial(spool, partial, scratch)
+                results = {}
+                stream_backup(
+                    None,
+                    database_type,
+                    file_name,
+                    open_stream=lambda: open_tar_stream(scratch, [partial]),
+                    targets=pending,
+                    results=results,
+                    cache_copy=False,
+                )
+            finally:
+                shutil.rmtree(scratch, ignore_errors=True)
+            for target in pending:
+                if not results.get(target.name):
+                    success = False
+                    continue
+                index = indexes[target.name]
+                previous = index["partial"]
+                index["partial"] = {
+                    "file": file_name,
+                    "segment": segment_name(partial),
+                    "archived_at": archived_at,
+                    "modified": modified,
+                }
+                write_archive_index(target, database, index)
+                if previous and previous["file"] != file_name:
+                    target.delete_file_from_destination(previous["file"])
+    return success
+
+
+def _start_receiver(db_url, database_type, spool, indexes):
+    """
+    Starts the process that streams the WAL or binary logs into the spool.
+    `pg_receivewal` resumes from its replication slot. `mysqlbinlog` resumes
+    from the newest binary log in the spool or in the archive, or from the
+    server's current one.
+    """
+    if database_type == "postgres":
+        return open_wal_receiver_postgres(
+            db_url, spool, current_app.config["ARCHIVE_SLOT"]
+        )
+    _, start_file = spool_files(spool, database_type)
+    for index in indexes.values():
+        if start_file:
+            break
+        if index["partial"]:
+            start_file = index["partial"]["segment"]
+        elif index["batches"]:
+            start_file = index["batches"][-1]["segments"][-1]
+    if not start_file:
+        for statement in ("SHOW BINARY LOG STATUS", "SHOW MASTER STATUS"):
+            try:
+                start_file = DB_QUERY_FUNCTIONS["mysql"](db_url, statement)[0][0]
+                break
+            except (subprocess.CalledProcessError, IndexError):
+                continue
+        else:
+            raise RuntimeError("Binary logging is off or cannot be read")
+    return open_binlog_receiver_mysql(db_url, spool, start_file)
+
+
+@destination_session
+def archive_logs(db_var):
+    """
+    Runs the log archiver of the database held by a config var until the
+    process is stopped: the WAL (PostgreSQL) or binary logs (MySQL) are
+    streamed to a local spool as they are written, and archived to the
+    destinations every ARCHIVE_INTERVAL seconds, so a restore can replay them
+    on top of a base backup up to any point in time. The receiver is
+    restarted if it exits. On SIGTERM, the spool is archived one last time.
+    Parameters:
+    db_var (str): The config var holding the database URL.
+    """
+    with app.app_context():
+        db_url = os.getenv(db_var)
+
+        if db_url is None:
+            logging.error(f"[archive_logs] Invalid environment variable: {db_var}")
+            sys.exit(1)
+        elif not (
+            isinstance(db_url, str) and db_url.startswith(("postgres://", "mysql://"))
+        ):
+            logging.error("[archive_logs] Invalid database connection URL")
+            sys.exit(1)
+        details = parse_connection_url(db_url)
+        database = details["database_name"]
+        database_type = details["database_type"]
+        try:
+            targets = upload_targets(current_app.config)
+            check_encryption_config(current_app.config)
+        except ValueError as e:
+            logging.error(f"[archive_logs] {str(e)}")
+            sys.exit(1)
+
+        indexes = {}
+        for target in targets:
+            indexes[target.name] = read_archive_index(target, database)
+            indexes[target.name]["database_type"] = database_type
+        spool = os.path.join(current_app.config["ARCHIVE_SPOOL_DIR"], database)
+        os.makedirs(spool, exist_ok=True)
+
+        stopping = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *args: stopping.set())
+        receiver = None
+        try:
+            while not stopping.is_set():
+                if receiver is None or receiver.poll() is not None:
+                    if receiver is not None:
+                        logging.error(
+                            f"[archive_logs] The receiver exited with return code {receiver.returncode}, restarting it"
+                        )
+                    try:
+                        receiver = _start_receiver(
+                            db_url, database_type, spool, indexes
+                        )
+                    except Exception as e:
+                        logging.error(
+                            f"[archive_logs] Error starting the receiver: {str(e)}"
+                        )
+                        receiver = None
+                try:
+                    archive_segments(targets, indexes, database, database_type, spool)
+                except Exception as e:
+                    logging.error(f"[archive_logs] Error archiving segments: {str(e)}")
+                stopping.wait(current_app.config["ARCHIVE_INTERVAL"])
+        finally:
+            if receiver is not None and receiver.poll() is None:
+                receiver.terminate()
+                receiver.wait()
+        # What the receiver wrote before it stopped
+        archive_segments(targets, indexes, database, database_type, spool)
+        logging.info("[archive_logs] Stopped")
+
+
+def rebuild_backup(file_name, output):
+    """
+    Rebuilds a full logical dump from any backup: an incremental chain manifest
+    (base plus increments), a deduplicated store manifest (its chunks in order),
+    a sharded backup manifest (its parts in order) or a compressed dump,
+    decompressed on the fly.
+    Parameters:
+    file_name (str): The name of the backup at the destination.
+    output (file): A binary file object to write the SQL to.
+    """
+    with app.app_context():
+        destination = DESTINATIONS[current_app.config["UPLOAD_DESTINATION"]]
+        try:
+            for chunk in iter_backup_data(
+                destination, file_name, current_app.config["STREAM_CHUNK_SIZE"]
+            ):
+                output.write(chunk)
+        except Exception as e:
+            logging.error(f"[rebuild_backup] Error rebuilding {file_name}: {str(e)}")
+            sys.exit(1)
+
+
+@destination_session
+def list_backups(db_var, label=None, rebuild=False):
+    """
+    Lists the backups of the database held by a config var from its catalog.
+    Parameters:
+    db_var (str): The config var holding the database URL.
+    label (str): Only list the backups with this label.
+    rebuild (bool): Rebuild the catalog from a full listing of the destination first.
+    Returns:
+    list: The catalog entries, oldest first.
+    """
+    with app.app_context():
+        db_url = os.getenv(db_var)
+
+        if db_url is None:
+            logging.error(f"[list_backups] Invalid environment variable: {db_var}")
+            sys.exit(1)
+        details = parse_connection_url(db_url)
+        destination = DESTINATIONS[current_app.config["UPLOAD_DESTINATION"]]
+        if rebuild:
+            rebuild_catalog(destination, details["database_name"])
+        return find_backups(destination, details["database_name"], label=label)
+
+
+@destination_session
+def restore_backup(db_var, backup_file=None):
+    """
+    Restores a backup into the database held by a config var. The backup is
+    streamed from the destination, decompressed on the fly and piped into
+    `psql` or `mysql`, so nothing is staged on disk. Directory-format backups
+    are extracted to a scratch directory and restored with parallel
+    `pg_restore -j RESTORE_JOBS`, and the parts of sharded backups are loaded
+    RESTORE_JOBS at a time.
+    Parameters:
+    db_var (str): The config var holding the URL of the database to restore into.
+    backup_file (str): The backup to restore. Defaults to the database's latest
+    unlabelled backup.
+    Returns:
+    str: The name of the restored backup.
+    """
+    with app.app_context():
+        db_url = os.getenv(db_var)
+
+        if db_url is None:
+            logging.error(f"[restore_backup] Invalid environment variable: {db_var}")
+            sys.exit(1)
+        elif isinstance(db_url, str) and db_url.startswith(("postgres://", "mysql://")):
+            details = parse_connection_url(db_url)
+            destination = DESTINATIONS[current_app.config["UPLOAD_DESTINATION"]]
+            backup_file = backup_file or find_latest_backup(
+                destination, details["database_name"]
+            )
+            if not backup_file:
+                logging.error(
+                    f"[restore_backup] No backup found for {details['database_name']}"
+                )
+                sys.exit(1)
+
+            if ".base." in backup_file:
+                logging.error(
+                    "[restore_backup] Base backups are restored with restore_to_time"
+                )
+                sys.exit(1)
+
+            with metrics.track_run("restore", db_var) as run:
+                logging.info(f"[restore_backup] Restoring {backup_file} into {db_var}")
+                if plain_name(backup_file).endswith(".tar"):
+                    if details["database_type"] != "postgres":
+                        logging.error(
+                            "[restore_backup] Directory-format backups can only be restored into PostgreSQL"
+                        )
+                        sys.exit(1)
+                    restore_success = restore_directory_archive(
+                        destination,
+                        backup_file,
+                        db_url,
+                        current_app.config["RESTORE_JOBS"],
+                        current_app.config["STREAM_CHUNK_SIZE"],
+                    )
+                elif backup_file.endswith(SHARDS_SUFFIX):
+                    restore_success = restore_shards(
+                        destination,
+                        backup_file,
+                        db_url,
+                        details["database_type"],
+                        current_app.config["RESTORE_JOBS"],
+                        current_app.config["STREAM_CHUNK_SIZE"],
+                    )
+                else:
+                    restore_success = restore_stream(
+                        destination,
+                        backup_file,
+                        db_url,
+                        details["database_type"],
+                        current_app.config["STREAM_CHUNK_SIZE"],
+                    )
+
+                if restore_success:
+                    logging.info(f"[restore_backup] Restore successful: {backup_file}")
+                    send_email_notification(
+                        app.config,
+                        "Restore Successful",
+                        f"Restore successful: {backup_file} into {db_var}\n\n{run.format()}",
+                    )
+                    return backup_file
+                else:
+                    logging.error("[restore_backup] Restore failed")
+                    send_email_notification(
+                        app.config,
+                        "Restore Failed",
+                        f"Restore failed: {backup_file} into {db_var}\n\n{run.format()}",
+                    )
+                    sys.exit(1)
+        else:
+            logging.error("[restore_backup] Invalid database connection URL")
+            sys.exit(1)
+
+
+@destination_session
+def restore_to_time(db_var, target_time, data_directory=None):
+    """
+    Recovers the database held by a config var as it was at `target_time`, from
+    the latest base backup taken before then and the WAL or binary logs
+    archived since. On MySQL the sharded backup is restored into the database,
+    then the binary logs are replayed from the position of its snapshot. On
+    PostgreSQL a physical backup can't be restored over a connection: it is
+    extracted into `data_directory` with the archived WAL, set up to replay it
+    up to `target_time` once PostgreSQL is started on it.
+    Parameters:
+    db_var (str): The config var holding the database URL.
+    target_time (str): The time to recover to, 'YYYY-mm-dd HH:MM:SS'.
+    data_directory (str): The empty directory to recover a PostgreSQL cluster into.
+    Returns:
+    str: The name of the base backup the recovery started from.
+    """
+    with app.app_context():
+        db_url = os.getenv(db_var)
+
+        if db_url is None:
+            logging.error(f"[restore_to_time] Invalid environment variable: {db_var}")
+            sys.exit(1)
+        elif not (
+            isinstance(db_url, str) and db_url.startswith(("postgres://", "mysql://"))
+        ):
+            logging.error("[restore_to_time] Invalid database connection URL")
+            sys.exit(1)
+        details = parse_connection_url(db_url)
+        database_type = details["database_type"]
+        if database_type == "postgres" and not data_directory:
+            logging.error(
+                "[restore_to_time] PostgreSQL is recovered into a data directory, pass its path"
+            )
+            sys.exit(1)
+        try:
+            target = parse_target_time(target_time)
+        except ValueError as e:
+            logging.error(f"[restore_to_time] {str(e)}")
+            sys.exit(1)
+        until = target.strftime("%Y%m%d%H%M%S")
+
+        destination = DESTINATIONS[current_app.config["UPLOAD_DESTINATION"]]
+        chunk_size = current_app.config["STREAM_CHUNK_SIZE"]
+        bases = [
+            entry
+            for entry in base_backups(
+                destination, details["database_name"], database_type
+            )
+            if entry["timestamp"] <= until
+        ]
+        if not bases:
+            logging.error(
+                f"[restore_to_time] No base backup of {details['database_name']} was taken before {target_time}"
+            )
+            sys.exit(1)
+        base = bases[-1]
+        batches, partial = plan_recovery(
+            read_archive_index(destination, details["database_name"]),
+            base["timestamp"],
+            until,
+        )
+        logging.info(
+            f"[restore_to_time] Recovering from {base['file']} with {len(batches)} archived batches"
+        )
+
+        def extract(file_name, directory):
+            process = subprocess.Popen(
+                ["tar", "-xf", "-", "-C", directory], stdin=subprocess.PIPE
+            )
+            if not pipe_to_process(
+                iter_backup_data(destination, file_name, chunk_size), process
+            ):
+                raise RuntimeError(f"Could not extract {file_name}")
+
+        with metrics.track_run("restore", db_var) as run:
+            scratch = tempfile.mkdtemp(prefix="archive_")
+            try:
+                if database_type == "postgres":
+                    os.makedirs(data_directory, exist_ok=True)
+                    if os.listdir(data_directory):
+                        raise RuntimeError(f"{data_directory} is not empty")
+                    extract(base["file"], data_directory)
+                    log_directory = os.path.join(data_directory, "archived_wal")
+                else:
+                    if not restore_shards(
+                        destination,
+                        base["file"],
+                        db_url,
+                        database_type,
+                        current_app.config["RESTORE_JOBS"],
+                        chunk_size,
+                    ):
+                        raise RuntimeError(f"Could not restore {base['file']}")
+                    log_directory = scratch
+                os.makedirs(log_directory, exist_ok=True)
+                for batch in batches:
+                    extract(batch["file"], log_directory)
+                if partial:
+                    extract(partial["file"], log_directory)
+                    # A partial WAL segment is replayed under its final name
+                    for name in os.listdir(log_directory):
+                        if name.endswith(".partial") and not os.path.exists(
+                            os.path.join(log_directory, segment_name(name))
+                        ):
+                            os.rename(
+                                os.path.join(log_directory, name),
+                                os.path.join(log_directory, segment_name(name)),
+                            )
+
+                if database_type == "postgres":
+                    write_recovery_config(data_directory, log_directory, target)
+                    logging.info(
+                        f"[restore_to_time] Start PostgreSQL on {data_directory} to replay the WAL up to {target_time}"
+                    )
+                    restore_success = True
+                else:
+                    position = base["binlog"]
+                    files = sorted(
+                        name
+                        for name in os.listdir(log_directory)
+                        if name >= position["file"]
+                    )
+                    if not files or files[0] != position["file"]:
+                        raise RuntimeError(
+                            f"The binary log {position['file']} was not archived"
+                        )
+                    restore_success = replay_binlogs_mysql(
+                        db_url,
+                        [os.path.join(log_directory, name) for name in files],
+                        position["position"],
+                        target.strftime("%Y-%m-%d %H:%M:%S"),
+                    )
+            except Exception as e:
+                logging.error(f"[restore_to_time] {str(e)}")
+                restore_success = False
+            finally:
+                shutil.rmtree(scratch, ignore_errors=True)
+
+            if restore_success:
+                send_email_notification(
+                    app.config,
+                    "Restore Successful",
+                    f"Recovered {db_var} to {target_time} from {base['file']}\n\n{run.format()}",
+                )
+                return base["file"]
+            send_email_notification(
+                app.config,
+                "Restore Failed",
+                f"Recovery of {db_var} to {target_time} failed\n\n{run.format()}",
+            )
+            sys.exit(1)
+
+
+# Test restores overwrite the one scratch database, so they run one at a time
+_scratch_lock = threading.Lock()
+
+
+def _test_restore(destination, backup_file, database_type):
+    """
+    Restores a verified backup into the scratch database of VERIFY_RESTORE_URL,
+    emptied first, and counts the tables it created.
+    Returns:
+    dict: Whether the restore succeeded, the number of tables restored and the
+    error, if any.
+    """
+    scratch_url = current_app.config["VERIFY_RESTORE_URL"]
+    if parse_connection_url(scratch_url)["database_type"] != database_type:
+        return {
+            "ok": False,
+            "tables": None,
+            "error": f"VERIFY_RESTORE_URL is not a {database_type} database",
+        }
+    try:
+        with _scratch_lock:
+            reset_scratch_database(scratch_url, database_type)
+            if plain_name(backup_file).endswith(".tar"):
+                restore_success = restore_directory_archive(
+                    destination,
+                    backup_file,
+                    scratch_url,
+                    current_app.config["RESTORE_JOBS"],
+                    current_app.config["STREAM_CHUNK_SIZE"],
+                )
+            else:
+                restore_success = restore_stream(
+                    destination,
+                    backup_file,
+                    scratch_url,
+                    database_type,
+                    current_app.config["STREAM_CHUNK_SIZE"],
+                )
+            if not restore_success:
+                return {"ok": False, "tables": None, "error": "the restore failed"}
+            tables = count_tables(scratch_url, database_type)
+    except Exception as e:
+        return {"ok": False, "tables": None, "error": str(e)}
+    if not tables:
+        return {"ok": False, "tables": 0, "error": "the restore created no table"}
+    return {"ok": True, "tables": tables, "error": None}
+
+
+@destination_session
+def verify_backup_integrity(db_var, backup_file=None, restore=False, sample=False):
+    """
+    Checks that a backup is intact at every destination it was written to, by
+    streaming it back without writing it to disk, see `integrity.verify_backup`.
+    With `restore`, the backup is then restored into the scratch database of
+    VERIFY_RESTORE_URL, which is emptied first, to prove that it can be used.
+    Parameters:
+    db_var (str): The config var holding the URL of the backed up database.
+    backup_file (str): The backup to verify. Defaults to the latest unlabelled
+    backup of the database.
+    restore (bool): Also test a restore into VERIFY_RESTORE_URL.
+    sample (bool): Pick a random backup from the catalog instead of the latest
+    one, so that scheduled runs end up covering the whole history.
+    Returns:
+    dict: The backup, whether it passed, the reports of its files by
+    destination and the outcome of the test restore.
+    """
+    with app.app_context():
+        db_url = os.getenv(db_var)
+
+        if db_url is None:
+            logging.error(f"[verify_backup] Invalid environment variable: {db_var}")
+            sys.exit(1)
+        details = parse_connection_url(db_url)
+        database = details["database_name"]
+        try:
+            targets = upload_targets(current_app.config)
+        except ValueError as e:
+            logging.error(f"[verify_backup] {str(e)}")
+            sys.exit(1)
+        if restore and not current_app.config["VERIFY_RESTORE_URL"]:
+            logging.error("[verify_backup] VERIFY_RESTORE_URL is not set")
+            sys.exit(1)
+
+        report_progress("list")
+        entries = find_backups(targets[0], database)
+        if not backup_file and sample:
+            candidates = [
+                entry["file"] for entry in entries if is_restorable(entry["file"])
+            ]
+            backup_file = random.choice(candidates) if candidates else None
+        backup_file = backup_file or find_latest_backup(targets[0], database)
+        if not backup_file:
+            logging.error(f"[verify_backup] No backup found for {database}")
+            sys.exit(1)
+
+        result = {
+            "database": database,
+            "file": backup_file,
+            "ok": True,
+            "destinations": {},
+            "restore": None,
+        }
+        with metrics.track_run("verify", db_var) as run:
+            for target in targets:
+                by_file = {
+                    entry["file"]: entry
+                    for entry in (
+                        entries
+                        if target is targets[0]
+                        else find_backups(target, database)
+                    )
+                }
+                # Incremental and dedup backups are not fanned out
+                if target is not targets[0] and backup_file not in by_file:
+                    continue
+                report_progress("verify", destination=target.name)
+                reports = verify_backup(
+                    target,
+                    backup_file,
+                    by_file,
+                    current_app.config["STREAM_CHUNK_SIZE"],
+                )
+                result["destinations"][target.name] = reports
+                for report in reports:
+                    if not report["ok"]:
+                        result["ok"] = False
+                        logging.error(
+                            f"[verify_backup] {target.name}: {report['file']} is damaged: {'; '.join(report['errors'])}"
+                        )
+            if restore and result["ok"]:
+                report_progress("restore")
+                result["restore"] = _test_restore(
+                    targets[0], backup_file, details["database_type"]
+                )
+                if not result["restore"]["ok"]:
+                    result["ok"] = False
+                    logging.error(
+                        f"[verify_backup] Test restore of {backup_file} failed: {result['restore']['error']}"
+                    )
+
+        errors = [
+            f"{name}: {report['file']}: {'; '.join(report['errors'])}"
+            for name, reports in result["destinations"].items()
+            for report in reports
+            if not report["ok"]
+        ]
+        if result["restore"] and not result["restore"]["ok"]:
+            errors.append(f"Test restore: {result['restore']['error']}")
+        if result["ok"]:
+            logging.info(f"[verify_backup] {backup_file} verified")
+            send_email_notification(
+                app.config,
+                "Backup Verified",
+                f"Backup verified: {backup_file}\n\n{run.format()}",
+            )
+        else:
+            send_email_notification(
+                app.config,
+                "Backup Verification Failed",
+                f"Backup verification failed: {backup_file}\n\n"
+                + "\n".join(errors)
+                + f"\n\n{run.format()}",
+            )
+        return result
+
+
+def record_backups(database, entries, destination=None):
+    """
+    Adds new backups to the catalog of their database, and stores the SHA-256
+    of each next to it in a `.sha256` sidecar for `verify`. A backup that could
+    not be recorded is still a valid backup, so the error is only logged. It
+    can be recovered with `rebuild_catalog`.
+    """
+    destination = destination or DESTINATIONS[current_app.config["UPLOAD_DESTINATION"]]
+    for entry in entries:
+        if entry["checksum"] and not write_sidecar(
+            destination, entry["file"], entry["checksum"]
+        ):
+            logging.error(
+                f"[record_backups] Error storing the checksum of {entry['file']}"
+            )
+    try:
+        update_catalog(destination, database, add=entries)
+    except Exception as e:
+        logging.error(
+            f"[record_backups] Error recording {[entry['file'] for entry in entries]} in the catalog: {str(e)}"
+        )
+
+
+# The settings that shape a backup. A run with other settings is never skipped.
+BACKUP_SHAPE_SETTINGS = (
+    "COMPRESSION_CODEC",
+    "DEDUP_STORE",
+    "POSTGRES_DUMP_FORMAT",
+    "MYSQL_DUMP_JOBS",
+    "SHARD_TABLE_SIZE",
+    "BACKUP_INCLUDE_TABLES",
+    "BACKUP_EXCLUDE_TABLES",
+)
+
+
+def backup_marker(db_url, database_type):
+    """
+    Reads the change marker of a database, tagged with a hash of the settings
+    the backup would be taken with.
+    Returns:
+    str: The marker, or None if the database has none.
+    """
+    marker = get_database_marker(db_url, database_type)
+    if marker is None:
+        return None
+    # Whether backups are encrypted, the key itself is never hashed
+    settings = json.dumps(
+        [current_app.config[name] for name in BACKUP_SHAPE_SETTINGS]
+        + [encryption_suffix(current_app.config)],
+        default=str,
+    )
+    return f"{marker}/{hashlib.sha256(settings.encode()).hexdigest()[:12]}"
+
+
+def find_unchanged_backup(targets, database, label, marker):
+    """
+    Finds the backup a run can be skipped for: the latest backup of the series
+    at every target, when it was taken with the same marker, so the database
+    has not changed since, and is not older than BACKUP_SKIP_MAX_AGE hours.
+    Parameters:
+    targets (list): The destination targets the backup would be written to.
+    database (str): The name of the database.
+    label (str): The label of the series, or None.
+    marker (str): The current marker, see `backup_marker`.
+    Returns:
+    dict: The catalog entry of the backup, or None if a backup must be taken.
+    """
+    if marker is None:
+        return None
+    max_age = current_app.config["BACKUP_SKIP_MAX_AGE"]
+    oldest = (datetime.now() - timedelta(hours=max_age)).strftime("%Y%m%d%H%M%S")
+    latest = None
+    for target in targets:
+        units = [
+            entry
+            for entry in retention_units(find_backups(target, database))
+            if entry["label"] == label
+        ]
+        if not units:
+            return None
+        entry = max(units, key=lambda entry: entry["timestamp"])
+        if entry.get("marker") != marker or (max_age and entry["timestamp"] < oldest):
+            return None
+        if latest is not None and entry["file"] != latest["file"]:
+            return None
+        latest = entry
+    return latest
+
+
+@destination_session
+def manual_backup(db_var, label=None, profile=None):
     with app.app_context():
         db_url = os.getenv(db_var)
 
@@ -63,81 +1566,213 @@ def manual_backup(db_var, label=None):
                 else f"{details['database_name']}_{timestamp}"
             )
 
-            backup_file = None
-            for attempt in range(3):
-                try:
-                    backup_file = DB_BACKUP_FUNCTIONS[details["database_type"]](
-                        db_url, backup_filename
-                    )
-                    logging.debug(
-                        f"[manual_backup] Backup file created on attempt {attempt+1}: {backup_file}"
-                    )
-                    break
-                except Exception as e:
-                    logging.error(
-                        f"[manual_backup] Error creating backup on attempt {attempt+1}: {str(e)}"
-                    )
-                    if attempt < 2:  # Don't sleep on the last attempt
-                        time.sleep(5)
-                    else:
-                        backup_file = None
-                        break
-
-            if backup_file is None:
-                logging.error("[manual_backup] Backup creation failed")
-                sys.exit(1)
-
             try:
-                logging.debug(f"[manual_backup] Compressing backup file: {backup_file}")
-                compression_success = compress_backup(backup_file)
-                if not compression_success:
-                    raise Exception("[manual_backup] Compression failed")
-            except Exception as e:
-                logging.error(f"[manual_backup] Error compressing backup: {str(e)}")
+                targets = upload_targets(current_app.config)
+                check_encryption_config(current_app.config)
+            except ValueError as e:
+                logging.error(f"[manual_backup] {str(e)}")
                 sys.exit(1)
+            # Both build on the backups already at the destination they write to
+            if len(targets) > 1 and (
+                current_app.config["INCREMENTAL_BACKUPS"]
+                or current_app.config["DEDUP_STORE"]
+            ):
+                logging.warning(
+                    f"[manual_backup] Incremental and dedup backups are not fanned out, only writing to {targets[0].name}"
+                )
+                targets = targets[:1]
 
-            compressed_backup_file = backup_file + ".gz"
-            logging.debug(
-                f"[manual_backup] Backup file compressed successfully: {compressed_backup_file}"
-            )
-
-            upload_success = False
-            try:
-                logging.debug(
-                    f"[manual_backup] Uploading compressed backup file: {compressed_backup_file}"
+            # An incremental backup already only dumps the tables that changed
+            marker = None
+            if (
+                current_app.config["BACKUP_SKIP_UNCHANGED"]
+                and not current_app.config["INCREMENTAL_BACKUPS"]
+            ):
+                # Read before the dump, so writes made during it are seen next time
+                marker = backup_marker(db_url, details["database_type"])
+                previous = find_unchanged_backup(
+                    targets, details["database_name"], label, marker
                 )
-                with open(compressed_backup_file, "rb") as file:
-                    file_content = file.read()
-                if current_app.config["UPLOAD_DESTINATION"] == "S3":
-                    upload_success = s3.upload_to_destination(
-                        compressed_backup_file, file_content
+                if previous:
+                    with metrics.track_run("backup", db_var) as run:
+                        run.skip()
+                        # Recorded so retention counts the skipped run's period
+                        for target in targets:
+                            try:
+                                update_catalog(
+                                    target,
+                                    details["database_name"],
+                                    amend={
+                                        previous["file"]: {"unchanged_until": timestamp}
+                                    },
+                                )
+                            except Exception as e:
+                                logging.error(
+                                    f"[manual_backup] Error recording the skipped backup in the catalog: {str(e)}"
+                                )
+                        logging.info(
+                            f"[manual_backup] {details['database_name']} has not changed since {previous['file']}, skipping the backup"
+                        )
+                        send_email_notification(
+                            app.config,
+                            "Backup Skipped",
+                            f"Backup skipped, the database has not changed since {previous['file']}",
+                        )
+                    return previous["file"]
+
+            results = {}
+            digest = StreamDigest()
+            with metrics.track_run("backup", db_var) as run, metrics.profile_run(
+                profile, backup_filename
+            ), throttle.throttled(db_url, details["database_type"], current_app.config):
+                if current_app.config["INCREMENTAL_BACKUPS"]:
+                    compressed_backup_file, upload_success = incremental_backup(
+                        db_url, details, backup_filename, label
                     )
-                elif current_app.config["UPLOAD_DESTINATION"] == "FTP":
-                    upload_success = ftp.upload_to_destination(
-                        compressed_backup_file, file_content
+                elif current_app.config["DEDUP_STORE"]:
+                    compressed_backup_file, upload_success = dedup_backup(
+                        db_url, details["database_type"], backup_filename
                     )
-            except Exception as e:
-                logging.error(f"[manual_backup] Error uploading backup: {str(e)}")
-                sys.exit(1)
+                elif current_app.config["SHARD_TABLE_SIZE"] or (
+                    details["database_type"] == "mysql"
+                    and current_app.config["MYSQL_DUMP_JOBS"] > 1
+                ):
+                    compressed_backup_file, upload_success = sharded_backup(
+                        db_url, details, backup_filename, targets, results, label
+                    )
+                elif (
+                    details["database_type"] == "postgres"
+                    and current_app.config["POSTGRES_DUMP_FORMAT"] == "base"
+                ):
+                    # A physical copy of the cluster, for point-in-time recovery
+                    compressed_backup_file = (
+                        backup_filename
+                        + ".base.tar"
+                        + get_extension(current_app.config["COMPRESSION_CODEC"])
+                        + encryption_suffix(current_app.config)
+                    )
+                    upload_success = stream_backup(
+                        db_url,
+                        details["database_type"],
+                        compressed_backup_file,
+                        open_stream=lambda: open_base_backup_postgres(db_url),
+                        digest=digest,
+                        targets=targets,
+                        results=results,
+                    )
+                elif (
+                    details["database_type"] == "postgres"
+                    and current_app.config["POSTGRES_DUMP_FORMAT"] == "directory"
+                ):
+                    compressed_backup_file, upload_success = directory_backup(
+                        db_url, backup_filename, digest, targets, results
+                    )
+                else:
+                    compressed_backup_file = (
+                        backup_filename
+                        + get_extension(current_app.config["COMPRESSION_CODEC"])
+                        + encryption_suffix(current_app.config)
+                    )
+                    journal = None
+                    # A journal follows the upload to a single destination
+                    if current_app.config["RESUMABLE_UPLOADS"] and len(targets) == 1:
+                        journal, compressed_backup_file = resume_or_start(
+                            targets[0],
+                            backup_filename[: -len(timestamp) - 1],
+                            compressed_backup_file,
+                        )
+                    if current_app.config["BACKUP_STREAMING"]:
+                        upload_success = stream_backup(
+                            db_url,
+                            details["database_type"],
+                            compressed_backup_file,
+                            digest=digest,
+                            journal=journal,
+                            targets=targets,
+                            results=results,
+                        )
+                    else:
+                        compressed_backup_file, upload_success = file_backup(
+                            db_url,
+                            details["database_type"],
+                            backup_filename,
+                            digest,
+                            targets,
+                            results,
+                            file_name=compressed_backup_file,
+                            journal=journal,
+                        )
 
-            if upload_success:
-                logging.info(
-                    f"[manual_backup] Backup upload successful: {compressed_backup_file}"
-                )
-                # Send email notification
-                send_email_notification(
-                    app.config,
-                    "Backup Successful",
-                    f"Backup upload successful: {compressed_backup_file}",
-                )
-                return compressed_backup_file  # return the backup file name
-            else:
-                logging.error("[manual_backup] Backup upload failed")
-                # Send email notification
-                send_email_notification(
-                    app.config, "Backup Failed", "Backup upload failed"
+                if not results:
+                    results[targets[0].name] = upload_success
+                # Each destination has its own catalog. Incremental and sharded
+                # backups record their parts and manifest themselves.
+                if not (
+                    current_app.config["INCREMENTAL_BACKUPS"]
+                    or compressed_backup_file.endswith(SHARDS_SUFFIX)
+                ):
+                    for target in targets:
+                        if not results.get(target.name):
+                            continue
+                        size, checksum = digest.of(target.name)
+                        entry = new_entry(
+                            compressed_backup_file,
+                            details["database_name"],
+                            details["database_type"],
+                            size or None,
+                            checksum if size else None,
+                            label=label or "",
+                        )
+                        # A resumed upload keeps the name of the run it started
+                        # in, but holds the dump of this run
+                        entry["timestamp"] = timestamp
+                        if marker:
+                            entry["marker"] = marker
+                        record_backups(details["database_name"], [entry], target)
+                elif marker and upload_success:
+                    for target in targets:
+                        try:
+                            update_catalog(
+                                target,
+                                details["database_name"],
+                                amend={compressed_backup_file: {"marker": marker}},
+                            )
+                        except Exception as e:
+                            logging.error(
+                                f"[manual_backup] Error recording the change marker in the catalog: {str(e)}"
+                            )
+                destination_report = (
+                    "".join(
+                        f"{name}: {'uploaded' if success else 'failed'}\n"
+                        for name, success in results.items()
+                    )
+                    + "\n"
+                    if len(results) > 1
+                    else ""
                 )
-                sys.exit(1)
+
+                if upload_success:
+                    logging.info(
+                        f"[manual_backup] Backup upload successful: {compressed_backup_file}"
+                    )
+                    # Send email notification
+                    send_email_notification(
+                        app.config,
+                        "Backup Successful",
+                        f"Backup upload successful: {compressed_backup_file}\n\n{destination_report}{run.format()}",
+                    )
+                    return compressed_backup_file  # return the backup file name
+                else:
+                    logging.error(
+                        f"[manual_backup] Backup upload failed: {', '.join(name for name, success in results.items() if not success)}"
+                    )
+                    # Send email notification
+                    send_email_notification(
+                        app.config,
+                        "Backup Failed",
+                        f"Backup upload failed\n\n{destination_report}{run.format()}",
+                    )
+                    sys.exit(1)
         else:
             logging.error("[manual_backup] Invalid database connection URL")
             # Send email notification
@@ -147,6 +1782,149 @@ def manual_backup(db_var, label=None):
             sys.exit(1)
 
 
+@destination_session
+def batch_backup(db_vars=None, label=None):
+    """
+    Backs up many databases concurrently, so a whole fleet takes roughly as long
+    as its slowest dump rather than the sum of all of them.
+    At most BATCH_MAX_CONCURRENCY backups run at once, and at most
+    BATCH_MAX_PER_HOST of them against the same database host.
+    Parameters:
+    db_vars (list): The config vars holding the database URLs. When empty, every
+    config var holding a supported database URL is backed up.
+    label (str): An optional label applied to every backup.
+    Returns:
+    list: One dict per database with its config var, host, status, backup file,
+    error and duration in seconds.
+    """
+    db_vars = list(db_vars) if db_vars else discover_database_vars()
+    max_concurrency = app.config["BATCH_MAX_CONCURRENCY"]
+    host_slots = defaultdict(
+        lambda: threading.BoundedSemaphore(app.config["BATCH_MAX_PER_HOST"])
+    )
+
+    # Interleave hosts so a worker is rarely stuck waiting on a busy host
+    # while backups for other hosts are still queued behind it
+    by_host = defaultdict(list)
+    for db_var in db_vars:
+        db_url = os.getenv(db_var) or ""
+        by_host[parse_connection_url(db_url).get("hostname")].append(db_var)
+    queue = []
+    while any(by_host.values()):
+        for host in list(by_host):
+            if by_host[host]:
+                queue.append((host, by_host[host].pop(0)))
+    # Create the semaphores up front, defaultdict is not safe to fill from threads
+    for host, _ in queue:
+        host_slots[host]
+
+    def run_one(host, db_var):
+        result = {
+            "config_var": db_var,
+            "host": host,
+            "status": "failed",
+            "backup_file": None,
+            "error": None,
+            "duration": 0.0,
+        }
+        with host_slots[host]:
+            start = time.monotonic()
+            try:
+                result["backup_file"] = manual_backup(db_var, label)
+                result["status"] = "success"
+            except SystemExit:
+                # manual_backup has already logged the reason
+                result["error"] = "Backup failed, see the logs for details"
+            except Exception as e:
+                result["error"] = str(e)
+            result["duration"] = round(time.monotonic() - start, 3)
+        logging.info(
+            f"[batch_backup] {db_var}: {result['status']} in {result['duration']}s"
+        )
+        return result
+
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        for result in executor.map(lambda item: run_one(*item), queue):
+            results.append(result)
+            report_progress("backup", completed=len(results), total=len(queue))
+
+    failed = [
+        result["config_var"] for result in results if result["status"] != "success"
+    ]
+    summary = "\n".join(
+        f"{result['config_var']}: {result['status']} ({result['duration']}s) {result['backup_file'] or result['error']}"
+        for result in results
+    )
+    send_email_notification(
+        app.config,
+        "Batch Backup Completed with Errors" if failed else "Batch Backup Successful",
+        f"Batch backup completed.\n{summary}",
+    )
+    return results
+
+
+def delete_backups(destination, database, files_to_delete):
+    """
+    Deletes backups in bulk with their checksum sidecars, removes them from the
+    catalog and, with the dedup store, collects the chunks that no manifest
+    references anymore.
+    Parameters:
+    destination (module): The destination module.
+    database (str): The name of the database.
+    files_to_delete (list): The files to delete.
+    Returns:
+    tuple: The list of deleted files, and the list of files that could not be deleted.
+    """
+    deleted_files, failures = destination.delete_files_from_destination(
+        files_to_delete + [sidecar_name(file) for file in files_to_delete]
+    )
+    # Not every backup has a sidecar
+    deleted_files = [
+        file for file in deleted_files if not file.endswith(SIDECAR_SUFFIX)
+    ]
+    failures = {
+        file: error
+        for file, error in failures.items()
+        if not file.endswith(SIDECAR_SUFFIX)
+    }
+    logging.info(f"[delete_backups] Deleted {len(deleted_files)} files")
+    if deleted_files:
+        try:
+            update_catalog(destination, database, remove=deleted_files)
+        except Exception as e:
+            logging.error(
+                f"[delete_backups] Error removing deleted files from the catalog: {str(e)}"
+            )
+    for file, error in failures.items():
+        logging.error(f"[delete_backups] Error deleting file: {file}, Error: {error}")
+    failed_deletes = list(failures)
+
+    # Archived logs older than the oldest remaining base backup are not needed
+    if deleted_files:
+        try:
+            prune_archive(destination, database)
+        except Exception as e:
+            logging.error(f"[delete_backups] Error pruning the log archive: {str(e)}")
+
+    # Deleted manifests may have left chunks that nothing references
+    if current_app.config["DEDUP_STORE"] and deleted_files:
+        try:
+            deleted_chunks, chunk_failures = collect_garbage(
+                destination, current_app.config["DEDUP_GC_GRACE_PERIOD"]
+            )
+            logging.info(
+                f"[delete_backups] Deleted {len(deleted_chunks)} unreferenced chunks"
+            )
+            failed_deletes += list(chunk_failures)
+        except Exception as e:
+            logging.error(
+                f"[delete_backups] Error collecting unreferenced chunks: {str(e)}"
+            )
+    return deleted_files, failed_deletes
+
+
+@destination_session
 def trim_backup_history(db_var, days):
     with app.app_context():
         db_url = os.getenv(db_var)
@@ -163,39 +1941,51 @@ def trim_backup_history(db_var, days):
             days = int(days)
             cutoff_date = datetime.now() - timedelta(days=days)
 
-            file_list = []
-            if current_app.config["UPLOAD_DESTINATION"] == "S3":
-                file_list = s3.fetch_destination_filelist()
-            elif current_app.config["UPLOAD_DESTINATION"] == "FTP":
-                file_list = ftp.fetch_destination_filelist()
-
-            files_to_delete = [
-                file
-                for file in file_list
-                if file.startswith(details["database_name"])
-                and datetime.strptime(file.split("_")[-1], "%Y%m%d%H%M%S") < cutoff_date
-            ]
+            try:
+                targets = upload_targets(current_app.config)
+            except ValueError as e:
+                logging.error(f"[trim_history] {str(e)}")
+                sys.exit(1)
 
-            deleted_files = []
-            failed_deletes = []
-            for file in files_to_delete:
-                creation_date = datetime.strptime(file.split("_")[-1], "%Y%m%d%H%M%S")
-                days_old = (datetime.now() - creation_date).days
-                logging.debug(
-                    f"# Filename: {file}\nCreated at: {creation_date}\nDays old: {days_old}\n=="
-                )
-                try:
-                    if current_app.config["UPLOAD_DESTINATION"] == "S3":
-                        s3.delete_file_from_destination(file)
-                    elif current_app.config["UPLOAD_DESTINATION"] == "FTP":
-                        ftp.delete_file_from_destination(file)
-                    logging.info(f"[trim_history] File deleted successfully: {file}")
-                    deleted_files.append(file)
-                except Exception as e:
-                    logging.error(
-                        f"[trim_history] Error deleting file: {file}, Error: {str(e)}"
+            # Every destination a backup was fanned out to is trimmed the same way.
+            # The files of other destinations are reported as `<TARGET>:<file>`.
+            deleted_files, failed_deletes = [], []
+            for target in targets:
+                report_progress("list", destination=target.name)
+                entries = find_backups(target, details["database_name"])
+                # A backup is as recent as the last run skipped after it, and
+                # the parts of a sharded backup are as recent as their manifest
+                last_seen = {}
+                for entry in entries:
+                    unit = entry["file"].split(".", 1)[0]
+                    last_seen[unit] = max(
+                        last_seen.get(unit, ""),
+                        entry.get("unchanged_until") or entry["timestamp"],
                     )
-                    failed_deletes.append(file)
+                cutoff = cutoff_date.strftime("%Y%m%d%H%M%S")
+                # Labelled backups are kept until they are deleted by hand
+                files_to_delete = [
+                    entry["file"]
+                    for entry in entries
+                    if entry["label"] is None
+                    and last_seen[entry["file"].split(".", 1)[0]] < cutoff
+                ]
+
+                # Keep the old bases that recent increments still depend on
+                protected = protected_chain_files(target, files_to_delete, cutoff_date)
+                files_to_delete = [
+                    file for file in files_to_delete if file not in protected
+                ]
+
+                report_progress(
+                    "delete", destination=target.name, files=len(files_to_delete)
+                )
+                deleted, failed = delete_backups(
+                    target, details["database_name"], files_to_delete
+                )
+                prefix = "" if target is targets[0] else f"{target.name}:"
+                deleted_files += [prefix + file for file in deleted]
+                failed_deletes += [prefix + file for file in failed]
 
             # Send email notification
             if failed_deletes:
@@ -214,6 +2004,243 @@ def trim_backup_history(db_var, days):
             return deleted_files, failed_deletes
 
 
+def _unit_files(destination, decision):
+    """
+    Returns the files of a backup retention decided on: a chain manifest comes
+    with its base and increments, a sharded backup manifest with its parts.
+    """
+    if decision["format"] not in ("chain", "sharded"):
+        return [decision["file"]]
+    content = destination.read_from_destination(decision["file"])
+    if content is None:
+        logging.error(f"[apply_retention] Could not read manifest {decision['file']}")
+        return [decision["file"]]
+    if decision["format"] == "sharded":
+        return shard_files(decision["file"], json.loads(content))
+    return chain_files(decision["file"], json.loads(content))
+
+
+def _retain(target, database, db_var, override, storage_classes, dry_run):
+    """
+    Applies retention to the backups of a database at one destination target.
+    Returns:
+    dict: The plan, and unless it is a dry run the deleted files, the files
+    that could not be deleted and the moved files.
+    """
+    report_progress("list", destination=target.name)
+    entries = find_backups(target, database)
+    series = {}
+    for entry in retention_units(entries):
+        series.setdefault(entry["label"], []).append(entry)
+
+    plan = []
+    for label, units in series.items():
+        # The policies were validated by apply_retention
+        series_policy = override or resolve_policy(current_app.config, db_var, label)
+        if series_policy is None:
+            logging.info(
+                f"[apply_retention] No policy for the {label or 'unlabelled'} backups of {database}, keeping them"
+            )
+            continue
+        plan += plan_retention(units, series_policy, storage_classes)
+    if dry_run:
+        return {"plan": plan}
+
+    files_to_delete = [
+        file
+        for decision in plan
+        if not decision["keep"]
+        for file in _unit_files(target, decision)
+    ]
+    report_progress("delete", destination=target.name, files=len(files_to_delete))
+    deleted_files, failed_deletes = (
+        delete_backups(target, database, files_to_delete)
+        if files_to_delete
+        else ([], [])
+    )
+
+    # Dedup chunks are shared between backups, so they stay where they are
+    report_progress("transition", destination=target.name)
+    by_file = {entry["file"]: entry for entry in entries}
+    moved = {}
+    for decision in plan:
+        if not decision["keep"] or not decision["storage_class"]:
+            continue
+        if decision["format"] == "dedup":
+            continue
+        for file in _unit_files(target, decision):
+            # Manifests are read on every restore, so they stay in STANDARD
+            if file.endswith((CHAIN_SUFFIX, SHARDS_SUFFIX)):
+                continue
+            current = by_file.get(file, {}).get("storage_class") or "STANDARD"
+            if current == decision["storage_class"]:
+                continue
+            if target.set_storage_class(file, decision["storage_class"]):
+                moved[file] = decision["storage_class"]
+    if moved:
+        try:
+            update_catalog(
+                target,
+                database,
+                add=[
+                    dict(by_file[file], storage_class=storage_class)
+                    for file, storage_class in moved.items()
+                    if file in by_file
+                ],
+            )
+        except Exception as e:
+            logging.error(
+                f"[apply_retention] Error recording storage classes in the catalog: {str(e)}"
+            )
+    logging.info(
+        f"[apply_retention] {target.name}: kept {sum(decision['keep'] for decision in plan)} backups, deleted {len(deleted_files)} files, moved {len(moved)} files"
+    )
+    return {
+        "plan": plan,
+        "deleted": deleted_files,
+        "failed": failed_deletes,
+        "moved": moved,
+    }
+
+
+@destination_session
+def apply_retention(db_var, policy=None, dry_run=False):
+    """
+    Applies a grandfather-father-son retention policy to the backups of a
+    database. Each label is a series of its own, with its own policy, so
+    hourly unlabelled backups never push out the monthly labelled ones.
+    Deletions run in bulk, and on S3 the backups only kept by coarser tiers can
+    be moved to cheaper storage classes instead (RETENTION_STORAGE_CLASSES).
+    Every destination of FANOUT_DESTINATIONS is planned from its own catalog.
+    Parameters:
+    db_var (str): The config var holding the database URL.
+    policy (str): A policy used for every series instead of the configured
+    ones, such as `hourly=24,daily=7,weekly=4,monthly=12`.
+    dry_run (bool): Only plan, without deleting or moving anything.
+    Returns:
+    dict: The plan of UPLOAD_DESTINATION, with one decision per backup, and
+    unless it is a dry run the deleted files, the files that could not be
+    deleted and the moved files. The files of fan-out destinations are
+    reported as `<TARGET>:<file>`, and their plans are under `destinations`.
+    """
+    with app.app_context():
+        db_url = os.getenv(db_var)
+
+        if db_url is None:
+            logging.error(f"[apply_retention] Invalid environment variable: {db_var}")
+            sys.exit(1)
+        details = parse_connection_url(db_url)
+        database = details["database_name"]
+        try:
+            targets = upload_targets(current_app.config)
+            override = parse_policy(policy) if policy else None
+            if override is None:
+                validate_policies(current_app.config)
+            storage_classes = parse_storage_classes(
+                current_app.config["RETENTION_STORAGE_CLASSES"]
+            )
+        except ValueError as e:
+            logging.error(f"[apply_retention] {str(e)}")
+            sys.exit(1)
+
+        results = {}
+        for target in targets:
+            target_classes = storage_classes
+            if storage_classes and target.kind != "S3":
+                logging.warning(
+                    f"[apply_retention] Storage classes are only supported on S3, ignoring them for {target.name}"
+                )
+                target_classes = {}
+            results[target.name] = _retain(
+                target, database, db_var, override, target_classes, dry_run
+            )
+
+        result = {
+            "database": database,
+            "dry_run": dry_run,
+            "plan": results[targets[0].name]["plan"],
+        }
+        if len(targets) > 1:
+            result["destinations"] = {
+                name: target_result["plan"]
+                for name, target_result in list(results.items())[1:]
+            }
+        if dry_run:
+            return result
+
+        deleted_files, failed_deletes, moved = [], [], {}
+        for target in targets:
+            prefix = "" if target is targets[0] else f"{target.name}:"
+            target_result = results[target.name]
+            deleted_files += [prefix + file for file in target_result["deleted"]]
+            failed_deletes += [prefix + file for file in target_result["failed"]]
+            moved.update(
+                {
+                    prefix + file: storage_class
+                    for file, storage_class in target_result["moved"].items()
+                }
+            )
+
+        if failed_deletes:
+            send_email_notification(
+                app.config,
+                "Retention Completed with Errors",
+                f"Retention completed. Deleted files: {deleted_files}, Moved files: {moved}, Failed deletes: {failed_deletes}",
+            )
+        else:
+            send_email_notification(
+                app.config,
+                "Retention Completed Successfully",
+                f"Retention completed. Deleted files: {deleted_files}, Moved files: {moved}",
+            )
+
+        return dict(result, deleted=deleted_files, failed=failed_deletes, moved=moved)
+
+
+# The functions the task endpoints queue, by job kind
+JOB_FUNCTIONS = {
+    "manual_backup": manual_backup,
+    "batch_backup": batch_backup,
+    "trim_history": trim_backup_history,
+    "restore": restore_backup,
+    "apply_retention": apply_retention,
+    "verify": verify_backup_integrity,
+}
+
+
+def job_queue():
+    # With resumable uploads, a backup interrupted by a restart is run again and
+    # continues its upload
+    return get_job_queue(
+        app.config,
+        JOB_FUNCTIONS,
+        ("manual_backup",) if app.config["RESUMABLE_UPLOADS"] else (),
+    )
+
+
+def queue_job(kind, dedup_key, **params):
+    """
+    Queues a job for a task endpoint and answers with its ID straight away, so
+    the request never runs into the router timeout. A request for a database
+    that already has the same kind of job queued or running gets that job back.
+    """
+    job_id, created = job_queue().submit(kind, dedup_key, **params)
+    logging.info(
+        f"[queue_job] {'Queued' if created else 'Already queued'} {kind} job {job_id}"
+    )
+    return (
+        jsonify(
+            {
+                "job_id": job_id,
+                "duplicate": not created,
+                "status_url": url_for("job_status_route", job_id=job_id),
+                "progress_url": url_for("job_progress_route", job_id=job_id),
+            }
+        ),
+        202,
+    )
+
+
 @app.route("/tasks/manual_backup", methods=["GET"])
 def manual_backup_route():
     secret_key = request.args.get("secretKey")
@@ -223,8 +2250,40 @@ def manual_backup_route():
         return "Invalid secret key", 401
     config_var = request.args.get("configVar")
     label = request.args.get("label")
-    backup_file = manual_backup(config_var, label)
-    return f"Manual backup completed. Label: {label}, Database: {config_var}, Backup file: {backup_file}"
+    profile = request.args.get("profile")
+    if not config_var:
+        return "No config var provided", 400
+    if label and not re.match("^[a-zA-Z0-9_-]*$", label):
+        return "Invalid label", 400
+    if profile and profile not in metrics.PROFILE_MODES:
+        return "Invalid profile", 400
+    return queue_job(
+        "manual_backup",
+        f"manual_backup:{config_var}:{label or ''}",
+        db_var=config_var,
+        label=label,
+        profile=profile,
+    )
+
+
+@app.route("/tasks/batch_backup", methods=["GET"])
+def batch_backup_route():
+    secret_key = request.args.get("secretKey")
+    if not secret_key:
+        return "No secret key provided", 403
+    if secret_key != os.getenv("SECRET_KEY"):
+        return "Invalid secret key", 401
+    config_vars = request.args.get("configVars")
+    label = request.args.get("label")
+    if label and not re.match("^[a-zA-Z0-9_-]*$", label):
+        return "Invalid label", 400
+    db_vars = sorted(config_vars.split(",")) if config_vars else None
+    return queue_job(
+        "batch_backup",
+        f"batch_backup:{','.join(db_vars or ['all'])}:{label or ''}",
+        db_vars=db_vars,
+        label=label,
+    )
 
 
 @app.route("/tasks/trim_history", methods=["GET"])
@@ -236,5 +2295,157 @@ def trim_history_route():
         return "Invalid secret key", 401
     config_var = request.args.get("configVar")
     days = request.args.get("days")
-    deleted_files, failed_deletes = trim_backup_history(config_var, days)
-    return f"Trim history completed. Deleted files: {deleted_files}, Failed deletes: {failed_deletes}"
+    if not config_var:
+        return "No config var provided", 400
+    if not days or not days.isdigit():
+        return "Invalid number of days", 400
+    return queue_job(
+        "trim_history",
+        f"trim_history:{config_var}",
+        db_var=config_var,
+        days=int(days),
+    )
+
+
+@app.route("/tasks/apply_retention", methods=["GET"])
+def apply_retention_route():
+    secret_key = request.args.get("secretKey")
+    if not secret_key:
+        return "No secret key provided", 403
+    if secret_key != os.getenv("SECRET_KEY"):
+        return "Invalid secret key", 401
+    config_var = request.args.get("configVar")
+    if not config_var:
+        return "No config var provided", 400
+    if os.getenv(config_var) is None:
+        return "Invalid config var", 400
+    policy = request.args.get("policy")
+    try:
+        if policy:
+            parse_policy(policy)
+        else:
+            validate_policies(app.config)
+    except ValueError as e:
+        return str(e), 400
+    # A plan only reads the catalog, so it is answered directly
+    if request.args.get("dryRun", "false").lower() in ("1", "true", "yes"):
+        return jsonify(apply_retention(config_var, policy, dry_run=True))
+    # Shares its key with trim_history, so the two never delete at the same time
+    return queue_job(
+        "apply_retention",
+        f"trim_history:{config_var}",
+        db_var=config_var,
+        policy=policy,
+    )
+
+
+@app.route("/tasks/restore", methods=["GET"])
+def restore_route():
+    secret_key = request.args.get("secretKey")
+    if not secret_key:
+        return "No secret key provided", 403
+    if secret_key != os.getenv("SECRET_KEY"):
+        return "Invalid secret key", 401
+    config_var = request.args.get("configVar")
+    if not config_var:
+        return "No config var provided", 400
+    return queue_job(
+        "restore",
+        f"restore:{config_var}",
+        db_var=config_var,
+        backup_file=request.args.get("backupFile"),
+    )
+
+
+@app.route("/tasks/verify", methods=["GET"])
+def verify_route():
+    secret_key = request.args.get("secretKey")
+    if not secret_key:
+        return "No secret key provided", 403
+    if secret_key != os.getenv("SECRET_KEY"):
+        return "Invalid secret key", 401
+    config_var = request.args.get("configVar")
+    if not config_var:
+        return "No config var provided", 400
+    if os.getenv(config_var) is None:
+        return "Invalid config var", 400
+    restore = request.args.get("restore", "false").lower() in ("1", "true", "yes")
+    if restore and not app.config["VERIFY_RESTORE_URL"]:
+        return "VERIFY_RESTORE_URL is not set", 400
+    return queue_job(
+        "verify",
+        f"verify:{config_var}",
+        db_var=config_var,
+        backup_file=request.args.get("backupFile"),
+        restore=restore,
+        sample=request.args.get("sample", "false").lower() in ("1", "true", "yes"),
+    )
+
+
+@app.route("/tasks/list_backups", methods=["GET"])
+def list_backups_route():
+    secret_key = request.args.get("secretKey")
+    if not secret_key:
+        return "No secret key provided", 403
+    if secret_key != os.getenv("SECRET_KEY"):
+        return "Invalid secret key", 401
+    config_var = request.args.get("configVar")
+    if not config_var:
+        return "No config var provided", 400
+    if os.getenv(config_var) is None:
+        return "Invalid config var", 400
+    # A catalog lookup is a single read, so it is answered directly
+    return jsonify(list_backups(config_var, request.args.get("label")))
+
+
+@app.route("/tasks/jobs", methods=["GET"])
+def jobs_route():
+    secret_key = request.args.get("secretKey")
+    if not secret_key:
+        return "No secret key provided", 403
+    if secret_key != os.getenv("SECRET_KEY"):
+        return "Invalid secret key", 401
+    store = job_queue().store
+    return jsonify(store.list(request.args.get("status")))
+
+
+@app.route("/tasks/jobs/<job_id>", methods=["GET"])
+def job_status_route(job_id):
+    secret_key = request.args.get("secretKey")
+    if not secret_key:
+        return "No secret key provided", 403
+    if secret_key != os.getenv("SECRET_KEY"):
+        return "Invalid secret key", 401
+    job = job_queue().store.get(job_id)
+    if job is None:
+        return "Unknown job", 404
+    return jsonify(job)
+
+
+@app.route("/tasks/jobs/<job_id>/progress", methods=["GET"])
+def job_progress_route(job_id):
+    secret_key = request.args.get("secretKey")
+    if not secret_key:
+        return "No secret key provided", 403
+    if secret_key != os.getenv("SECRET_KEY"):
+        return "Invalid secret key", 401
+    job = job_queue().store.get(job_id)
+    if job is None:
+        return "Unknown job", 404
+    return jsonify(
+        {"job_id": job_id, "status": job["status"], "progress": job["progress"]}
+    )
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_route():
+    secret_key = request.args.get("secretKey")
+    if not secret_key:
+        return "No secret key provided", 403
+    if secret_key != os.getenv("SECRET_KEY"):
+        return "Invalid secret key", 401
+    return (
+        metrics.REGISTRY.render(),
+        200,
+        {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
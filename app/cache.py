@@ -0,0 +1,399 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from flask import current_app
+from . import metrics
+
+# Temporary files older than this were left by a process that died while
+# filling the cache
+STALE_TEMP_SECONDS = 3600
+
+
+def destination_key(destination):
+    """
+    Returns:
+    str: The name of a destination target, or of the kind of a destination
+    module, so the primary target and its module share their cached files.
+    """
+    name = getattr(destination, "name", None)
+    return name or destination.__name__.rsplit(".", 1)[-1].upper()
+
+
+def fingerprint(stat):
+    """
+    Returns:
+    dict: What tells whether a stored file was replaced: its size, and on S3
+    its ETag.
+    """
+    return {"size": stat["size"], "etag": stat.get("etag")}
+
+
+class CacheWriter:
+    """
+    Copies a stream into a new cache entry as it goes by. Failures to write,
+    such as a full disk, only abandon the entry, the stream is never affected.
+    Parameters:
+    cache (LocalCache): The cache the entry is added to.
+    key (str): The key of the entry.
+    meta (dict): The destination and name of the cached file.
+    limit (int): The size over which the entry is abandoned.
+    """
+
+    def __init__(self, cache, key, meta, limit):
+        self.cache = cache
+        self.key = key
+        self.meta = meta
+        self.limit = limit
+        self.size = 0
+        self._digest = hashlib.sha256()
+        self._fd, self._path = tempfile.mkstemp(dir=cache.directory, suffix=".tmp")
+
+    def write(self, data):
+        if self._fd is None:
+            return
+        self.size += len(data)
+        if self.size > self.limit:
+            logging.debug(f"[cache] {self.meta['file']} is too large to be cached")
+            self.discard()
+            return
+        try:
+            os.write(self._fd, data)
+            self._digest.update(data)
+        except OSError as e:
+            logging.warning(f"[cache] Could not cache {self.meta['file']}: {str(e)}")
+            self.discard()
+
+    def wrap(self, chunks):
+        """
+        Passes a stream of chunks through, copying them into the entry.
+        """
+        for chunk in chunks:
+            self.write(chunk)
+            yield chunk
+
+    def commit(self, stat):
+        """
+        Adds the entry to the cache, once the whole file was written.
+        Parameters:
+        stat (dict): What the destination knows of the stored file, see
+        `stat_destination_file`. The entry is dropped if it has another size.
+        """
+        if self._fd is None:
+            return
+        if stat is None or stat["size"] != self.size:
+            self.discard()
+            return
+        try:
+            os.close(self._fd)
+            self._fd = None
+            self.cache.add(
+                self.key,
+                self._path,
+                dict(
+                    self.meta,
+                    size=self.size,
+                    sha256=self._digest.hexdigest(),
+                    stored=fingerprint(stat),
+                ),
+            )
+        except OSError as e:
+            logging.warning(f"[cache] Could not cache {self.meta['file']}: {str(e)}")
+            self.discard()
+
+    def commit_stored(self, destination, file_name):
+        """
+        Adds the entry to the cache with what the destination stored, see
+        `commit`.
+        """
+        try:
+            stat = destination.stat_destination_file(file_name)
+        except Exception as e:
+            logging.warning(f"[cache] Could not cache {file_name}: {str(e)}")
+            self.discard()
+            return
+        self.commit(stat)
+
+    def discard(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        try:
+            os.remove(self._path)
+        except OSError:
+            pass
+
+
+class LocalCache:
+    """
+    Keeps recently uploaded and downloaded files on local disk, so they can be
+    read again at disk speed. Each entry is a data file and a metadata file
+    with its size and SHA-256, and what the destination knew of the stored
+    file when it was cached. The least recently used entries are evicted to
+    stay under `max_size`, and to leave `min_free` bytes free on the disk.
+    Parameters:
+    directory (str): The directory holding the cache.
+    max_size (int): The maximum total size of the cached files.
+    min_free (int): The free disk space the cache never uses.
+    """
+
+    def __init__(self, directory, max_size, min_free):
+        self.directory = directory
+        self.max_size = max_size
+        self.min_free = min_free
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _key(self, destination, file_name):
+        return hashlib.sha256(
+            f"{destination_key(destination)}/{file_name}".encode()
+        ).hexdigest()
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + ".data", base + ".json"
+
+    def _entries(self):
+        """
+        Returns:
+        list: The key, size and last use of every entry, least recently used first.
+        """
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if name.endswith(".tmp") and now - stat.st_mtime > STALE_TEMP_SECONDS:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            elif name.endswith(".data"):
+                entries.append((name[: -len(".data")], stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def _remove(self, key):
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def trim(self, room=0):
+        """
+        Evicts the least recently used entries until `room` more bytes fit
+        under the size cap and the free space reserve.
+        Returns:
+        bool: True if there is room.
+        """
+        with self._lock:
+            entries = self._entries()
+            used = sum(size for _, size, _ in entries)
+            free = shutil.disk_usage(self.directory).free
+            while entries and (
+                used + room > self.max_size or free - room < self.min_free
+            ):
+                key, size, _ = entries.pop(0)
+                self._remove(key)
+                used -= size
+                free += size
+            return used + room <= self.max_size and free - room >= self.min_free
+
+    def writer(self, destination, file_name, size=None):
+        """
+        Starts a new entry for a file, evicting older entries to make room.
+        Parameters:
+        destination (module): The destination the file is stored at.
+        file_name (str): The name of the file.
+        size (int): The size of the file, when known.
+        Returns:
+        CacheWriter: The writer of the entry, or None if the file does not fit.
+        """
+        if size is not None and size > self.max_size:
+            return None
+        try:
+            if not self.trim(size or 0):
+                return None
+            # A file of unknown size may use what is left under both limits
+            used = sum(entry[1] for entry in self._entries())
+            limit = min(
+                self.max_size - used,
+                shutil.disk_usage(self.directory).free - self.min_free,
+            )
+            return CacheWriter(
+                self,
+                self._key(destination, file_name),
+                {"destination": destination_key(destination), "file": file_name},
+                limit,
+            )
+        except OSError as e:
+            logging.warning(f"[cache] The cache cannot be used: {str(e)}")
+            return None
+
+    def add(self, key, path, meta):
+        data_path, meta_path = self._paths(key)
+        with self._lock:
+            with open(meta_path + ".tmp", "w") as meta_file:
+                json.dump(meta, meta_file)
+            # The data is in place before the metadata that makes it an entry
+            os.replace(path, data_path)
+            os.replace(meta_path + ".tmp", meta_path)
+
+    def evict(self, destination, file_name):
+        with self._lock:
+            self._remove(self._key(destination, file_name))
+
+    def open(self, destination, file_name, immutable=False):
+        """
+        Opens the cached copy of a file, after checking that the destination
+        still stores the same file and that the copy has the SHA-256 it had
+        when it was cached. A copy that fails a check is evicted.
+        Parameters:
+        destination (module): The destination the file is stored at.
+        file_name (str): The name of the file.
+        immutable (bool): Whether the file is never replaced, such as a dedup
+        chunk named after its content, so the destination is not asked.
+        Returns:
+        file: The copy, opened for reading, or None if it is not cached.
+        """
+        key = self._key(destination, file_name)
+        data_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            # Evicted files stay readable through an open handle
+            data = open(data_path, "rb")
+        except (OSError, ValueError):
+            return None
+        try:
+            if meta["file"] != file_name:
+                raise ValueError("another file has the same key")
+            if not immutable:
+                stat = destination.stat_destination_file(file_name)
+                if stat is None or fingerprint(stat) != meta["stored"]:
+                    raise ValueError("the stored file changed")
+            digest = hashlib.sha256()
+            for block in iter(lambda: data.read(1024 * 1024), b""):
+                digest.update(block)
+            if digest.hexdigest() != meta["sha256"]:
+                raise ValueError("the copy is damaged")
+            data.seek(0)
+            os.utime(data_path)
+            return data
+        except Exception as e:
+            logging.info(f"[cache] Not using the cached {file_name}: {str(e)}")
+            data.close()
+            self.evict(destination, file_name)
+            return None
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(config):
+    """
+    Returns:
+    LocalCache: The process-wide cache in CACHE_DIR, or None when it is not set
+    or cannot be created.
+    """
+    directory = config["CACHE_DIR"]
+    if not directory:
+        return None
+    with _caches_lock:
+        if directory not in _caches:
+            try:
+                _caches[directory] = LocalCache(
+                    directory, config["CACHE_MAX_SIZE"], config["CACHE_MIN_FREE"]
+                )
+            except OSError as e:
+                logging.warning(f"[cache] The cache cannot be used: {str(e)}")
+                return None
+        return _caches[directory]
+
+
+def cached_download_stream(destination, file_name, chunk_size=1024 * 1024, offset=0):
+    """
+    Streams a file like `download_stream_from_destination`, from its cached
+    copy when there is a valid one. A file downloaded from its start is cached
+    as it is read, if it fits.
+    Parameters:
+    destination (module): The destination module.
+    file_name (str): The name of the file at the destination.
+    chunk_size (int): The size of the chunks to yield.
+    offset (int): The position in the file to start from.
+    Yields:
+    bytes: The content of the file, chunk by chunk.
+    """
+    cache = get_cache(current_app.config)
+    if cache is None:
+        yield from destination.download_stream_from_destination(
+            file_name, chunk_size, offset
+        )
+        return
+
+    cached = cache.open(destination, file_name)
+    if cached is not None:
+        metrics.count("cache_hits")
+        with cached:
+            cached.seek(offset)
+            for chunk in iter(lambda: cached.read(chunk_size), b""):
+                metrics.count("bytes_from_cache", len(chunk))
+                yield chunk
+        return
+
+    writer = None
+    if offset == 0:
+        try:
+            stat = destination.stat_destination_file(file_name)
+        except Exception:
+            stat = None
+        if stat is not None:
+            writer = cache.writer(destination, file_name, stat["size"])
+    chunks = destination.download_stream_from_destination(file_name, chunk_size, offset)
+    if writer is None:
+        yield from chunks
+        return
+    try:
+        yield from writer.wrap(chunks)
+        writer.commit(stat)
+    finally:
+        # The reader stopped early or the download failed
+        writer.discard()
+
+
+def cached_read(destination, file_name, immutable=False):
+    """
+    Reads a small file like `read_from_destination`, such as a manifest or a
+    dedup chunk, from its cached copy when there is a valid one, and caches it
+    otherwise.
+    Returns:
+    bytes: The content of the file, or None if it does not exist.
+    """
+    cache = get_cache(current_app.config)
+    if cache is None:
+        return destination.read_from_destination(file_name)
+    cached = cache.open(destination, file_name, immutable)
+    if cached is not None:
+        metrics.count("cache_hits")
+        with cached:
+            return cached.read()
+
+    content = destination.read_from_destination(file_name)
+    if content is None:
+        return None
+    writer = cache.writer(destination, file_name, len(content))
+    if writer is not None:
+        writer.write(content)
+        if immutable:
+            writer.commit({"size": len(content)})
+        else:
+            writer.commit_stored(destination, file_name)
+    return content
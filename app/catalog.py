@@ -0,0 +1,273 @@
+import hashlib
+import json
+import logging
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from .compression import get_codec
+from .encryption import plain_name
+from .dedup import MANIFEST_SUFFIX
+from .destinations.ftp import PARTIAL_SUFFIX
+from .incremental import CHAIN_SUFFIX
+from .integrity import SIDECAR_SUFFIX
+from .sharding import SHARDS_SUFFIX
+
+CATALOG_PREFIX = "catalog_"
+
+# Conditional writes that lost a race are retried this many times
+MAX_UPDATE_ATTEMPTS = 8
+
+_BACKUP_NAME = re.compile(r"^(.+)_(\d{14})((?:\.[A-Za-z0-9.]+)?)$")
+
+# Serialises the updates of a catalog within this process
+_locks = defaultdict(threading.Lock)
+_locks_lock = threading.Lock()
+
+
+class StreamDigest:
+    """
+    Computes the size and SHA-256 of a backup as it is uploaded, so the catalog
+    can record them without reading the backup back. A retry may only upload
+    to some of the targets, so the values of each attempt are kept for the
+    targets it uploaded to.
+    """
+
+    def __init__(self):
+        self.targets = {}
+        self.reset()
+
+    def reset(self):
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def update(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+
+    def wrap(self, chunks):
+        """
+        Passes a stream of chunks through, hashing them. Each call starts over,
+        so a retried upload is hashed from scratch.
+        """
+        self.reset()
+        for chunk in chunks:
+            self.update(chunk)
+            yield chunk
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def record(self, names):
+        """
+        Keeps the size and SHA-256 of the current attempt for the targets it
+        was uploaded to.
+        """
+        for name in names:
+            self.targets[name] = (self.size, self.hexdigest())
+
+    def of(self, name):
+        """
+        Returns:
+        tuple: The size and SHA-256 of what was uploaded to a target, the
+        current values if none were recorded for it.
+        """
+        return self.targets.get(name, (self.size, self.hexdigest()))
+
+
+def catalog_name(database):
+    return f"{CATALOG_PREFIX}{database}.json"
+
+
+def backup_format(file_name):
+    """
+    Infers the format of a backup from its name.
+    """
+    if file_name.endswith(CHAIN_SUFFIX):
+        return "chain"
+    if file_name.endswith(MANIFEST_SUFFIX):
+        return "dedup"
+    if file_name.endswith(SHARDS_SUFFIX):
+        return "sharded"
+    if ".shard" in file_name:
+        return "shard"
+    if ".base." in file_name:
+        return "base"
+    if plain_name(file_name).endswith(".tar"):
+        return "directory"
+    if ".inc." in file_name:
+        return "incremental"
+    return "plain"
+
+
+def new_entry(
+    file_name,
+    database,
+    database_type=None,
+    size=None,
+    checksum=None,
+    file_format=None,
+    label=None,
+):
+    """
+    Describes a backup for the catalog.
+    Parameters:
+    file_name (str): The name of the backup, `[<label>_]<database>_<timestamp><ext>`.
+    database (str): The name of the database.
+    database_type (str): 'postgres' or 'mysql'.
+    size (int): The size of the stored object in bytes.
+    checksum (str): The SHA-256 of the stored object.
+    file_format (str): The backup format. Defaults to the one inferred from the name.
+    label (str): The label of the backup, '' for an unlabelled one. Defaults to
+    the one inferred from the name, which is ambiguous when the name of another
+    database ends with `_<database>`.
+    Returns:
+    dict: The catalog entry, or None if the name is not a backup of `database`.
+    """
+    match = _BACKUP_NAME.match(file_name)
+    if not match:
+        return None
+    prefix, timestamp, _ = match.groups()
+    if label is not None:
+        label = label or None
+        if prefix != (f"{label}_{database}" if label else database):
+            return None
+    elif prefix == database:
+        label = None
+    elif prefix.endswith("_" + database):
+        label = prefix[: -len(database) - 1]
+    else:
+        return None
+    return {
+        "file": file_name,
+        "database": database,
+        "database_type": database_type,
+        "label": label,
+        "timestamp": timestamp,
+        "size": size,
+        "codec": get_codec(plain_name(file_name)),
+        "checksum": checksum,
+        "format": file_format or backup_format(file_name),
+    }
+
+
+def _scan_destination(destination, database):
+    """
+    Builds the entries of a database from a full listing of the destination.
+    Only needed once, for backups taken before the catalog existed.
+    """
+    entries = []
+    for file_name in destination.fetch_destination_filelist():
+        if file_name.startswith(CATALOG_PREFIX) or file_name.endswith(
+            (PARTIAL_SUFFIX, SIDECAR_SUFFIX)
+        ):
+            continue
+        entry = new_entry(file_name, database)
+        if entry:
+            entries.append(entry)
+    return entries
+
+
+def _read_catalog(destination, database):
+    """
+    Returns:
+    tuple: The catalog entries and the catalog version. When there is no
+    catalog yet, its entries are rebuilt from a listing and the version is None.
+    """
+    content, version = destination.read_versioned_from_destination(
+        catalog_name(database)
+    )
+    if content is None:
+        logging.info(f"[catalog] Building the catalog of {database} from a listing")
+        return _scan_destination(destination, database), None
+    return json.loads(content)["entries"], version
+
+
+def update_catalog(destination, database, add=(), remove=(), rescan=False, amend=None):
+    """
+    Adds and removes catalog entries in one atomic read-modify-write cycle.
+    The write only succeeds if the catalog did not change since it was read,
+    otherwise the cycle is retried on the new catalog, so concurrent backups of
+    the same database never lose each other's entries.
+    Parameters:
+    destination (module): The destination module.
+    database (str): The name of the database.
+    add (list): Entries to add, replacing any entry for the same file.
+    remove (list): Names of the files whose entries are removed.
+    rescan (bool): Replace the entries with the backups found by a full listing.
+    amend (dict): Fields to set on the entries of existing files, by file name.
+    Files that have no entry are left out.
+    Returns:
+    list: The entries of the updated catalog.
+    Raises:
+    RuntimeError: If the catalog kept changing under us.
+    """
+    with _locks_lock:
+        lock = _locks[database]
+    with lock:
+        for attempt in range(MAX_UPDATE_ATTEMPTS):
+            entries, version = _read_catalog(destination, database)
+            by_file = {entry["file"]: entry for entry in entries}
+            if rescan:
+                by_file = {
+                    entry["file"]: by_file.get(entry["file"], entry)
+                    for entry in _scan_destination(destination, database)
+                }
+            for entry in add:
+                by_file[entry["file"]] = entry
+            for file_name in remove:
+                by_file.pop(file_name, None)
+            for file_name, fields in (amend or {}).items():
+                if file_name in by_file:
+                    by_file[file_name] = dict(by_file[file_name], **fields)
+            entries = sorted(
+                by_file.values(), key=lambda entry: (entry["timestamp"], entry["file"])
+            )
+            content = json.dumps({"database": database, "entries": entries}, indent=1)
+            if destination.write_versioned_to_destination(
+                catalog_name(database), content.encode(), version
+            ):
+                return entries
+            logging.debug(
+                f"[update_catalog] Catalog of {database} changed, retrying (attempt {attempt+1})"
+            )
+            time.sleep(random.uniform(0.05, 0.2) * (attempt + 1))
+    raise RuntimeError(f"Could not update the catalog of {database}")
+
+
+def find_backups(destination, database, label=None, before=None):
+    """
+    Looks up the backups of a database in its catalog, without listing the
+    destination. A missing catalog is built from a listing and saved once.
+    Parameters:
+    destination (module): The destination module.
+    database (str): The name of the database.
+    label (str): Only return the backups with this label.
+    before (datetime): Only return the backups taken before this date.
+    Returns:
+    list: The matching entries, oldest first.
+    """
+    content, _ = destination.read_versioned_from_destination(catalog_name(database))
+    if content is None:
+        entries = update_catalog(destination, database)
+    else:
+        entries = json.loads(content)["entries"]
+    if label is not None:
+        entries = [entry for entry in entries if entry["label"] == label]
+    if before is not None:
+        cutoff = before.strftime("%Y%m%d%H%M%S")
+        entries = [entry for entry in entries if entry["timestamp"] < cutoff]
+    return entries
+
+
+def rebuild_catalog(destination, database):
+    """
+    Replaces the catalog of a database with one rebuilt from a full listing,
+    for instance after backups were added or removed by hand. Sizes and
+    checksums are only known for backups recorded at upload time, so they are
+    kept for the files that are still there.
+    Returns:
+    list: The entries of the rebuilt catalog.
+    """
+    return update_catalog(destination, database, rescan=True)
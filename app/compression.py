@@ -0,0 +1,275 @@
+import logging
+import os
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# zstd and lz4 are optional, the codecs that need them are only usable when installed
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:  # pragma: no cover
+    lz4 = None
+
+
+class _ZlibGzipCompressor:
+    """Single-threaded gzip, the original behaviour of `compress_backup`."""
+
+    def __init__(self, level):
+        # wbits=31 selects the gzip container, so the output is readable by gunzip
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+
+class _ParallelBlockCompressor:
+    """
+    Splits the input into fixed-size blocks and compresses them on a thread pool,
+    each block as an independent frame. Concatenated gzip members and LZ4 frames
+    are both valid streams, so the output stays readable by `gunzip` / `lz4 -d`.
+    At most `threads * block_size` bytes of input are buffered at once.
+    """
+
+    def __init__(self, compress_block, threads, block_size=4 * 1024 * 1024):
+        self._compress_block = compress_block
+        self._block_size = block_size
+        self._batch_size = block_size * threads
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._buffer = bytearray()
+
+    def _compress_buffered(self, final):
+        if final:
+            size = len(self._buffer)
+        else:
+            size = len(self._buffer) - len(self._buffer) % self._batch_size
+        if not size:
+            return b""
+        blocks = [
+            bytes(self._buffer[offset : min(offset + self._block_size, size)])
+            for offset in range(0, size, self._block_size)
+        ]
+        del self._buffer[:size]
+        # zlib, zstd and lz4 release the GIL while compressing, so this uses every core
+        return b"".join(self._executor.map(self._compress_block, blocks))
+
+    def compress(self, data):
+        self._buffer += data
+        if len(self._buffer) < self._batch_size:
+            return b""
+        return self._compress_buffered(final=False)
+
+    def flush(self):
+        try:
+            return self._compress_buffered(final=True)
+        finally:
+            self._executor.shutdown()
+
+
+class _MultiFrameDecompressor:
+    """
+    Decompresses a stream made of one or more concatenated frames (gzip members,
+    zstd or LZ4 frames), as written by the parallel block compressors.
+    `complete` tells whether the data so far ended with a whole frame, so a
+    truncated stream can be told apart from a complete one.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._decompressor = factory()
+        self.complete = False
+
+    def decompress(self, data):
+        output = []
+        while data:
+            output.append(self._decompressor.decompress(data))
+            if not self._decompressor.eof:
+                self.complete = False
+                break
+            data = self._decompressor.unused_data
+            self._decompressor = self._factory()
+            self.complete = True
+        return b"".join(output)
+
+
+def _gzip_compressor(level, threads):
+    if threads > 1:
+
+        def compress_block(block):
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+            return compressor.compress(block) + compressor.flush()
+
+        return _ParallelBlockCompressor(compress_block, threads)
+    return _ZlibGzipCompressor(level)
+
+
+def _zstd_compressor(level, threads):
+    if zstandard is None:
+        raise ValueError("The 'zstd' codec requires the 'zstandard' package")
+    # zstd has native multi-threading, which keeps the output a single frame
+    return zstandard.ZstdCompressor(
+        level=level, threads=threads if threads > 1 else 0
+    ).compressobj()
+
+
+def _lz4_compressor(level, threads):
+    if lz4 is None:
+        raise ValueError("The 'lz4' codec requires the 'lz4' package")
+    if threads > 1:
+        return _ParallelBlockCompressor(
+            lambda block: lz4.frame.compress(block, compression_level=level), threads
+        )
+    compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+    header = compressor.begin()
+
+    class _Compressor:
+        def compress(self, data):
+            nonlocal header
+            output, header = header + compressor.compress(data), b""
+            return output
+
+        def flush(self):
+            return header + compressor.flush()
+
+    return _Compressor()
+
+
+def _zstd_decompressor():
+    if zstandard is None:
+        raise ValueError("The 'zstd' codec requires the 'zstandard' package")
+    return _MultiFrameDecompressor(lambda: zstandard.ZstdDecompressor().decompressobj())
+
+
+def _lz4_decompressor():
+    if lz4 is None:
+        raise ValueError("The 'lz4' codec requires the 'lz4' package")
+    return _MultiFrameDecompressor(lz4.frame.LZ4FrameDecompressor)
+
+
+# name: (file extension, default level, compressor factory, decompressor factory)
+# 'gzip' and 'pgzip' share the .gz extension, their output is interchangeable
+CODECS = {
+    "gzip": (
+        ".gz",
+        9,
+        lambda level, threads: _gzip_compressor(level, 1),
+        lambda: _MultiFrameDecompressor(lambda: zlib.decompressobj(31)),
+    ),
+    "pgzip": (
+        ".gz",
+        6,
+        _gzip_compressor,
+        lambda: _MultiFrameDecompressor(lambda: zlib.decompressobj(31)),
+    ),
+    "zstd": (".zst", 3, _zstd_compressor, _zstd_decompressor),
+    "lz4": (".lz4", 0, _lz4_compressor, _lz4_decompressor),
+}
+
+
+def get_extension(codec):
+    """
+    Returns the file extension that records the given codec in a backup's name.
+    Parameters:
+    codec (str): The name of the codec.
+    Returns:
+    str: The file extension, including the leading dot.
+    """
+    return CODECS[codec][0]
+
+
+def get_compressor(codec="gzip", level=None, threads=1):
+    """
+    Creates a streaming compressor for the given codec.
+    Parameters:
+    codec (str): One of 'gzip', 'pgzip', 'zstd' or 'lz4'.
+    level (int): The compression level. Defaults to the codec's own default.
+    threads (int): The number of threads to compress with. Ignored by 'gzip'.
+    Returns:
+    object: A compressor with `compress(data)` and `flush()` methods returning bytes.
+    """
+    if codec not in CODECS:
+        raise ValueError(f"Unknown compression codec: {codec}")
+    _, default_level, compressor_factory, _ = CODECS[codec]
+    return compressor_factory(
+        default_level if level is None else level, max(1, threads or 1)
+    )
+
+
+def get_codec(file_name):
+    """
+    Finds the codec a backup was compressed with, from its file extension.
+    'gzip' and 'pgzip' share the .gz extension, so .gz files report 'gzip'.
+    Parameters:
+    file_name (str): The name of the compressed backup.
+    Returns:
+    str: The codec name, or None if the extension is not a codec extension.
+    """
+    for codec, (extension, _, _, _) in CODECS.items():
+        if file_name.endswith(extension):
+            return codec
+    return None
+
+
+def get_decompressor(file_name):
+    """
+    Creates a streaming decompressor for a backup, based on its file extension.
+    Parameters:
+    file_name (str): The name of the compressed backup.
+    Returns:
+    object: A decompressor with a `decompress(data)` method, or None if the
+    name does not end with a known codec extension.
+    """
+    for extension, _, _, decompressor_factory in CODECS.values():
+        if file_name.endswith(extension):
+            return decompressor_factory()
+    return None
+
+
+def compare_codecs(sample_file, codecs=None, threads=None):
+    """
+    Compresses a sample dump with each codec and measures throughput against ratio.
+    Parameters:
+    sample_file (str): The path of the sample dump.
+    codecs (list): The codecs to compare. Defaults to every installed codec.
+    threads (int): The number of threads for multi-threaded codecs. Defaults to
+    the number of available cores.
+    Returns:
+    list: One dict per codec with its name, level, threads, seconds, input MB/s
+    and compression ratio.
+    """
+    threads = threads or os.cpu_count() or 1
+    results = []
+    for codec in codecs or CODECS:
+        try:
+            compressor = get_compressor(codec, threads=threads)
+        except ValueError as e:
+            logging.warning(f"[compare_codecs] Skipping {codec}: {str(e)}")
+            continue
+        size_in = size_out = 0
+        start = time.perf_counter()
+        with open(sample_file, "rb") as f_in:
+            for chunk in iter(lambda: f_in.read(1024 * 1024), b""):
+                size_in += len(chunk)
+                size_out += len(compressor.compress(chunk))
+        size_out += len(compressor.flush())
+        seconds = time.perf_counter() - start
+        results.append(
+            {
+                "codec": codec,
+                "level": CODECS[codec][1],
+                "threads": 1 if codec == "gzip" else threads,
+                "seconds": round(seconds, 3),
+                "mb_per_s": round(size_in / 1024 / 1024 / seconds, 1)
+                if seconds
+                else None,
+                "ratio": round(size_in / size_out, 2) if size_out else None,
+            }
+        )
+    return results
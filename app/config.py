@@ -1,5 +1,6 @@
 import os
 import logging
+import tempfile
 
 
 def get_config_vars():
@@ -22,10 +23,176 @@ def get_config_vars():
             if os.getenv("FTP_PORT")
             else 21,  # Default FTP port is 21, convert to integer if FTP_PORT is set
             "FTP_PATH": os.getenv("FTP_PATH"),
+            "FTP_POOL_SIZE": int(os.getenv("FTP_POOL_SIZE"))
+            if os.getenv("FTP_POOL_SIZE")
+            else 4,  # Reusable FTP connections kept open during a job
             "AWS_ACCESS_KEY_ID": os.getenv("AWS_ACCESS_KEY_ID"),
             "AWS_SECRET_ACCESS_KEY": os.getenv("AWS_SECRET_ACCESS_KEY"),
             "AWS_S3_BUCKET": os.getenv("AWS_S3_BUCKET"),
             "AWS_S3_REGION": os.getenv("AWS_S3_REGION"),
+            "FANOUT_DESTINATIONS": os.getenv(
+                "FANOUT_DESTINATIONS"
+            ),  # Extra targets every backup is also written to, e.g. S3_EU,FTP_OFFSITE
+            "FANOUT_BUFFER_CHUNKS": int(os.getenv("FANOUT_BUFFER_CHUNKS"))
+            if os.getenv("FANOUT_BUFFER_CHUNKS")
+            else 8,  # Stream chunks buffered for the slowest fan-out destination
+            "BACKUP_STREAMING": os.getenv("BACKUP_STREAMING", "false").lower()
+            in ("1", "true", "yes"),  # Stream dump -> gzip -> upload without temp files
+            "STREAM_CHUNK_SIZE": int(os.getenv("STREAM_CHUNK_SIZE"))
+            if os.getenv("STREAM_CHUNK_SIZE")
+            else 1024 * 1024,  # Bytes read from the dump process per chunk
+            "S3_MULTIPART_PART_SIZE": int(os.getenv("S3_MULTIPART_PART_SIZE"))
+            if os.getenv("S3_MULTIPART_PART_SIZE")
+            else 64
+            * 1024
+            * 1024,  # S3 requires at least 5 MB for all but the last part
+            "S3_MULTIPART_CONCURRENCY": int(os.getenv("S3_MULTIPART_CONCURRENCY"))
+            if os.getenv("S3_MULTIPART_CONCURRENCY")
+            else 4,  # Parts uploaded in parallel, and held in memory, at once
+            "S3_PART_MAX_ATTEMPTS": int(os.getenv("S3_PART_MAX_ATTEMPTS"))
+            if os.getenv("S3_PART_MAX_ATTEMPTS")
+            else 3,
+            "RESUMABLE_UPLOADS": os.getenv("RESUMABLE_UPLOADS", "false").lower()
+            in (
+                "1",
+                "true",
+                "yes",
+            ),  # Journal streaming uploads so they survive restarts
+            "FTP_SEGMENT_SIZE": int(os.getenv("FTP_SEGMENT_SIZE"))
+            if os.getenv("FTP_SEGMENT_SIZE")
+            else 16
+            * 1024
+            * 1024,  # Bytes appended per APPE, the granularity of FTP resumes
+            "S3_DELETE_CONCURRENCY": int(os.getenv("S3_DELETE_CONCURRENCY"))
+            if os.getenv("S3_DELETE_CONCURRENCY")
+            else 4,  # DeleteObjects batches of 1000 keys in flight at once
+            "POSTGRES_DUMP_FORMAT": os.getenv(
+                "POSTGRES_DUMP_FORMAT", "plain"
+            ).lower(),  # 'plain', 'directory' or 'base'
+            "POSTGRES_DUMP_JOBS": int(os.getenv("POSTGRES_DUMP_JOBS"))
+            if os.getenv("POSTGRES_DUMP_JOBS")
+            else os.cpu_count() or 1,  # Parallel jobs for directory-format dumps
+            "MYSQL_DUMP_JOBS": int(os.getenv("MYSQL_DUMP_JOBS"))
+            if os.getenv("MYSQL_DUMP_JOBS")
+            else 1,  # Connections of the parallel MySQL dump engine, 1 uses mysqldump
+            "RESTORE_JOBS": int(os.getenv("RESTORE_JOBS"))
+            if os.getenv("RESTORE_JOBS")
+            else os.cpu_count()
+            or 1,  # Parallel pg_restore jobs for directory-format backups
+            "BACKUP_INCLUDE_TABLES": os.getenv(
+                "BACKUP_INCLUDE_TABLES"
+            ),  # Only back up these tables, e.g. 'public.orders,public.customer*'
+            "BACKUP_EXCLUDE_TABLES": os.getenv(
+                "BACKUP_EXCLUDE_TABLES"
+            ),  # Leave these tables out of backups, e.g. '*_log,sessions'
+            "SHARD_TABLE_SIZE": int(os.getenv("SHARD_TABLE_SIZE"))
+            if os.getenv("SHARD_TABLE_SIZE")
+            else None,  # Bytes above which a table is dumped as primary key ranges
+            "SHARD_JOBS": int(os.getenv("SHARD_JOBS"))
+            if os.getenv("SHARD_JOBS")
+            else 4,  # Parts of a sharded backup dumped and uploaded at once
+            "COMPRESSION_CODEC": os.getenv(
+                "COMPRESSION_CODEC", "gzip"
+            ).lower(),  # 'gzip', 'pgzip', 'zstd' or 'lz4'
+            "COMPRESSION_LEVEL": int(os.getenv("COMPRESSION_LEVEL"))
+            if os.getenv("COMPRESSION_LEVEL")
+            else None,  # Defaults to the codec's own default level
+            "COMPRESSION_THREADS": int(os.getenv("COMPRESSION_THREADS"))
+            if os.getenv("COMPRESSION_THREADS")
+            else os.cpu_count() or 1,
+            "ENCRYPTION_KEY": os.getenv("ENCRYPTION_KEY"),  # Base64 256-bit master key
+            "ENCRYPTION_PREVIOUS_KEYS": os.getenv("ENCRYPTION_PREVIOUS_KEYS"),
+            "ENCRYPTION_CHUNK_SIZE": int(os.getenv("ENCRYPTION_CHUNK_SIZE"))
+            if os.getenv("ENCRYPTION_CHUNK_SIZE")
+            else 1024 * 1024,  # Plaintext bytes sealed per AES-GCM chunk
+            "ENCRYPTION_THREADS": int(os.getenv("ENCRYPTION_THREADS"))
+            if os.getenv("ENCRYPTION_THREADS")
+            else os.cpu_count() or 1,
+            "INCREMENTAL_BACKUPS": os.getenv("INCREMENTAL_BACKUPS", "false").lower()
+            in ("1", "true", "yes"),  # Only re-dump the tables that changed
+            "INCREMENTAL_MAX_CHAIN": int(os.getenv("INCREMENTAL_MAX_CHAIN"))
+            if os.getenv("INCREMENTAL_MAX_CHAIN")
+            else 24,  # Increments on top of a full base before taking a new one
+            "INCREMENTAL_MYSQL_CHECKSUM": os.getenv(
+                "INCREMENTAL_MYSQL_CHECKSUM", "false"
+            ).lower()
+            in ("1", "true", "yes"),  # CHECKSUM TABLE instead of UPDATE_TIME
+            "DEDUP_STORE": os.getenv("DEDUP_STORE", "false").lower()
+            in ("1", "true", "yes"),  # Content-defined chunking, deduplicated store
+            "DEDUP_CHUNK_SIZE": int(os.getenv("DEDUP_CHUNK_SIZE"))
+            if os.getenv("DEDUP_CHUNK_SIZE")
+            else 1024 * 1024,  # Target average chunk size
+            "DEDUP_UPLOAD_CONCURRENCY": int(os.getenv("DEDUP_UPLOAD_CONCURRENCY"))
+            if os.getenv("DEDUP_UPLOAD_CONCURRENCY")
+            else 4,
+            "DEDUP_GC_GRACE_PERIOD": int(os.getenv("DEDUP_GC_GRACE_PERIOD"))
+            if os.getenv("DEDUP_GC_GRACE_PERIOD")
+            else 24,  # Hours before an unreferenced chunk may be deleted
+            "BATCH_MAX_CONCURRENCY": int(os.getenv("BATCH_MAX_CONCURRENCY"))
+            if os.getenv("BATCH_MAX_CONCURRENCY")
+            else 4,  # Backups running at once in a batch
+            "BATCH_MAX_PER_HOST": int(os.getenv("BATCH_MAX_PER_HOST"))
+            if os.getenv("BATCH_MAX_PER_HOST")
+            else 2,  # Backups running at once against the same database host
+            "JOBS_DB_PATH": os.getenv(
+                "JOBS_DB_PATH", "jobs.sqlite3"
+            ),  # SQLite file holding the state of jobs queued by the task endpoints
+            "JOB_WORKERS": int(os.getenv("JOB_WORKERS"))
+            if os.getenv("JOB_WORKERS")
+            else 2,  # Jobs running at once per web process
+            "RETENTION_POLICY": os.getenv(
+                "RETENTION_POLICY"
+            ),  # Backups kept per tier, e.g. 'hourly=24,daily=7,weekly=4,monthly=12'
+            "RETENTION_STORAGE_CLASSES": os.getenv(
+                "RETENTION_STORAGE_CLASSES"
+            ),  # S3 storage class per tier, e.g. 'weekly=STANDARD_IA,monthly=GLACIER_IR'
+            "THROTTLE_DUMP_RATE": int(os.getenv("THROTTLE_DUMP_RATE"))
+            if os.getenv("THROTTLE_DUMP_RATE")
+            else None,  # Bytes per second read from dumps, shared by concurrent jobs
+            "THROTTLE_UPLOAD_RATE": int(os.getenv("THROTTLE_UPLOAD_RATE"))
+            if os.getenv("THROTTLE_UPLOAD_RATE")
+            else None,  # Bytes per second uploaded, shared by concurrent jobs
+            "THROTTLE_ADAPTIVE": os.getenv("THROTTLE_ADAPTIVE", "false").lower()
+            in ("1", "true", "yes"),  # Back off while the source database is loaded
+            "THROTTLE_ADAPTIVE_INTERVAL": float(os.getenv("THROTTLE_ADAPTIVE_INTERVAL"))
+            if os.getenv("THROTTLE_ADAPTIVE_INTERVAL")
+            else 10.0,  # Seconds between two samples of the source database load
+            "THROTTLE_MAX_REPLICATION_LAG": float(
+                os.getenv("THROTTLE_MAX_REPLICATION_LAG")
+            )
+            if os.getenv("THROTTLE_MAX_REPLICATION_LAG")
+            else 30.0,  # Seconds
+            "THROTTLE_MAX_ACTIVE_CONNECTIONS": int(
+                os.getenv("THROTTLE_MAX_ACTIVE_CONNECTIONS")
+            )
+            if os.getenv("THROTTLE_MAX_ACTIVE_CONNECTIONS")
+            else 20,  # Sessions running a query, not counting the dump
+            "VERIFY_RESTORE_URL": os.getenv(
+                "VERIFY_RESTORE_URL"
+            ),  # Scratch database that `verify` test restores overwrite
+            "ARCHIVE_INTERVAL": float(os.getenv("ARCHIVE_INTERVAL"))
+            if os.getenv("ARCHIVE_INTERVAL")
+            else 60.0,  # Seconds between two uploads of the archived logs
+            "ARCHIVE_SLOT": os.getenv(
+                "ARCHIVE_SLOT", "heroku_database_backup"
+            ),  # Replication slot of the WAL archiver
+            "ARCHIVE_SPOOL_DIR": os.getenv(
+                "ARCHIVE_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "archive")
+            ),  # Where received logs wait to be archived
+            "BACKUP_SKIP_UNCHANGED": os.getenv("BACKUP_SKIP_UNCHANGED", "false").lower()
+            in ("1", "true", "yes"),  # Skip backups of databases that did not change
+            "BACKUP_SKIP_MAX_AGE": int(os.getenv("BACKUP_SKIP_MAX_AGE"))
+            if os.getenv("BACKUP_SKIP_MAX_AGE")
+            else 168,  # Hours after which a backup is taken anyway, 0 for never
+            "CACHE_DIR": os.getenv(
+                "CACHE_DIR"
+            ),  # Local copies of recent backups, off when unset
+            "CACHE_MAX_SIZE": int(os.getenv("CACHE_MAX_SIZE"))
+            if os.getenv("CACHE_MAX_SIZE")
+            else 1024 * 1024 * 1024,  # Total size of the cached files
+            "CACHE_MIN_FREE": int(os.getenv("CACHE_MIN_FREE"))
+            if os.getenv("CACHE_MIN_FREE")
+            else 512 * 1024 * 1024,  # Disk space the cache leaves free
         }
     except Exception as e:
         logging.error(
@@ -1,6 +1,42 @@
 # Import the database backup functions from the respective files
-from .postgres import create_backup_postgres
-from .mysql import create_backup_mysql
+from .postgres import (
+    create_backup_postgres,
+    create_backup_postgres_directory,
+    open_backup_stream_postgres,
+    open_base_backup_postgres,
+    open_copy_restore_postgres,
+    open_copy_stream_postgres,
+    open_restore_stream_postgres,
+    open_snapshot_postgres,
+    open_wal_receiver_postgres,
+    restore_backup_postgres_directory,
+    run_query_postgres,
+)
+from .mysql import (
+    MySQLSnapshot,
+    create_backup_mysql,
+    open_backup_stream_mysql,
+    open_binlog_receiver_mysql,
+    open_restore_stream_mysql,
+    open_snapshot_mysql,
+    replay_binlogs_mysql,
+    run_query_mysql,
+)
 
 # Create a dictionary to map the database system to the respective backup function
 DB_BACKUP_FUNCTIONS = {"postgres": create_backup_postgres, "mysql": create_backup_mysql}
+
+# Map the database system to the function that starts a streaming dump process
+DB_STREAM_FUNCTIONS = {
+    "postgres": open_backup_stream_postgres,
+    "mysql": open_backup_stream_mysql,
+}
+
+# Map the database system to the function that runs a query and returns its rows
+DB_QUERY_FUNCTIONS = {"postgres": run_query_postgres, "mysql": run_query_mysql}
+
+# Map the database system to the function that starts a restore reading from stdin
+DB_RESTORE_FUNCTIONS = {
+    "postgres": open_restore_stream_postgres,
+    "mysql": open_restore_stream_mysql,
+}
@@ -1,16 +1,37 @@
 import subprocess
 import os
+import queue
+import threading
 from datetime import datetime
 from ..util import parse_connection_url
 import logging
 
+# pymysql is optional, only the parallel dump engine needs it
+try:
+    import pymysql
+    import pymysql.cursors
+except ImportError:  # pragma: no cover
+    pymysql = None
 
-def create_backup_mysql(ConnectionUrl, backup_filename):
+# Written at the start of every table dumped by the parallel engine, so each
+# can be loaded on its own session
+ROWS_HEADER = (
+    "SET NAMES utf8mb4;\n"
+    "SET TIME_ZONE='+00:00';\n"
+    "SET FOREIGN_KEY_CHECKS=0;\n"
+    "SET UNIQUE_CHECKS=0;\n"
+    "SET SQL_MODE='NO_AUTO_VALUE_ON_ZERO';\n"
+)
+
+
+def create_backup_mysql(ConnectionUrl, backup_filename, extra_args=None, tables=None):
     """
     This function creates a backup of a MySQL database.
     Parameters:
     ConnectionUrl (str): The connection URL of the MySQL database.
     backup_filename (str): The filename to use for the backup file.
+    extra_args (list): Additional `mysqldump` options, such as `--ignore-table`.
+    tables (list): Only dump these tables. Defaults to the whole database.
     Returns:
     str: The name of the backup file if the backup is successful, False otherwise.
     """
@@ -26,17 +47,21 @@ def create_backup_mysql(ConnectionUrl, backup_filename):
     # Create a copy of the current environment variables
     env = os.environ.copy()
 
-    # Add the password to the environment variables for the subprocess
-    # This is done to avoid exposing the password in the process list
-    # The name of the environment variable is constructed based on the database name to avoid conflicts
-    env[f"MYSQL_PWD_{dbname.upper()}"] = password
+    # mysqldump reads the password from MYSQL_PWD, which keeps it out of the process list
+    env["MYSQL_PWD"] = password
 
     # Construct the mysqldump command to create a backup of the database
-    command = f"mysqldump -u {username} -h {host} {dbname} > {backup_file}"
+    command = ["mysqldump", "-u", username, "-h", host]
+    if connection_details["port"]:
+        command += ["-P", str(connection_details["port"])]
+    command += extra_args or []
+    command.append(dbname)
+    command += tables or []
 
-    # Execute the command
+    # Execute the command, with its output written straight to the backup file
     try:
-        result = subprocess.run(command, shell=True, check=False, env=env)
+        with open(backup_file, "wb") as output:
+            result = subprocess.run(command, stdout=output, check=False, env=env)
         if result.returncode != 0:
             logging.error(
                 f"[create_backup_mysql] Command failed with return code: {result.returncode}"
@@ -61,3 +86,409 @@ def create_backup_mysql(ConnectionUrl, backup_filename):
 
     # Return the name of the backup file if the backup is successful
     return backup_file
+
+
+def open_backup_stream_mysql(ConnectionUrl, extra_args=None, tables=None):
+    """
+    This function starts `mysqldump` with the dump written to a pipe instead of a file.
+    The caller is responsible for reading the process output and waiting for it to exit.
+    Parameters:
+    ConnectionUrl (str): The connection URL of the MySQL database.
+    extra_args (list): Additional `mysqldump` options, such as `--no-create-info`.
+    tables (list): Only dump these tables. Defaults to the whole database.
+    Returns:
+    subprocess.Popen: The running `mysqldump` process, with the dump available on its stdout.
+    """
+    connection_details = parse_connection_url(ConnectionUrl)
+
+    # mysqldump reads the password from MYSQL_PWD, which keeps it out of the process list
+    env = os.environ.copy()
+    env["MYSQL_PWD"] = connection_details["password"]
+
+    command = [
+        "mysqldump",
+        "-u",
+        connection_details["username"],
+        "-h",
+        connection_details["hostname"],
+    ]
+    if connection_details["port"]:
+        command += ["-P", str(connection_details["port"])]
+    command += extra_args or []
+    command.append(connection_details["database_name"])
+    command += tables or []
+
+    return subprocess.Popen(command, stdout=subprocess.PIPE, env=env)
+
+
+def run_query_mysql(ConnectionUrl, query):
+    """
+    This function runs one or more queries with the `mysql` client and returns the result rows.
+    Parameters:
+    ConnectionUrl (str): The connection URL of the MySQL database.
+    query (str): The SQL to run.
+    Returns:
+    list: The result rows, each a list of column values as strings.
+    """
+    connection_details = parse_connection_url(ConnectionUrl)
+
+    env = os.environ.copy()
+    env["MYSQL_PWD"] = connection_details["password"]
+
+    command = [
+        "mysql",
+        "-N",
+        "-B",
+        "-u",
+        connection_details["username"],
+        "-h",
+        connection_details["hostname"],
+    ]
+    if connection_details["port"]:
+        command += ["-P", str(connection_details["port"])]
+    command += [connection_details["database_name"], "-e", query]
+
+    result = subprocess.run(
+        command, check=True, env=env, stdout=subprocess.PIPE, text=True
+    )
+    return [line.split("\t") for line in result.stdout.splitlines() if line]
+
+
+def open_restore_stream_mysql(ConnectionUrl):
+    """
+    This function starts the `mysql` client reading a dump from its stdin.
+    The caller writes the dump to the process and closes stdin when done.
+    Parameters:
+    ConnectionUrl (str): The connection URL of the MySQL database to restore into.
+    Returns:
+    subprocess.Popen: The running `mysql` process, with stdin=PIPE.
+    """
+    connection_details = parse_connection_url(ConnectionUrl)
+
+    env = os.environ.copy()
+    env["MYSQL_PWD"] = connection_details["password"]
+
+    command = [
+        "mysql",
+        "-u",
+        connection_details["username"],
+        "-h",
+        connection_details["hostname"],
+    ]
+    if connection_details["port"]:
+        command += ["-P", str(connection_details["port"])]
+    command.append(connection_details["database_name"])
+
+    return subprocess.Popen(
+        command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, env=env
+    )
+
+
+def connect_mysql(ConnectionUrl):
+    """
+    This function opens a pymysql connection to a MySQL database.
+    Parameters:
+    ConnectionUrl (str): The connection URL of the MySQL database.
+    Returns:
+    pymysql.connections.Connection: The open connection.
+    Raises:
+    ValueError: If pymysql is not installed.
+    """
+    if pymysql is None:
+        raise ValueError("The parallel MySQL dump requires the 'pymysql' package")
+    connection_details = parse_connection_url(ConnectionUrl)
+    return pymysql.connect(
+        host=connection_details["hostname"],
+        port=int(connection_details["port"] or 3306),
+        user=connection_details["username"],
+        password=connection_details["password"],
+        database=connection_details["database_name"],
+        charset="utf8mb4",
+        init_command="SET TIME_ZONE='+00:00'",
+    )
+
+
+def _binlog_position(cursor):
+    """
+    Returns the binary log position and GTID set of the server, or None when
+    binary logging is off or the user cannot read it.
+    """
+    for statement in ("SHOW BINARY LOG STATUS", "SHOW MASTER STATUS"):
+        try:
+            cursor.execute(statement)
+        except pymysql.MySQLError:
+            continue
+        row = cursor.fetchone()
+        if not row:
+            return None
+        return {
+            "file": row[0],
+            "position": int(row[1]),
+            "gtid": row[4] if len(row) > 4 else "",
+        }
+    return None
+
+
+class _RowDumpProcess:
+    """
+    Dumps the rows of one table as INSERT statements from a connection of a
+    shared snapshot, on a thread. It looks like a dump process to the streaming
+    pipeline: the SQL is read from `stdout`, and `wait` returns 0 once every
+    row was written.
+    """
+
+    def __init__(self, snapshot, table, condition, statement_size):
+        self._snapshot = snapshot
+        self._table = table
+        self._condition = condition
+        self._statement_size = statement_size
+        self.returncode = None
+        read_end, self._write_end = os.pipe()
+        self.stdout = os.fdopen(read_end, "rb")
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        connection = self._snapshot.acquire()
+        try:
+            with os.fdopen(self._write_end, "wb") as output:
+                self._dump(connection, output)
+            self.returncode = 0
+        except BrokenPipeError:
+            # The reader gave up, the upload failed or the dump was killed
+            self.returncode = -9
+        except Exception as e:
+            logging.error(
+                f"[open_rows_stream_mysql] Error dumping {self._table}: {str(e)}"
+            )
+            self.returncode = 1
+        finally:
+            self._snapshot.release(connection)
+
+    def _dump(self, connection, output):
+        quoted_table = "`" + self._table.replace("`", "``") + "`"
+        with connection.cursor() as cursor:
+            # Generated columns cannot be inserted into
+            cursor.execute(
+                "SELECT COLUMN_NAME FROM information_schema.COLUMNS "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s "
+                "AND EXTRA NOT LIKE '%%GENERATED%%' ORDER BY ORDINAL_POSITION",
+                (self._table,),
+            )
+            columns = ", ".join(
+                "`" + row[0].replace("`", "``") + "`" for row in cursor.fetchall()
+            )
+        query = f"SELECT {columns} FROM {quoted_table}"
+        if self._condition:
+            query += f" WHERE {self._condition}"
+        insert = f"INSERT INTO {quoted_table} ({columns}) VALUES ".encode()
+
+        output.write(ROWS_HEADER.encode())
+        # An unbuffered cursor streams the rows instead of loading the whole table.
+        # Closing it reads the rest of the result, so the connection can be reused.
+        with connection.cursor(pymysql.cursors.SSCursor) as cursor:
+            cursor.execute(query)
+            statement = []
+            size = 0
+            while True:
+                rows = cursor.fetchmany(1000)
+                if not rows:
+                    break
+                for row in rows:
+                    # Binary values are escaped as surrogates, encoded back to bytes
+                    values = connection.escape(row).encode("utf8", "surrogateescape")
+                    statement.append(values)
+                    size += len(values) + 1
+                    if size >= self._statement_size:
+                        output.write(insert + b",".join(statement) + b";\n")
+                        statement = []
+                        size = 0
+            if statement:
+                output.write(insert + b",".join(statement) + b";\n")
+
+    def poll(self):
+        return None if self._thread.is_alive() else self.returncode
+
+    def kill(self):
+        # The dump stops at its next write
+        self.stdout.close()
+
+    def wait(self):
+        self._thread.join()
+        return self.returncode
+
+
+class MySQLSnapshot:
+    """
+    A pool of connections that all read the database as of the same instant,
+    opened the way mydumper does: every connection starts a consistent snapshot
+    transaction while writes are blocked by a global read lock, or by a read
+    lock on every table when the user lacks the RELOAD privilege. The lock is
+    released as soon as the snapshots are taken.
+    Parameters:
+    ConnectionUrl (str): The connection URL of the MySQL database.
+    connections (int): The number of connections, and of tables dumped at once.
+    statement_size (int): The size of the INSERT statements written, in bytes.
+    """
+
+    def __init__(self, ConnectionUrl, connections, statement_size=1024 * 1024):
+        self._statement_size = statement_size
+        self._idle = queue.Queue()
+        self._connections = []
+        coordinator = connect_mysql(ConnectionUrl)
+        try:
+            with coordinator.cursor() as cursor:
+                try:
+                    cursor.execute("FLUSH TABLES WITH READ LOCK")
+                except pymysql.MySQLError:
+                    cursor.execute("SHOW FULL TABLES WHERE Table_type = 'BASE TABLE'")
+                    tables = [row[0] for row in cursor.fetchall()]
+                    if tables:
+                        cursor.execute(
+                            "LOCK TABLES "
+                            + ", ".join(
+                                "`" + table.replace("`", "``") + "` READ"
+                                for table in tables
+                            )
+                        )
+                for _ in range(max(1, connections)):
+                    connection = connect_mysql(ConnectionUrl)
+                    self._connections.append(connection)
+                    with connection.cursor() as worker:
+                        worker.execute(
+                            "SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ"
+                        )
+                        worker.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+                    self._idle.put(connection)
+                self.position = _binlog_position(cursor)
+                cursor.execute("UNLOCK TABLES")
+        except Exception:
+            self.close()
+            raise
+        finally:
+            coordinator.close()
+
+    def acquire(self):
+        return self._idle.get()
+
+    def release(self, connection):
+        self._idle.put(connection)
+
+    def open_rows_stream(self, table, condition=None):
+        """
+        Starts dumping the rows of a table, or of the rows matching `condition`,
+        as soon as a connection is free.
+        Returns:
+        object: A process-like object with the SQL available on its stdout.
+        """
+        return _RowDumpProcess(self, table, condition, self._statement_size)
+
+    def close(self):
+        for connection in self._connections:
+            try:
+                connection.rollback()
+                connection.close()
+            except Exception:
+                pass
+
+
+def open_snapshot_mysql(ConnectionUrl, connections):
+    """
+    This function opens a pool of connections sharing one consistent snapshot.
+    Parameters:
+    ConnectionUrl (str): The connection URL of the MySQL database.
+    connections (int): The number of connections.
+    Returns:
+    MySQLSnapshot: The open snapshot. The caller closes it when done.
+    """
+    return MySQLSnapshot(ConnectionUrl, connections)
+
+
+def open_binlog_receiver_mysql(ConnectionUrl, directory, start_file):
+    """
+    This function starts `mysqlbinlog` copying the binary logs of the server into
+    a directory as they are written, from `start_file` on. Every file but the
+    newest is complete.
+    Parameters:
+    ConnectionUrl (str): The connection URL of the MySQL database. The user needs
+    the REPLICATION SLAVE privilege.
+    directory (str): The directory to write the binary logs to.
+    start_file (str): The name of the first binary log to copy.
+    Returns:
+    subprocess.Popen: The running `mysqlbinlog` process.
+    """
+    connection_details = parse_connection_url(ConnectionUrl)
+
+    env = os.environ.copy()
+    env["MYSQL_PWD"] = connection_details["password"]
+
+    command = [
+        "mysqlbinlog",
+        "--read-from-remote-server",
+        "--raw",
+        "--stop-never",
+        "--host",
+        connection_details["hostname"],
+        "--user",
+        connection_details["username"],
+    ]
+    if connection_details["port"]:
+        command += ["--port", str(connection_details["port"])]
+    command += [f"--result-file={os.path.join(directory, '')}", start_file]
+
+    return subprocess.Popen(command, env=env)
+
+
+def replay_binlogs_mysql(ConnectionUrl, files, start_position, stop_datetime):
+    """
+    This function replays binary logs into a database with `mysqlbinlog`, piped
+    into the `mysql` client. Only the events of the database are replayed, and
+    their GTIDs are dropped so the server does not skip them as already applied.
+    Parameters:
+    ConnectionUrl (str): The connection URL of the MySQL database to replay into.
+    files (list): The paths of the binary logs, in order.
+    start_position (int): The position in the first file to start from.
+    stop_datetime (str): Stop at the first event at or after this time,
+    'YYYY-MM-DD HH:MM:SS'.
+    Returns:
+    bool: True if every event was replayed, False otherwise.
+    """
+    connection_details = parse_connection_url(ConnectionUrl)
+
+    env = os.environ.copy()
+    env["MYSQL_PWD"] = connection_details["password"]
+
+    replay = subprocess.Popen(
+        [
+            "mysqlbinlog",
+            "--skip-gtids",
+            f"--database={connection_details['database_name']}",
+            f"--start-position={start_position}",
+            f"--stop-datetime={stop_datetime}",
+        ]
+        + files,
+        stdout=subprocess.PIPE,
+    )
+    command = [
+        "mysql",
+        "-u",
+        connection_details["username"],
+        "-h",
+        connection_details["hostname"],
+    ]
+    if connection_details["port"]:
+        command += ["-P", str(connection_details["port"])]
+    command.append(connection_details["database_name"])
+    client = subprocess.Popen(
+        command, stdin=replay.stdout, stdout=subprocess.DEVNULL, env=env
+    )
+    # Only the client reads the pipe, so it sees its end when mysqlbinlog exits
+    replay.stdout.close()
+    client_code = client.wait()
+    replay_code = replay.wait()
+    if replay_code != 0 or client_code != 0:
+        logging.error(
+            f"[replay_binlogs_mysql] mysqlbinlog exited with {replay_code}, mysql with {client_code}"
+        )
+        return False
+    return True
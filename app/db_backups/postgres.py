@@ -1,11 +1,14 @@
 import os
+import shutil
 import subprocess
 from datetime import datetime
 from ..util import parse_connection_url
 import logging
 
 
-def create_backup_postgres(ConnectionUrl, backup_filename):
+def create_backup_postgres(
+    ConnectionUrl, backup_filename, extra_args=None, tables=None
+):
     """
     This function creates a backup of a PostgreSQL database using the `pg_dump` command-line utility.
     The backup file is saved in the current directory with the provided filename.
@@ -13,6 +16,8 @@ def create_backup_postgres(ConnectionUrl, backup_filename):
     Parameters:
     ConnectionUrl (str): The connection URL of the PostgreSQL database.
     backup_filename (str): The filename to use for the backup file.
+    extra_args (list): Additional `pg_dump` arguments, such as `-T <table>`.
+    tables (list): Only dump these tables. Defaults to the whole database.
 
     Returns:
     str: The name of the backup file if the backup is successful, False otherwise.
@@ -44,7 +49,9 @@ def create_backup_postgres(ConnectionUrl, backup_filename):
                 backup_file_name,
                 "-d",
                 database_name,
-            ],
+            ]
+            + (extra_args or [])
+            + [arg for table in tables or [] for arg in ("-t", table)],
             check=False,
             env=env,
         )
@@ -70,3 +77,469 @@ def create_backup_postgres(ConnectionUrl, backup_filename):
 
     # Return the name of the backup file if the backup is successful
     return backup_file_name
+
+
+def open_backup_stream_postgres(ConnectionUrl, extra_args=None, tables=None):
+    """
+    This function starts `pg_dump` with the plain-SQL dump written to a pipe instead of a file.
+    The caller is responsible for reading the process output and waiting for it to exit.
+
+    Parameters:
+    ConnectionUrl (str): The connection URL of the PostgreSQL database.
+    extra_args (list): Additional `pg_dump` arguments, such as `--data-only` or `-t <table>`.
+    tables (list): Only dump these tables. Defaults to the whole database.
+
+    Returns:
+    subprocess.Popen: The running `pg_dump` process, with the dump available on its stdout.
+    """
+    connection_details = parse_connection_url(ConnectionUrl)
+
+    # Pass the password through the environment to keep it out of the process list
+    env = os.environ.copy()
+    env["PGPASSWORD"] = connection_details["password"]
+
+    command = [
+        "pg_dump",
+        "-h",
+        connection_details["hostname"],
+        "-U",
+        connection_details["username"],
+        "-d",
+        connection_details["database_name"],
+    ]
+    if connection_details["port"]:
+        command += ["-p", str(connection_details["port"])]
+    command += extra_args or []
+    for table in tables or []:
+        command += ["-t", table]
+
+    return subprocess.Popen(command, stdout=subprocess.PIPE, env=env)
+
+
+def create_backup_postgres_directory(
+    ConnectionUrl, backup_directory, jobs=None, extra_args=None, tables=None
+):
+    """
+    This function creates a directory-format backup of a PostgreSQL database using `pg_dump -Fd`.
+    Tables are dumped (and compressed) in parallel by `jobs` worker processes, and the
+    result can be restored in parallel with `pg_restore -j`.
+
+    Parameters:
+    ConnectionUrl (str): The connection URL of the PostgreSQL database.
+    backup_directory (str): The directory to create for the backup. It must not exist yet.
+    jobs (int): The number of parallel dump jobs. Defaults to the number of available cores.
+    extra_args (list): Additional `pg_dump` arguments, such as `-T <table>`.
+    tables (list): Only dump these tables. Defaults to the whole database.
+
+    Returns:
+    str: The path of the backup directory if the backup is successful, False otherwise.
+    """
+    connection_details = parse_connection_url(ConnectionUrl)
+    jobs = jobs or os.cpu_count() or 1
+
+    # Add the password to the environment variables
+    # This is done to avoid exposing the password in the process list
+    env = os.environ.copy()
+    env["PGPASSWORD"] = connection_details["password"]
+
+    command = [
+        "pg_dump",
+        "-h",
+        connection_details["hostname"],
+        "-U",
+        connection_details["username"],
+        "-Fd",
+        "-j",
+        str(jobs),
+        "-f",
+        backup_directory,
+        "-d",
+        connection_details["database_name"],
+    ]
+    if connection_details["port"]:
+        command += ["-p", str(connection_details["port"])]
+    command += extra_args or []
+    for table in tables or []:
+        command += ["-t", table]
+
+    try:
+        result = subprocess.run(command, check=False, env=env)
+        if result.returncode != 0:
+            logging.error(
+                f"[create_backup_postgres_directory] Command failed with return code: {result.returncode}"
+            )
+            # pg_dump refuses to write into an existing directory, so clear it for a retry
+            shutil.rmtree(backup_directory, ignore_errors=True)
+            return False
+    except Exception as e:
+        logging.error(
+            f"[create_backup_postgres_directory] Unexpected error during backup: {str(e)}"
+        )
+        return False
+
+    if not os.path.isdir(backup_directory):
+        logging.error(
+            f"[create_backup_postgres_directory] Backup directory {backup_directory} does not exist."
+        )
+        return False
+
+    return backup_directory
+
+
+def run_query_postgres(ConnectionUrl, query):
+    """
+    This function runs a query with `psql` and returns the result rows.
+
+    Parameters:
+    ConnectionUrl (str): The connection URL of the PostgreSQL database.
+    query (str): The SQL query to run.
+
+    Returns:
+    list: The result rows, each a list of column values as strings.
+    """
+    connection_details = parse_connection_url(ConnectionUrl)
+
+    env = os.environ.copy()
+    env["PGPASSWORD"] = connection_details["password"]
+
+    command = [
+        "psql",
+        "-X",
+        "-q",
+        "-A",
+        "-t",
+        "-F",
+        "\t",
+        "-v",
+        "ON_ERROR_STOP=1",
+        "--single-transaction",
+        "-h",
+        connection_details["hostname"],
+        "-U",
+        connection_details["username"],
+        "-d",
+        connection_details["database_name"],
+        "-c",
+        query,
+    ]
+    if connection_details["port"]:
+        command += ["-p", str(connection_details["port"])]
+
+    result = subprocess.run(
+        command, check=True, env=env, stdout=subprocess.PIPE, text=True
+    )
+    return [line.split("\t") for line in result.stdout.splitlines() if line]
+
+
+def open_snapshot_postgres(ConnectionUrl):
+    """
+    This function opens a `psql` session holding a repeatable read transaction and
+    exports its snapshot, so other sessions can read the database as of the same
+    instant with `pg_dump --snapshot` or `SET TRANSACTION SNAPSHOT`.
+    The snapshot stays valid until the session ends: the caller writes `COMMIT` to
+    the process's stdin, closes it and waits for the process to exit.
+
+    Parameters:
+    ConnectionUrl (str): The connection URL of the PostgreSQL database.
+
+    Returns:
+    tuple: The running `psql` process, and the exported snapshot ID.
+    """
+    connection_details = parse_connection_url(ConnectionUrl)
+
+    env = os.environ.copy()
+    env["PGPASSWORD"] = connection_details["password"]
+
+    command = [
+        "psql",
+        "-X",
+        "-q",
+        "-A",
+        "-t",
+        "-v",
+        "ON_ERROR_STOP=1",
+        "-h",
+        connection_details["hostname"],
+        "-U",
+        connection_details["username"],
+        "-d",
+        connection_details["database_name"],
+    ]
+    if connection_details["port"]:
+        command += ["-p", str(connection_details["port"])]
+
+    process = subprocess.Popen(
+        command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env, text=True
+    )
+    process.stdin.write(
+        "BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY;\n"
+        "SELECT pg_export_snapshot();\n"
+    )
+    process.stdin.flush()
+    snapshot = process.stdout.readline().strip()
+    if not snapshot:
+        process.kill()
+        process.wait()
+        raise RuntimeError("Could not export a snapshot")
+    return process, snapshot
+
+
+def open_copy_stream_postgres(ConnectionUrl, query, snapshot=None):
+    """
+    This function starts `psql` running `COPY (<query>) TO STDOUT`, with the rows
+    written to a pipe in the text format of `COPY`.
+    The caller is responsible for reading the process output and waiting for it to exit.
+
+    Parameters:
+    ConnectionUrl (str): The connection URL of the PostgreSQL database.
+    query (str): The `SELECT` whose rows are copied.
+    snapshot (str): Read the rows as of this exported snapshot.
+
+    Returns:
+    subprocess.Popen: The running `psql` process, with the rows available on its stdout.
+    """
+    connection_details = parse_connection_url(ConnectionUrl)
+
+    env = os.environ.copy()
+    env["PGPASSWORD"] = connection_details["password"]
+
+    command = [
+        "psql",
+        "-X",
+        "-q",
+        "-v",
+        "ON_ERROR_STOP=1",
+        "-h",
+        connection_details["hostname"],
+        "-U",
+        connection_details["username"],
+        "-d",
+        connection_details["database_name"],
+    ]
+    if connection_details["port"]:
+        command += ["-p", str(connection_details["port"])]
+    if snapshot:
+        command += [
+            "-c",
+            "BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY",
+            "-c",
+            f"SET TRANSACTION SNAPSHOT '{snapshot}'",
+        ]
+    command += ["-c", f"COPY ({query}) TO STDOUT"]
+    if snapshot:
+        command += ["-c", "COMMIT"]
+
+    return subprocess.Popen(command, stdout=subprocess.PIPE, env=env)
+
+
+def open_copy_restore_postgres(ConnectionUrl, table, columns=None):
+    """
+    This function starts `psql` running `COPY <table> FROM STDIN`, reading rows in
+    the text format of `COPY` from its stdin.
+    The caller writes the rows to the process and closes stdin when done.
+
+    Parameters:
+    ConnectionUrl (str): The connection URL of the PostgreSQL database to restore into.
+    table (str): The quoted name of the table to load.
+    columns (list): The quoted names of the columns the rows hold. Defaults to
+    every column of the table.
+
+    Returns:
+    subprocess.Popen: The running `psql` process, with stdin=PIPE.
+    """
+    connection_details = parse_connection_url(ConnectionUrl)
+
+    env = os.environ.copy()
+    env["PGPASSWORD"] = connection_details["password"]
+
+    command = [
+        "psql",
+        "-X",
+        "-q",
+        "-v",
+        "ON_ERROR_STOP=1",
+        "-h",
+        connection_details["hostname"],
+        "-U",
+        connection_details["username"],
+        "-d",
+        connection_details["database_name"],
+        "-c",
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN"
+        if columns
+        else f"COPY {table} FROM STDIN",
+    ]
+    if connection_details["port"]:
+        command += ["-p", str(connection_details["port"])]
+
+    return subprocess.Popen(
+        command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, env=env
+    )
+
+
+def open_restore_stream_postgres(ConnectionUrl):
+    """
+    This function starts `psql` reading a plain-SQL dump from its stdin.
+    The caller writes the dump to the process and closes stdin when done.
+    The dump is replayed in a single transaction that stops at the first error,
+    so a failed or interrupted restore leaves the database untouched.
+
+    Parameters:
+    ConnectionUrl (str): The connection URL of the PostgreSQL database to restore into.
+
+    Returns:
+    subprocess.Popen: The running `psql` process, with stdin=PIPE.
+    """
+    connection_details = parse_connection_url(ConnectionUrl)
+
+    env = os.environ.copy()
+    env["PGPASSWORD"] = connection_details["password"]
+
+    command = [
+        "psql",
+        "-X",
+        "-q",
+        "-v",
+        "ON_ERROR_STOP=1",
+        "--single-transaction",
+        "-h",
+        connection_details["hostname"],
+        "-U",
+        connection_details["username"],
+        "-d",
+        connection_details["database_name"],
+    ]
+    if connection_details["port"]:
+        command += ["-p", str(connection_details["port"])]
+
+    return subprocess.Popen(
+        command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, env=env
+    )
+
+
+def restore_backup_postgres_directory(ConnectionUrl, backup_directory, jobs=None):
+    """
+    This function restores a directory-format backup with `pg_restore`, using
+    `jobs` parallel workers.
+
+    Parameters:
+    ConnectionUrl (str): The connection URL of the PostgreSQL database to restore into.
+    backup_directory (str): The path of the directory-format backup.
+    jobs (int): The number of parallel restore jobs. Defaults to the number of available cores.
+
+    Returns:
+    bool: True if the restore is successful, False otherwise.
+    """
+    connection_details = parse_connection_url(ConnectionUrl)
+    jobs = jobs or os.cpu_count() or 1
+
+    env = os.environ.copy()
+    env["PGPASSWORD"] = connection_details["password"]
+
+    command = [
+        "pg_restore",
+        "-h",
+        connection_details["hostname"],
+        "-U",
+        connection_details["username"],
+        "-d",
+        connection_details["database_name"],
+        "-j",
+        str(jobs),
+        "--no-owner",
+        "--exit-on-error",
+        backup_directory,
+    ]
+    if connection_details["port"]:
+        command[1:1] = ["-p", str(connection_details["port"])]
+
+    try:
+        result = subprocess.run(command, check=False, env=env)
+        if result.returncode != 0:
+            logging.error(
+                f"[restore_backup_postgres_directory] Command failed with return code: {result.returncode}"
+            )
+            return False
+    except Exception as e:
+        logging.error(
+            f"[restore_backup_postgres_directory] Unexpected error during restore: {str(e)}"
+        )
+        return False
+    return True
+
+
+def open_base_backup_postgres(ConnectionUrl):
+    """
+    This function starts `pg_basebackup` with a physical copy of the whole cluster
+    written to a pipe as a tar archive. No WAL is included: the copy can only be
+    brought to a consistent state by replaying the WAL archived from the time it
+    started, which is what point-in-time recovery does.
+
+    Parameters:
+    ConnectionUrl (str): The connection URL of the PostgreSQL database. The user
+    needs the REPLICATION attribute.
+
+    Returns:
+    subprocess.Popen: The running `pg_basebackup` process, with the archive available on its stdout.
+    """
+    connection_details = parse_connection_url(ConnectionUrl)
+
+    env = os.environ.copy()
+    env["PGPASSWORD"] = connection_details["password"]
+
+    command = [
+        "pg_basebackup",
+        "-h",
+        connection_details["hostname"],
+        "-U",
+        connection_details["username"],
+        "-D",
+        "-",
+        "-Ft",
+        "-X",
+        "none",
+        "-c",
+        "fast",
+    ]
+    if connection_details["port"]:
+        command += ["-p", str(connection_details["port"])]
+
+    return subprocess.Popen(command, stdout=subprocess.PIPE, env=env)
+
+
+def open_wal_receiver_postgres(ConnectionUrl, directory, slot):
+    """
+    This function starts `pg_receivewal` streaming the WAL of the cluster into a
+    directory, from a replication slot that is created if it does not exist yet.
+    The slot makes the server keep the WAL the receiver has not received, so it
+    can be restarted without a gap. Completed segments appear under their own
+    name, the one being written ends with `.partial`.
+
+    Parameters:
+    ConnectionUrl (str): The connection URL of the PostgreSQL database. The user
+    needs the REPLICATION attribute.
+    directory (str): The directory to write the WAL segments to.
+    slot (str): The name of the replication slot.
+
+    Returns:
+    subprocess.Popen: The running `pg_receivewal` process.
+    """
+    connection_details = parse_connection_url(ConnectionUrl)
+
+    env = os.environ.copy()
+    env["PGPASSWORD"] = connection_details["password"]
+
+    command = [
+        "pg_receivewal",
+        "-h",
+        connection_details["hostname"],
+        "-U",
+        connection_details["username"],
+        "--slot",
+        slot,
+    ]
+    if connection_details["port"]:
+        command += ["-p", str(connection_details["port"])]
+
+    subprocess.run(command + ["--create-slot", "--if-not-exists"], check=True, env=env)
+    return subprocess.Popen(command + ["-D", directory], env=env)
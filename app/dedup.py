@@ -0,0 +1,270 @@
+import collections
+import contextvars
+import hashlib
+import json
+import logging
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from . import metrics
+from .cache import cached_read
+from .compression import get_compressor, get_decompressor, get_extension
+
+CHUNK_PREFIX = "chunk_"
+MANIFEST_SUFFIX = ".manifest.json"
+
+# Chunks uploaded or reused by backups still running in this process, protected
+# from GC, with the number of backups using each
+_pending_chunks = collections.Counter()
+_pending_lock = threading.Lock()
+
+
+def iter_content_chunks(stream, average_size=1024 * 1024):
+    """
+    Splits a dump stream into content-defined chunks.
+    Boundaries are placed after lines whose CRC32 matches a mask, so they depend
+    on the content around them rather than on offsets. An insert early in the dump
+    only changes the chunks around it, and later chunks keep their hashes.
+    SQL dumps are line-oriented, so cutting on line ends keeps the hashing in C
+    (`split` and `crc32`) instead of a per-byte rolling hash in Python. Chunks are
+    at least a quarter and at most four times `average_size`, and lines longer
+    than the maximum are cut at the maximum.
+    Parameters:
+    stream (iterable): An iterable of bytes objects, the uncompressed dump.
+    average_size (int): The target average chunk size in bytes.
+    Yields:
+    bytes: The chunks, which concatenate back to the original stream.
+    """
+    min_size = average_size // 4
+    max_size = average_size * 4
+    # Assume ~128 byte lines, so one line in (average / 128) ends a chunk
+    mask = (1 << max(0, (average_size // 128).bit_length() - 1)) - 1
+
+    pending = []
+    pending_size = 0
+    remainder = b""
+    for data in stream:
+        lines = (remainder + data).split(b"\n")
+        remainder = lines.pop()
+        for line in lines:
+            line += b"\n"
+            while len(line) > max_size:
+                pending.append(line[: max_size - pending_size])
+                line = line[max_size - pending_size :]
+                yield b"".join(pending)
+                pending, pending_size = [], 0
+            pending.append(line)
+            pending_size += len(line)
+            if pending_size >= max_size or (
+                pending_size >= min_size and zlib.crc32(line) & mask == 0
+            ):
+                yield b"".join(pending)
+                pending, pending_size = [], 0
+    if remainder:
+        pending.append(remainder)
+    if pending:
+        yield b"".join(pending)
+
+
+def chunk_name(digest, codec):
+    return f"{CHUNK_PREFIX}{digest}{get_extension(codec)}"
+
+
+def store_stream(
+    destination,
+    stream,
+    manifest_name,
+    codec="gzip",
+    level=None,
+    average_size=1024 * 1024,
+    concurrency=4,
+    metadata=None,
+    rate_limiter=None,
+):
+    """
+    Stores a dump in the deduplicated store: the stream is split into
+    content-defined chunks, each chunk is identified by its SHA-256, and only the
+    chunks not already in the store are compressed and uploaded. The manifest,
+    listing the chunks in order, is written last, so a backup only becomes
+    visible once all of its chunks are stored. Reused chunks are checked again
+    before the manifest is written, since a GC on another dyno may have deleted
+    them while the dump ran, and the backup fails if one is gone.
+    Parameters:
+    destination (module): The destination module.
+    stream (iterable): An iterable of bytes objects, the uncompressed dump.
+    manifest_name (str): The name of the manifest to write.
+    codec (str): The codec chunks are compressed with.
+    level (int): The compression level.
+    average_size (int): The target average chunk size in bytes.
+    concurrency (int): The number of chunks uploaded in parallel.
+    metadata (dict): Extra fields to record in the manifest.
+    rate_limiter (TokenBucket): Limits the rate compressed chunks are uploaded at.
+    Returns:
+    dict: The manifest, including the number of new and reused chunks.
+    """
+    existing = set(destination.fetch_destination_filelist(prefix=CHUNK_PREFIX))
+    slots = threading.BoundedSemaphore(concurrency)
+    # The chunks this backup uploads or reuses, protected from GC in this process
+    protected = set()
+    reused = set()
+    chunks = []
+    new_chunks = 0
+    total_size = 0
+
+    def upload(name, data):
+        try:
+            compressor = get_compressor(codec, level)
+            compressed = compressor.compress(data) + compressor.flush()
+            metrics.count("bytes_compressed", len(compressed))
+            if rate_limiter is not None:
+                metrics.add_time("throttle", rate_limiter.consume(len(compressed)))
+            if not destination.upload_to_destination(name, compressed):
+                raise RuntimeError(f"Upload of chunk {name} failed")
+        finally:
+            slots.release()
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = []
+            for data in iter_content_chunks(stream, average_size):
+                digest = hashlib.sha256(data).hexdigest()
+                name = chunk_name(digest, codec)
+                chunks.append([digest, len(data)])
+                total_size += len(data)
+                if name in protected:
+                    continue
+                with _pending_lock:
+                    _pending_chunks[name] += 1
+                protected.add(name)
+                if name in existing:
+                    reused.add(name)
+                    continue
+                new_chunks += 1
+                slots.acquire()
+                # Each task gets a copy of the context, which carries the Flask app
+                futures.append(
+                    executor.submit(contextvars.copy_context().run, upload, name, data)
+                )
+            for future in futures:
+                future.result()
+
+        if reused:
+            missing = reused.difference(
+                destination.fetch_destination_filelist(prefix=CHUNK_PREFIX)
+            )
+            if missing:
+                raise RuntimeError(
+                    f"{len(missing)} reused chunks were deleted during the backup"
+                )
+
+        manifest = dict(metadata or {})
+        manifest.update(
+            {
+                "codec": codec,
+                "created": datetime.now().strftime("%Y%m%d%H%M%S"),
+                "size": total_size,
+                "new_chunks": new_chunks,
+                "reused_chunks": len(chunks) - new_chunks,
+                "chunks": chunks,
+            }
+        )
+        if not destination.upload_to_destination(
+            manifest_name, json.dumps(manifest).encode()
+        ):
+            raise RuntimeError(f"Upload of manifest {manifest_name} failed")
+        logging.info(
+            f"[store_stream] Stored {manifest_name}: {len(chunks)} chunks, {new_chunks} new"
+        )
+        return manifest
+    finally:
+        with _pending_lock:
+            _pending_chunks.subtract(protected)
+            for name in protected:
+                if _pending_chunks[name] <= 0:
+                    del _pending_chunks[name]
+
+
+def iter_manifest_data(destination, manifest, prefetch=4):
+    """
+    Rebuilds a dump from its manifest, downloading and decompressing the chunks
+    in order. Up to `prefetch` chunks are downloaded ahead in parallel.
+    Parameters:
+    destination (module): The destination module.
+    manifest (dict): The backup manifest.
+    prefetch (int): The number of chunks downloaded ahead.
+    Yields:
+    bytes: The uncompressed dump, chunk by chunk.
+    """
+
+    def fetch(entry):
+        digest, size = entry
+        name = chunk_name(digest, manifest["codec"])
+        # Chunks are named after their content, so a cached copy is never stale
+        content = cached_read(destination, name, immutable=True)
+        if content is None:
+            raise RuntimeError(f"Missing chunk {name}")
+        data = get_decompressor(name).decompress(content)
+        if hashlib.sha256(data).hexdigest() != digest or len(data) != size:
+            raise RuntimeError(f"Corrupted chunk {name}")
+        return data
+
+    with ThreadPoolExecutor(max_workers=prefetch) as executor:
+        window = collections.deque()
+        for entry in manifest["chunks"]:
+            # Each task gets a copy of the context, which carries the Flask app
+            window.append(executor.submit(contextvars.copy_context().run, fetch, entry))
+            if len(window) >= prefetch:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
+
+
+def collect_garbage(destination, grace_period=24):
+    """
+    Deletes the chunks that no manifest references anymore. References are
+    rebuilt from every manifest in the store, so they can never drift from the
+    manifests themselves. Chunks used by backups still running in this process
+    are kept, and so are chunks modified within the grace period, which may
+    belong to a backup running on another dyno whose manifest is not written yet.
+    Parameters:
+    destination (module): The destination module.
+    grace_period (int): The age in hours under which chunks are never deleted.
+    Returns:
+    tuple: The list of deleted chunks and a dict of per-chunk errors.
+    """
+    file_list = destination.fetch_destination_filelist()
+    references = set()
+    for file_name in file_list:
+        if not file_name.endswith(MANIFEST_SUFFIX):
+            continue
+        content = destination.read_from_destination(file_name)
+        if content is None:
+            # Deleting chunks based on a partial view would lose data
+            raise RuntimeError(f"Could not read manifest {file_name}")
+        manifest = json.loads(content)
+        for digest, _ in manifest["chunks"]:
+            references.add(chunk_name(digest, manifest["codec"]))
+
+    with _pending_lock:
+        unreferenced = [
+            file_name
+            for file_name in file_list
+            if file_name.startswith(CHUNK_PREFIX)
+            and file_name not in references
+            and file_name not in _pending_chunks
+        ]
+    if not unreferenced:
+        return [], {}
+    # Chunks without a date, deleted since they were listed, are left alone
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=grace_period)
+    dates = destination.fetch_destination_file_dates(prefix=CHUNK_PREFIX)
+    unreferenced = [
+        file_name
+        for file_name in unreferenced
+        if file_name in dates and dates[file_name] < cutoff
+    ]
+    if not unreferenced:
+        return [], {}
+    logging.info(f"[collect_garbage] Deleting {len(unreferenced)} unreferenced chunks")
+    return destination.delete_files_from_destination(unreferenced)
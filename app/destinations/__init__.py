@@ -1,3 +1,8 @@
+import functools
+import inspect
+import os
+import threading
+from . import s3, ftp, settings
 from .s3 import (
     download_from_destination as download_from_s3,
     upload_to_destination as upload_to_s3,
@@ -5,4 +10,137 @@ from .s3 import (
 from .ftp import (
     download_from_destination as download_from_ftp,
     upload_to_destination as upload_to_ftp,
-)
\ No newline at end of file
+)
+
+# Map the UPLOAD_DESTINATION config var to the module that implements it
+DESTINATIONS = {"S3": s3, "FTP": ftp}
+
+# The settings a fan-out target can set for itself, per destination kind.
+# `AWS_S3_BUCKET_S3_EU` is the bucket of the target S3_EU, for instance.
+TARGET_SETTINGS = {
+    "S3": (
+        "AWS_ACCESS_KEY_ID",
+        "AWS_SECRET_ACCESS_KEY",
+        "AWS_S3_BUCKET",
+        "AWS_S3_REGION",
+    ),
+    "FTP": ("FTP_HOSTNAME", "FTP_PORT", "FTP_USER", "FTP_PASS"),
+}
+
+_active_sessions = 0
+_sessions_lock = threading.Lock()
+
+
+def destination_session(function):
+    """
+    Decorates a job so the pooled destination connections it opens are reused for
+    its whole lifetime, then closed once no other job is still running.
+    """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        global _active_sessions
+        with _sessions_lock:
+            _active_sessions += 1
+        try:
+            return function(*args, **kwargs)
+        finally:
+            with _sessions_lock:
+                _active_sessions -= 1
+                if _active_sessions == 0:
+                    for destination in DESTINATIONS.values():
+                        destination.close_connections()
+
+    return wrapper
+
+
+class DestinationTarget:
+    """
+    A destination module bound to the settings of one target, so the same
+    module can write to several buckets or servers. Every function of the
+    module is available on the target and runs with its settings.
+    Parameters:
+    name (str): The name of the target, such as `S3` or `S3_EU`.
+    kind (str): The destination kind, a key of DESTINATIONS.
+    overrides (dict): The settings that differ from the app config.
+    """
+
+    def __init__(self, name, kind, overrides=None):
+        self.name = name
+        self.kind = kind
+        self.module = DESTINATIONS[kind]
+        self.overrides = overrides or {}
+
+    def __repr__(self):
+        return f"DestinationTarget({self.name!r})"
+
+    def __getattr__(self, attribute):
+        function = getattr(self.module, attribute)
+        if not callable(function) or not self.overrides:
+            return function
+
+        if inspect.isgeneratorfunction(function):
+            # The settings must also hold while the generator runs
+            @functools.wraps(function)
+            def stream(*args, **kwargs):
+                with settings.overridden(self.overrides):
+                    items = function(*args, **kwargs)
+                while True:
+                    with settings.overridden(self.overrides):
+                        try:
+                            item = next(items)
+                        except StopIteration:
+                            return
+                    yield item
+
+            return stream
+
+        @functools.wraps(function)
+        def call(*args, **kwargs):
+            with settings.overridden(self.overrides):
+                return function(*args, **kwargs)
+
+        return call
+
+
+def _target_overrides(name, kind):
+    overrides = {}
+    for setting in TARGET_SETTINGS[kind]:
+        value = os.getenv(f"{setting}_{name}")
+        if value:
+            overrides[setting] = int(value) if setting == "FTP_PORT" else value
+    return overrides
+
+
+def primary_target(config):
+    """
+    Returns:
+    DestinationTarget: The target of UPLOAD_DESTINATION, with the app settings.
+    """
+    return DestinationTarget(config["UPLOAD_DESTINATION"], config["UPLOAD_DESTINATION"])
+
+
+def upload_targets(config):
+    """
+    Lists the destinations every backup is written to: UPLOAD_DESTINATION,
+    then the targets of FANOUT_DESTINATIONS, such as `S3_EU,FTP_OFFSITE`.
+    The kind of a fan-out target is the part of its name before the first
+    underscore, and its settings are read from `<SETTING>_<NAME>` config vars,
+    falling back to the ones of UPLOAD_DESTINATION.
+    Returns:
+    list: The DestinationTarget objects, UPLOAD_DESTINATION first.
+    Raises:
+    ValueError: If a target name is repeated or of an unknown kind.
+    """
+    targets = [primary_target(config)]
+    for name in filter(
+        None,
+        (part.strip() for part in (config["FANOUT_DESTINATIONS"] or "").split(",")),
+    ):
+        kind = name.split("_", 1)[0].upper()
+        if kind not in DESTINATIONS:
+            raise ValueError(f"Unknown kind of fan-out destination: {name}")
+        if name in (target.name for target in targets):
+            raise ValueError(f"Repeated fan-out destination: {name}")
+        targets.append(DestinationTarget(name, kind, _target_overrides(name, kind)))
+    return targets
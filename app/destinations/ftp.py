@@ -1,6 +1,117 @@
+import hashlib
+import io
 import logging
-from ftplib import FTP
-from flask import current_app
+import queue
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from ftplib import FTP, all_errors, error_reply, error_temp, error_perm
+from . import settings
+from ..util import ChunkedStreamReader
+from .. import metrics
+
+
+class FTPConnectionPool:
+    """
+    A pool of logged-in FTP connections that are reused across operations, so a
+    job pays the TCP + auth handshake once per connection instead of once per file.
+    A connection is handed to one caller at a time, since `ftplib.FTP` is not
+    thread-safe, and at most `size` connections are open at once.
+    """
+
+    def __init__(self, hostname, port, user, password, size=4):
+        self.hostname = hostname
+        self.port = port
+        self.user = user
+        self.password = password
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        ftp = FTP()
+        ftp.connect(self.hostname, self.port)
+        ftp.login(user=self.user, passwd=self.password)
+        return ftp
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection from the pool, opening a new one if none is idle.
+        A connection that raises while in use is closed rather than returned.
+        """
+        self._slots.acquire()
+        ftp = None
+        try:
+            while ftp is None:
+                try:
+                    ftp = self._idle.get_nowait()
+                except queue.Empty:
+                    ftp = self._connect()
+                    break
+                try:
+                    # The server may have dropped an idle connection
+                    ftp.voidcmd("NOOP")
+                except all_errors:
+                    ftp.close()
+                    ftp = None
+            yield ftp
+        except BaseException:
+            if ftp is not None:
+                ftp.close()
+            ftp = None
+            raise
+        finally:
+            if ftp is not None:
+                self._idle.put(ftp)
+            self._slots.release()
+
+    def close(self):
+        """
+        Closes every idle connection in the pool.
+        """
+        while True:
+            try:
+                ftp = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                ftp.quit()
+            except all_errors:
+                ftp.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns the connection pool for the configured FTP server, creating it on first use.
+    Returns:
+    FTPConnectionPool: The shared connection pool.
+    """
+    config = settings.config()
+    key = (config["FTP_HOSTNAME"], config["FTP_PORT"], config["FTP_USER"])
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = FTPConnectionPool(
+                config["FTP_HOSTNAME"],
+                config["FTP_PORT"],
+                config["FTP_USER"],
+                config["FTP_PASS"],
+                config["FTP_POOL_SIZE"],
+            )
+        return _pools[key]
+
+
+def close_connections():
+    """
+    This function closes the idle connections of every FTP pool, at the end of a job.
+    """
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
 
 
 def download_from_destination(file_name):
@@ -11,14 +122,9 @@ def download_from_destination(file_name):
     Returns:
     bool: True if file download is successful, False otherwise.
     """
-    ftp = FTP(current_app.config["FTP_HOSTNAME"])
-    ftp.login(
-        user=current_app.config["FTP_USER"], passwd=current_app.config["FTP_PASS"]
-    )
     try:
-        with open(file_name, "wb") as file:
+        with get_pool().connection() as ftp, open(file_name, "wb") as file:
             ftp.retrbinary("RETR " + file_name, file.write)
-        ftp.quit()
         return True
     except Exception as e:
         # Log the error message for debugging purposes
@@ -26,9 +132,115 @@ def download_from_destination(file_name):
             f"[download_from_destination] Error downloading file from FTP: {str(e)}"
         )
         return False
-    finally:
-        if ftp:
-            ftp.close()
+
+
+def download_stream_from_destination(file_name, chunk_size=1024 * 1024, offset=0):
+    """
+    This function streams a file from an FTP server in chunks, without writing it to disk.
+    Parameters:
+    file_name (str): The name of the file to be downloaded.
+    chunk_size (int): The maximum size of the chunks to yield.
+    offset (int): The position in the file to start from, sent with `REST`.
+    Yields:
+    bytes: The content of the file, chunk by chunk.
+    """
+    with get_pool().connection() as ftp:
+        ftp.voidcmd("TYPE I")
+        with ftp.transfercmd("RETR " + file_name, offset or None) as connection:
+            while True:
+                chunk = connection.recv(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        ftp.voidresp()
+
+
+def read_from_destination(file_name):
+    """
+    This function reads a small file, such as a manifest, from an FTP server into memory.
+    Parameters:
+    file_name (str): The name of the file to be read.
+    Returns:
+    bytes: The content of the file, or None if it does not exist or cannot be read.
+    """
+    buffer = io.BytesIO()
+    try:
+        with get_pool().connection() as ftp:
+            ftp.retrbinary("RETR " + file_name, buffer.write)
+        return buffer.getvalue()
+    except error_perm:
+        return None
+    except Exception as e:
+        logging.error(f"[read_from_destination] Error reading file from FTP: {str(e)}")
+        return None
+
+
+def read_versioned_from_destination(file_name):
+    """
+    This function reads a small file from an FTP server together with its
+    version, a hash of its content, for a later `write_versioned_to_destination`.
+    Parameters:
+    file_name (str): The name of the file to be read.
+    Returns:
+    tuple: The content of the file and its version, or (None, None) if it does not exist.
+    Raises:
+    ftplib.Error: If the file exists but cannot be read.
+    """
+    buffer = io.BytesIO()
+    try:
+        with get_pool().connection() as ftp:
+            ftp.retrbinary("RETR " + file_name, buffer.write)
+    except error_perm as e:
+        if str(e).startswith("550"):
+            return None, None
+        raise
+    content = buffer.getvalue()
+    return content, hashlib.sha256(content).hexdigest()
+
+
+def write_versioned_to_destination(file_name, file_content, version):
+    """
+    This function writes a small file to an FTP server only if it has not
+    changed since it was read. FTP has no conditional writes, so the check and
+    the write are not one operation: the version is checked again just before
+    the write, and the file is uploaded under a temporary name then renamed over
+    the old one, so readers never see a partial file.
+    Parameters:
+    file_name (str): The name of the file to be written.
+    file_content (bytes): The new content of the file.
+    version (str): The version returned by `read_versioned_from_destination`,
+    or None if the file did not exist.
+    Returns:
+    bool: True if the file was written, False if it changed in the meantime.
+    """
+    if read_versioned_from_destination(file_name)[1] != version:
+        return False
+    temporary_name = f"{file_name}.{uuid.uuid4().hex}.tmp"
+    with get_pool().connection() as ftp:
+        ftp.storbinary("STOR " + temporary_name, io.BytesIO(file_content))
+        try:
+            ftp.rename(temporary_name, file_name)
+        except all_errors:
+            ftp.delete(temporary_name)
+            raise
+    return True
+
+
+def _check_size(ftp, file_name, expected):
+    """
+    Checks that the server stored every byte sent, since FTP has no checksums.
+    """
+    try:
+        size = ftp.size(file_name)
+    except error_perm as e:
+        # Not every server implements SIZE
+        if str(e)[:3] in ("500", "502"):
+            return
+        raise
+    if size is not None and size != expected:
+        raise error_reply(
+            f"{file_name} is {size} bytes on the server, {expected} bytes were sent"
+        )
 
 
 def upload_to_destination(file_name, file_content):
@@ -40,44 +252,235 @@ def upload_to_destination(file_name, file_content):
     Returns:
     bool: True if file upload is successful, False otherwise.
     """
-    ftp = FTP(current_app.config["FTP_HOSTNAME"])
-    ftp.login(
-        user=current_app.config["FTP_USER"], passwd=current_app.config["FTP_PASS"]
-    )
     try:
-        with open(file_name, "rb") as file:
-            ftp.storbinary("STOR " + file_name, file)
-        ftp.quit()
+        with get_pool().connection() as ftp:
+            ftp.storbinary("STOR " + file_name, io.BytesIO(file_content))
+            _check_size(ftp, file_name, len(file_content))
         return True
     except Exception as e:
         # Log the error message for debugging purposes
         logging.error(f"[upload_to_destination] Error uploading file to FTP: {str(e)}")
         return False
-    finally:
-        if ftp:
-            ftp.close()
 
 
-def fetch_destination_filelist():
+def upload_stream_to_destination(file_name, chunks, journal=None):
+    """
+    This function uploads a stream of byte chunks to an FTP server.
+    The data is sent as it is produced, so nothing is staged on disk.
+    A partially written file is removed if the upload fails.
+    Parameters:
+    file_name (str): The name of the file to be uploaded.
+    chunks (iterable): An iterable of bytes objects making up the file content.
+    journal (UploadJournal): Makes the upload resumable, see `resumable_upload`.
+    Returns:
+    bool: True if file upload is successful, False otherwise.
+    """
+    if journal is not None:
+        try:
+            resumable_upload(file_name, chunks, journal)
+            return True
+        except Exception as e:
+            logging.error(
+                f"[upload_stream_to_destination] Error uploading stream to FTP, keeping the partial file to resume it: {str(e)}"
+            )
+            return False
+    pool = get_pool()
+    sent = [0]
+
+    def count(chunks):
+        for chunk in chunks:
+            sent[0] += len(chunk)
+            yield chunk
+
+    try:
+        with pool.connection() as ftp:
+            ftp.storbinary(
+                "STOR " + file_name,
+                ChunkedStreamReader(count(chunks)),
+                blocksize=settings.config()["STREAM_CHUNK_SIZE"],
+            )
+            _check_size(ftp, file_name, sent[0])
+        return True
+    except Exception as e:
+        logging.error(
+            f"[upload_stream_to_destination] Error uploading stream to FTP: {str(e)}"
+        )
+        try:
+            with pool.connection() as ftp:
+                ftp.delete(file_name)
+        except Exception:
+            pass
+        return False
+
+
+# Resumable uploads are written to `<name>.partial`, then renamed once complete
+PARTIAL_SUFFIX = ".partial"
+
+
+def _segments(chunks, segment_size):
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= segment_size:
+            yield bytes(buffer[:segment_size])
+            del buffer[:segment_size]
+    if buffer:
+        yield bytes(buffer)
+
+
+def resumable_upload(file_name, chunks, journal):
+    """
+    This function uploads a stream to an FTP server in segments of FTP_SEGMENT_SIZE
+    bytes, appended with APPE to a partial file that is renamed once complete.
+    The SHA-256 of every segment is journaled once the server has stored it.
+    A later run continues the journaled partial file: the leading segments of
+    its stream that match the journal are skipped, and the file is overwritten
+    from the first segment that differs, with REST and STOR.
+    Parameters:
+    file_name (str): The name of the file to be uploaded.
+    chunks (iterable): An iterable of bytes objects making up the file content.
+    journal (UploadJournal): Where the state of the upload is kept.
+    Raises:
+    RuntimeError: If the partial file does not end up with the size of the stream.
+    """
+    segment_size = settings.config()["FTP_SEGMENT_SIZE"]
+    partial_name = file_name + PARTIAL_SUFFIX
+    with get_pool().connection() as ftp:
+        ftp.voidcmd("TYPE I")
+        recorded = {}
+        stored_size = None
+        if (
+            journal.state.get("file") == file_name
+            and journal.state.get("segment_size") == segment_size
+        ):
+            recorded = journal.parts()
+            try:
+                stored_size = ftp.size(partial_name)
+            except error_perm:
+                recorded = {}
+        if recorded and stored_size is not None:
+            logging.info(
+                f"[resumable_upload] Resuming {partial_name} with {stored_size} bytes stored"
+            )
+        else:
+            journal.save(segment_size=segment_size, parts={})
+
+        offset = 0
+        diverged = False
+        for index, segment in enumerate(_segments(chunks, segment_size)):
+            sha256 = hashlib.sha256(segment).hexdigest()
+            previous = recorded.get(str(index))
+            if (
+                not diverged
+                and previous
+                and previous["sha256"] == sha256
+                and offset + len(segment) <= stored_size
+            ):
+                # The server already holds this segment from the interrupted run
+                metrics.count("parts_reused")
+            elif not diverged:
+                diverged = True
+                journal.save(
+                    parts={
+                        number: part
+                        for number, part in recorded.items()
+                        if int(number) < index
+                    }
+                )
+                ftp.storbinary(
+                    "STOR " + partial_name, io.BytesIO(segment), rest=offset or None
+                )
+            else:
+                ftp.storbinary("APPE " + partial_name, io.BytesIO(segment))
+            if diverged:
+                journal.add_part(index, {"sha256": sha256, "size": len(segment)})
+            offset += len(segment)
+        if offset == 0:
+            ftp.storbinary("STOR " + partial_name, io.BytesIO(b""))
+
+        # REST and STOR may not truncate what the interrupted run wrote past the
+        # point it was overwritten from
+        if ftp.size(partial_name) != offset:
+            ftp.delete(partial_name)
+            journal.clear()
+            raise RuntimeError(
+                f"{partial_name} does not have the size of the stream, starting over"
+            )
+        ftp.rename(partial_name, file_name)
+    journal.clear()
+
+
+def stat_destination_file(file_name):
+    """
+    This function fetches the size of a file stored on an FTP server, the only
+    integrity information FTP offers.
+    Parameters:
+    file_name (str): The name of the file.
+    Returns:
+    dict: The size of the file, or None if the file does not exist.
+    """
+    with get_pool().connection() as ftp:
+        ftp.voidcmd("TYPE I")
+        try:
+            return {"size": ftp.size(file_name)}
+        except error_perm as e:
+            if str(e).startswith("550"):
+                return None
+            raise
+
+
+def fetch_destination_filelist(prefix=None):
     """
     This function fetches a list of all files from an FTP server.
+    Parameters:
+    prefix (str): Only return the files whose name starts with this prefix.
     Returns:
     list: A list of all file names.
     """
-    ftp = FTP(current_app.config["FTP_HOSTNAME"])
-    ftp.login(
-        user=current_app.config["FTP_USER"], passwd=current_app.config["FTP_PASS"]
-    )
     try:
-        return ftp.nlst()
+        with get_pool().connection() as ftp:
+            file_names = ftp.nlst()
     except Exception as e:
         logging.error(
             f"[fetch_destination_filelist] Error fetching file list from FTP: {str(e)}"
         )
         return []
-    finally:
-        if ftp:
-            ftp.close()
+    if prefix:
+        file_names = [name for name in file_names if name.startswith(prefix)]
+    return file_names
+
+
+def _parse_ftp_time(value):
+    # MLSD and MDTM times are UTC, with optional fractions of a second
+    return datetime.strptime(value[:14], "%Y%m%d%H%M%S").replace(tzinfo=timezone.utc)
+
+
+def fetch_destination_file_dates(prefix=None):
+    """
+    This function fetches the last modification time of all files from an FTP
+    server, with MLSD, or with MDTM for each file on servers without it.
+    Parameters:
+    prefix (str): Only return the files whose name starts with this prefix.
+    Returns:
+    dict: The last modification time, a timezone-aware datetime, of each file.
+    """
+    with get_pool().connection() as ftp:
+        try:
+            dates = {
+                name: _parse_ftp_time(facts["modify"])
+                for name, facts in ftp.mlsd(facts=["type", "modify"])
+                if facts.get("type", "file") == "file" and "modify" in facts
+            }
+        except error_perm:
+            dates = {}
+            for name in ftp.nlst():
+                if prefix and not name.startswith(prefix):
+                    continue
+                response = ftp.sendcmd(f"MDTM {name}")
+                dates[name] = _parse_ftp_time(response.split()[-1])
+    if prefix:
+        dates = {name: date for name, date in dates.items() if name.startswith(prefix)}
+    return dates
 
 
 def delete_file_from_destination(file_name):
@@ -86,16 +489,52 @@ def delete_file_from_destination(file_name):
     Parameters:
     file_name (str): The name of the file to be deleted.
     """
-    ftp = FTP(current_app.config["FTP_HOSTNAME"])
-    ftp.login(
-        user=current_app.config["FTP_USER"], passwd=current_app.config["FTP_PASS"]
-    )
     try:
-        ftp.delete(file_name)
+        with get_pool().connection() as ftp:
+            ftp.delete(file_name)
     except Exception as e:
         logging.error(
             f"[delete_file_from_destination] Error deleting file from FTP: {str(e)}"
         )
-    finally:
-        if ftp:
-            ftp.close()
+
+
+# DELE commands sent ahead of their replies, small enough not to fill socket buffers
+DELETE_PIPELINE_DEPTH = 32
+
+
+def delete_files_from_destination(file_names):
+    """
+    This function deletes many files from an FTP server over a single session.
+    DELE commands are pipelined: a window of them is sent before the replies are
+    read, so the deletes are not serialised on the network round trip.
+    Parameters:
+    file_names (list): The names of the files to be deleted.
+    Returns:
+    tuple: The list of deleted file names, and a dict mapping each file that
+    could not be deleted to the error reported for it.
+    """
+    deleted = []
+    failed = {}
+    try:
+        with get_pool().connection() as ftp:
+            for offset in range(0, len(file_names), DELETE_PIPELINE_DEPTH):
+                window = file_names[offset : offset + DELETE_PIPELINE_DEPTH]
+                for file_name in window:
+                    ftp.putcmd("DELE " + file_name)
+                # Replies come back in the order the commands were sent
+                for file_name in window:
+                    try:
+                        response = ftp.getresp()
+                        if not response.startswith("2"):
+                            raise error_reply(response)
+                        deleted.append(file_name)
+                    except (error_reply, error_temp, error_perm) as e:
+                        failed[file_name] = str(e)
+    except Exception as e:
+        logging.error(
+            f"[delete_files_from_destination] Error deleting files from FTP: {str(e)}"
+        )
+        for file_name in file_names:
+            if file_name not in failed and file_name not in deleted:
+                failed[file_name] = str(e)
+    return deleted, failed
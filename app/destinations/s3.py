@@ -1,7 +1,77 @@
 import boto3
-from botocore.exceptions import NoCredentialsError
-from flask import current_app
+from botocore.config import Config
+from botocore.exceptions import ClientError, NoCredentialsError
+from . import settings
+import base64
+import contextvars
+import hashlib
 import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from .. import metrics
+
+# S3 rejects non-final multipart parts smaller than this
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def multipart_checksum(digests):
+    """
+    Computes the SHA-256 checksum S3 reports for a multipart object: the
+    checksum of the concatenated SHA-256 digests of its parts.
+    Parameters:
+    digests (list): The raw SHA-256 digest of each part, in order.
+    Returns:
+    str: The base64 checksum, without the `-<parts>` suffix.
+    """
+    return base64.b64encode(hashlib.sha256(b"".join(digests)).digest()).decode()
+
+
+def multipart_etag(digests):
+    """
+    Computes the ETag S3 gives a multipart object that is not encrypted with
+    KMS, from the raw MD5 digest of each of its parts.
+    """
+    return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+
+
+def get_client():
+    """
+    Returns the S3 client for the configured region and credentials, creating it on first use.
+    boto3 clients are thread-safe and keep their HTTPS connections alive, so one
+    shared client avoids a TCP + TLS handshake per operation. Its connection pool
+    is sized for the multipart upload concurrency.
+    Returns:
+    botocore.client.S3: The shared S3 client.
+    """
+    config = settings.config()
+    region = config["AWS_S3_REGION"]
+    pool_size = max(config["S3_MULTIPART_CONCURRENCY"], 10)
+    # Fan-out targets may use other credentials, unset ones use the default chain
+    key = (region, pool_size, config["AWS_ACCESS_KEY_ID"])
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = boto3.client(
+                "s3",
+                region_name=region,
+                aws_access_key_id=config["AWS_ACCESS_KEY_ID"],
+                aws_secret_access_key=config["AWS_SECRET_ACCESS_KEY"],
+                config=Config(max_pool_connections=pool_size),
+            )
+        return _clients[key]
+
+
+def close_connections():
+    """
+    This function drops the cached S3 clients, closing their connections.
+    """
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
 
 
 def download_from_destination(file_name):
@@ -12,9 +82,9 @@ def download_from_destination(file_name):
     Returns:
     bool: True if file download is successful, False otherwise.
     """
-    s3 = boto3.client("s3", region_name=current_app.config["AWS_S3_REGION"])
+    s3 = get_client()
     try:
-        s3.download_file(current_app.config["AWS_S3_BUCKET"], file_name, file_name)
+        s3.download_file(settings.config()["AWS_S3_BUCKET"], file_name, file_name)
         return True
     except NoCredentialsError:
         logging.error(
@@ -28,6 +98,105 @@ def download_from_destination(file_name):
         return False
 
 
+def download_stream_from_destination(file_name, chunk_size=1024 * 1024, offset=0):
+    """
+    This function streams a file from S3 in chunks, without writing it to disk.
+    Parameters:
+    file_name (str): The name of the file to be downloaded.
+    chunk_size (int): The size of the chunks to yield.
+    offset (int): The position in the file to start from.
+    Yields:
+    bytes: The content of the file, chunk by chunk.
+    """
+    kwargs = {"Range": f"bytes={offset}-"} if offset else {}
+    response = get_client().get_object(
+        Bucket=settings.config()["AWS_S3_BUCKET"], Key=file_name, **kwargs
+    )
+    body = response["Body"]
+    try:
+        yield from body.iter_chunks(chunk_size)
+    finally:
+        body.close()
+
+
+def read_from_destination(file_name):
+    """
+    This function reads a small file, such as a manifest, from S3 into memory.
+    Parameters:
+    file_name (str): The name of the file to be read.
+    Returns:
+    bytes: The content of the file, or None if it does not exist or cannot be read.
+    """
+    try:
+        return (
+            get_client()
+            .get_object(Bucket=settings.config()["AWS_S3_BUCKET"], Key=file_name)[
+                "Body"
+            ]
+            .read()
+        )
+    except get_client().exceptions.NoSuchKey:
+        return None
+    except Exception as e:
+        logging.error(
+            f"[read_from_destination] An error occurred while reading the file: {str(e)}"
+        )
+        return None
+
+
+def read_versioned_from_destination(file_name):
+    """
+    This function reads a small file from S3 together with its version, for a
+    later `write_versioned_to_destination`.
+    Parameters:
+    file_name (str): The name of the file to be read.
+    Returns:
+    tuple: The content of the file and its ETag, or (None, None) if it does not exist.
+    Raises:
+    botocore.exceptions.ClientError: If the file exists but cannot be read.
+    """
+    s3 = get_client()
+    try:
+        response = s3.get_object(
+            Bucket=settings.config()["AWS_S3_BUCKET"], Key=file_name
+        )
+    except s3.exceptions.NoSuchKey:
+        return None, None
+    return response["Body"].read(), response["ETag"]
+
+
+def write_versioned_to_destination(file_name, file_content, version):
+    """
+    This function writes a small file to S3 only if it has not changed since it
+    was read, using a conditional PUT, so concurrent read-modify-write cycles
+    cannot overwrite each other.
+    Parameters:
+    file_name (str): The name of the file to be written.
+    file_content (bytes): The new content of the file.
+    version (str): The ETag returned by `read_versioned_from_destination`, or
+    None if the file did not exist.
+    Returns:
+    bool: True if the file was written, False if it changed in the meantime.
+    """
+    s3 = get_client()
+    condition = {"IfMatch": version} if version else {"IfNoneMatch": "*"}
+    try:
+        s3.put_object(
+            Bucket=settings.config()["AWS_S3_BUCKET"],
+            Key=file_name,
+            Body=file_content,
+            **condition,
+        )
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] in (
+            "PreconditionFailed",
+            "ConditionalRequestConflict",
+        ):
+            return False
+        raise
+
+
 def upload_to_destination(file_name, file_content):
     """
     This function uploads a file to S3.
@@ -37,10 +206,18 @@ def upload_to_destination(file_name, file_content):
     Returns:
     bool: True if file upload is successful, False otherwise.
     """
-    s3 = boto3.client("s3", region_name=current_app.config["AWS_S3_REGION"])
+    s3 = get_client()
     try:
+        if len(file_content) > settings.config()["S3_MULTIPART_PART_SIZE"]:
+            return upload_stream_to_destination(file_name, [file_content])
+        digest = hashlib.sha256(file_content)
+        # S3 rejects the upload if the content it received has another checksum
         s3.put_object(
-            Body=file_content, Bucket=current_app.config["AWS_S3_BUCKET"], Key=file_name
+            Body=file_content,
+            Bucket=settings.config()["AWS_S3_BUCKET"],
+            Key=file_name,
+            ChecksumSHA256=base64.b64encode(digest.digest()).decode(),
+            Metadata={"sha256": digest.hexdigest()},
         )
         return True
     except NoCredentialsError:
@@ -55,19 +232,332 @@ def upload_to_destination(file_name, file_content):
         return False
 
 
-def fetch_destination_filelist():
+def upload_stream_to_destination(file_name, chunks, journal=None):
+    """
+    This function uploads a stream of byte chunks to S3 as a parallel multipart upload.
+    The part size and number of parts in flight are taken from the
+    S3_MULTIPART_PART_SIZE and S3_MULTIPART_CONCURRENCY config vars.
+    Parameters:
+    file_name (str): The name of the file to be uploaded.
+    chunks (iterable): An iterable of bytes objects making up the file content.
+    journal (UploadJournal): Makes the upload resumable, see `multipart_upload`.
+    Returns:
+    bool: True if file upload is successful, False otherwise.
+    """
+    concurrency = settings.config()["S3_MULTIPART_CONCURRENCY"]
+    s3 = get_client()
+    try:
+        multipart_upload(
+            s3,
+            settings.config()["AWS_S3_BUCKET"],
+            file_name,
+            chunks,
+            part_size=settings.config()["S3_MULTIPART_PART_SIZE"],
+            concurrency=concurrency,
+            max_attempts=settings.config()["S3_PART_MAX_ATTEMPTS"],
+            journal=journal,
+        )
+        return True
+    except NoCredentialsError:
+        logging.error(
+            "[upload_stream_to_destination] No AWS credentials found. Unable to upload the file."
+        )
+        return False
+    except Exception as e:
+        logging.error(
+            f"[upload_stream_to_destination] An error occurred while uploading the file: {str(e)}"
+        )
+        return False
+
+
+def multipart_upload(
+    s3,
+    bucket,
+    key,
+    chunks,
+    part_size=64 * 1024 * 1024,
+    concurrency=4,
+    max_attempts=3,
+    journal=None,
+):
+    """
+    This function uploads a stream to S3 as a multipart upload using a bounded pool of workers.
+    A part is only read from the stream once a worker slot is free, so at most
+    `concurrency` parts (`concurrency * part_size` bytes) are held in memory at once.
+    Each part is retried individually, and the whole upload is aborted if any part
+    fails for good, so no incomplete upload is left behind in the bucket.
+    It takes an explicit client so it can be driven against a local S3 stand-in.
+    Every part is sent with its SHA-256, which S3 checks on receipt, and the
+    checksum S3 computes for the whole object is checked once it is complete.
+    With a journal, the upload ID and the ETag and SHA-256 of every stored part
+    are journaled, and a failed upload is kept rather than aborted. A later run
+    continues the journaled upload: the parts of its stream whose SHA-256 match
+    a part S3 still holds are reused, and only the others are uploaded.
+    Parameters:
+    s3 (botocore.client.S3): The S3 client to use.
+    bucket (str): The name of the bucket to upload to.
+    key (str): The key of the object to create.
+    chunks (iterable): An iterable of bytes objects making up the object content.
+    part_size (int): The size of each part in bytes, except the last one.
+    concurrency (int): The number of parts uploaded in parallel.
+    max_attempts (int): The number of times each part is tried before giving up.
+    journal (UploadJournal): Where the state of the upload is kept, if resumable.
+    Returns:
+    dict: The response of the CompleteMultipartUpload call.
+    """
+    part_size = max(part_size, MIN_PART_SIZE)
+    upload_id, stored, recorded = None, {}, {}
+    if journal is not None:
+        upload_id, stored = _resume_upload(s3, bucket, key, part_size, journal)
+        recorded = journal.parts()
+    if upload_id is None:
+        upload_id = s3.create_multipart_upload(
+            Bucket=bucket, Key=key, ChecksumAlgorithm="SHA256"
+        )["UploadId"]
+        if journal is not None:
+            journal.save(
+                upload_id=upload_id,
+                part_size=part_size,
+                checksum_algorithm="SHA256",
+                parts={},
+            )
+    slots = threading.BoundedSemaphore(concurrency)
+    failed = threading.Event()
+
+    def release_slot(future):
+        if future.exception() is not None:
+            failed.set()
+        slots.release()
+
+    try:
+        futures = []
+        digests = []
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for part_number, body in enumerate(
+                _read_parts(chunks, part_size, slots), start=1
+            ):
+                digest = hashlib.sha256(body).digest()
+                digests.append(digest)
+                previous = recorded.get(str(part_number))
+                if (
+                    previous
+                    and previous["sha256"] == digest.hex()
+                    and stored.get(part_number) == previous["ETag"]
+                ):
+                    # S3 already holds this part from the interrupted run
+                    metrics.count("parts_reused")
+                    future = Future()
+                    future.set_result(
+                        {
+                            "PartNumber": part_number,
+                            "ETag": previous["ETag"],
+                            "ChecksumSHA256": base64.b64encode(digest).decode(),
+                        }
+                    )
+                else:
+                    # The copied context carries the metrics of the running backup
+                    future = executor.submit(
+                        contextvars.copy_context().run,
+                        _upload_part,
+                        s3,
+                        bucket,
+                        key,
+                        upload_id,
+                        part_number,
+                        body,
+                        max_attempts,
+                        journal,
+                        digest,
+                    )
+                future.add_done_callback(release_slot)
+                futures.append(future)
+                del body
+                if failed.is_set():
+                    break
+            # Re-raises the first part failure, if any
+            parts = [future.result() for future in futures]
+
+        response = s3.complete_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+        # The checksum of a multipart object ends with `-<parts>`
+        stored_checksum = response.get("ChecksumSHA256")
+        if stored_checksum and stored_checksum.split("-")[0] != multipart_checksum(
+            digests
+        ):
+            s3.delete_object(Bucket=bucket, Key=key)
+            raise RuntimeError(f"S3 stored {key} with another checksum than was sent")
+        logging.debug(f"[multipart_upload] Uploaded {len(parts)} parts to {key}")
+        if journal is not None:
+            journal.clear()
+        return response
+    except BaseException:
+        if journal is not None:
+            logging.warning(
+                f"[multipart_upload] Keeping multipart upload {upload_id} of {key} to resume it"
+            )
+            raise
+        try:
+            s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        except Exception as e:
+            logging.error(
+                f"[multipart_upload] Error aborting multipart upload {upload_id}: {str(e)}"
+            )
+        raise
+
+
+def _read_parts(chunks, part_size, slots):
+    """
+    Regroups a stream of chunks into parts of exactly `part_size` bytes (the last
+    part may be shorter). A slot is acquired before each part is assembled, which
+    is what bounds the memory held by in-flight parts.
+    """
+    buffer = bytearray()
+    yielded = False
+    slots.acquire()
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= part_size:
+            part = bytes(buffer[:part_size])
+            del buffer[:part_size]
+            yield part
+            yielded = True
+            slots.acquire()
+    # An empty stream still needs one (empty) part to form a valid object
+    if buffer or not yielded:
+        yield bytes(buffer)
+    else:
+        slots.release()
+
+
+def _resume_upload(s3, bucket, key, part_size, journal):
+    """
+    Finds the journaled upload of a key that S3 still holds.
+    Returns:
+    tuple: The upload ID and a dict mapping the number of each stored part to
+    its ETag, or (None, {}) if there is no upload to resume.
+    """
+    upload_id = journal.state.get("upload_id")
+    if not upload_id or journal.state.get("file") != key:
+        return None, {}
+    try:
+        if (
+            journal.state.get("part_size") != part_size
+            or journal.state.get("checksum_algorithm") != "SHA256"
+        ):
+            # The parts would not line up with the new stream, or could not be
+            # completed with checksums
+            s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+            return None, {}
+        stored = {
+            part["PartNumber"]: part["ETag"]
+            for page in s3.get_paginator("list_parts").paginate(
+                Bucket=bucket, Key=key, UploadId=upload_id
+            )
+            for part in page.get("Parts", [])
+        }
+    except ClientError as e:
+        # The upload was completed, aborted or expired by a lifecycle rule
+        logging.warning(
+            f"[multipart_upload] Cannot resume upload {upload_id} of {key}: {str(e)}"
+        )
+        return None, {}
+    logging.info(
+        f"[multipart_upload] Resuming upload {upload_id} of {key} with {len(stored)} stored parts"
+    )
+    return upload_id, stored
+
+
+def _upload_part(
+    s3, bucket, key, upload_id, part_number, body, max_attempts, journal, digest
+):
+    checksum = base64.b64encode(digest).decode()
+    for attempt in range(max_attempts):
+        try:
+            response = s3.upload_part(
+                Bucket=bucket,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=body,
+                ChecksumSHA256=checksum,
+            )
+            if journal is not None:
+                journal.add_part(
+                    part_number, {"ETag": response["ETag"], "sha256": digest.hex()}
+                )
+            return {
+                "PartNumber": part_number,
+                "ETag": response["ETag"],
+                "ChecksumSHA256": checksum,
+            }
+        except Exception as e:
+            logging.warning(
+                f"[multipart_upload] Error uploading part {part_number} on attempt {attempt+1}: {str(e)}"
+            )
+            if attempt == max_attempts - 1:
+                raise
+            metrics.count("part_retries")
+            time.sleep(2**attempt)
+
+
+def stat_destination_file(file_name):
+    """
+    This function fetches what S3 knows about the integrity of a stored file.
+    Parameters:
+    file_name (str): The name of the file.
+    Returns:
+    dict: The size of the file, its ETag, server-side encryption and SHA-256
+    checksum, the SHA-256 recorded in its metadata at upload time, and for a
+    multipart object its number of parts and the size of its first part.
+    None if the file does not exist.
+    """
+    s3 = get_client()
+    bucket = settings.config()["AWS_S3_BUCKET"]
+    try:
+        response = s3.head_object(Bucket=bucket, Key=file_name, ChecksumMode="ENABLED")
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return None
+        raise
+    stat = {
+        "size": response["ContentLength"],
+        "etag": response["ETag"].strip('"'),
+        "encryption": response.get("ServerSideEncryption"),
+        "checksum": response.get("ChecksumSHA256"),
+        "sha256": response.get("Metadata", {}).get("sha256"),
+        "parts": None,
+        "part_size": None,
+    }
+    if "-" in stat["etag"]:
+        # Every part but the last has the size of the first one
+        part = s3.head_object(Bucket=bucket, Key=file_name, PartNumber=1)
+        stat["parts"] = part.get("PartsCount") or int(stat["etag"].split("-")[1])
+        stat["part_size"] = part["ContentLength"]
+    return stat
+
+
+def fetch_destination_filelist(prefix=None):
     """
-    This function fetches a list of all files from S3.
+    This function fetches a list of all files from S3, following pagination.
+    Parameters:
+    prefix (str): Only list the files whose name starts with this prefix. The
+    filtering is done by S3, so other files are never transferred.
     Returns:
     list: A list of all file names.
     """
-    s3 = boto3.client("s3", region_name=current_app.config["AWS_S3_REGION"])
+    s3 = get_client()
+    params = {"Bucket": settings.config()["AWS_S3_BUCKET"]}
+    if prefix:
+        params["Prefix"] = prefix
     try:
         return [
             obj["Key"]
-            for obj in s3.list_objects(Bucket=current_app.config["AWS_S3_BUCKET"])[
-                "Contents"
-            ]
+            for page in s3.get_paginator("list_objects_v2").paginate(**params)
+            for obj in page.get("Contents", [])
         ]
     except Exception as e:
         logging.error(
@@ -76,16 +566,112 @@ def fetch_destination_filelist():
         return []
 
 
+def fetch_destination_file_dates(prefix=None):
+    """
+    This function fetches the last modification time of all files from S3,
+    following pagination.
+    Parameters:
+    prefix (str): Only list the files whose name starts with this prefix.
+    Returns:
+    dict: The last modification time, a timezone-aware datetime, of each file.
+    """
+    s3 = get_client()
+    params = {"Bucket": settings.config()["AWS_S3_BUCKET"]}
+    if prefix:
+        params["Prefix"] = prefix
+    return {
+        obj["Key"]: obj["LastModified"]
+        for page in s3.get_paginator("list_objects_v2").paginate(**params)
+        for obj in page.get("Contents", [])
+    }
+
+
 def delete_file_from_destination(file_name):
     """
     This function deletes a file from S3.
     Parameters:
     file_name (str): The name of the file to be deleted.
     """
-    s3 = boto3.client("s3", region_name=current_app.config["AWS_S3_REGION"])
+    s3 = get_client()
     try:
-        s3.delete_object(Bucket=current_app.config["AWS_S3_BUCKET"], Key=file_name)
+        s3.delete_object(Bucket=settings.config()["AWS_S3_BUCKET"], Key=file_name)
     except Exception as e:
         logging.error(
             f"[delete_file_from_destination] An error occurred while deleting the file: {str(e)}"
         )
+
+
+# DeleteObjects accepts at most this many keys per request
+DELETE_BATCH_SIZE = 1000
+
+
+def delete_files_from_destination(file_names):
+    """
+    This function deletes many files from S3 with DeleteObjects, in batches of
+    1000 keys with several batches in flight at once (S3_DELETE_CONCURRENCY).
+    Parameters:
+    file_names (list): The names of the files to be deleted.
+    Returns:
+    tuple: The list of deleted file names, and a dict mapping each file that
+    could not be deleted to the error reported for it.
+    """
+    s3 = get_client()
+    bucket = settings.config()["AWS_S3_BUCKET"]
+    batches = [
+        file_names[offset : offset + DELETE_BATCH_SIZE]
+        for offset in range(0, len(file_names), DELETE_BATCH_SIZE)
+    ]
+
+    def delete_batch(batch):
+        try:
+            response = s3.delete_objects(
+                Bucket=bucket,
+                Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
+            )
+        except Exception as e:
+            logging.error(
+                f"[delete_files_from_destination] An error occurred while deleting a batch of {len(batch)} files: {str(e)}"
+            )
+            return {key: str(e) for key in batch}
+        # In quiet mode, only the keys that failed are reported back
+        return {
+            error["Key"]: f"{error.get('Code')}: {error.get('Message')}"
+            for error in response.get("Errors", [])
+        }
+
+    failed = {}
+    with ThreadPoolExecutor(
+        max_workers=max(1, settings.config()["S3_DELETE_CONCURRENCY"])
+    ) as executor:
+        for batch_failures in executor.map(delete_batch, batches):
+            failed.update(batch_failures)
+
+    deleted = [file_name for file_name in file_names if file_name not in failed]
+    return deleted, failed
+
+
+def set_storage_class(file_name, storage_class):
+    """
+    This function moves a file to another S3 storage class by copying it onto
+    itself. The managed copy switches to a multipart copy for files over 5 GB.
+    Parameters:
+    file_name (str): The name of the file.
+    storage_class (str): The target storage class, such as 'STANDARD_IA'.
+    Returns:
+    bool: True if the storage class was changed, False otherwise.
+    """
+    s3 = get_client()
+    bucket = settings.config()["AWS_S3_BUCKET"]
+    try:
+        s3.copy(
+            {"Bucket": bucket, "Key": file_name},
+            bucket,
+            file_name,
+            ExtraArgs={"StorageClass": storage_class, "MetadataDirective": "COPY"},
+        )
+        return True
+    except Exception as e:
+        logging.error(
+            f"[set_storage_class] An error occurred while moving {file_name} to {storage_class}: {str(e)}"
+        )
+        return False
@@ -0,0 +1,31 @@
+import contextvars
+from collections import ChainMap
+from contextlib import contextmanager
+from flask import current_app
+
+_overrides = contextvars.ContextVar("destination_overrides", default=None)
+
+
+def config():
+    """
+    Returns the app config as seen by the destination modules: the settings of
+    the destination target in use, if any, over the app config.
+    """
+    overrides = _overrides.get()
+    if overrides:
+        return ChainMap(overrides, current_app.config)
+    return current_app.config
+
+
+@contextmanager
+def overridden(overrides):
+    """
+    Makes the destination modules use other settings inside the block, such as
+    another bucket and region. The settings follow the context into the worker
+    threads that are started with a copy of it.
+    """
+    token = _overrides.set(overrides)
+    try:
+        yield
+    finally:
+        _overrides.reset(token)
@@ -0,0 +1,368 @@
+import base64
+import hashlib
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from .cache import cached_download_stream
+
+# cryptography is optional, backups can only be encrypted when it is installed
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:  # pragma: no cover
+    AESGCM = None
+
+ENCRYPTED_SUFFIX = ".enc"
+
+MAGIC = b"HDBE"
+VERSION = 1
+TAG_SIZE = 16
+# The start of the header, which authenticates the wrapped data key
+_PREFIX = struct.Struct(">4sBI8s")
+# Magic, version, plaintext chunk size, master key ID, wrapping nonce, wrapped data key
+_HEADER = struct.Struct(">4sBI8s12s48s")
+HEADER_SIZE = _HEADER.size
+
+
+def _require_cryptography():
+    if AESGCM is None:
+        raise ValueError("Encrypted backups require the 'cryptography' package")
+
+
+def is_encrypted(file_name):
+    return file_name.endswith(ENCRYPTED_SUFFIX)
+
+
+def plain_name(file_name):
+    """
+    Returns:
+    str: The name of a backup without its `.enc` suffix, which tells how its
+    content is compressed or archived.
+    """
+    if is_encrypted(file_name):
+        return file_name[: -len(ENCRYPTED_SUFFIX)]
+    return file_name
+
+
+def encryption_suffix(config):
+    """
+    Returns:
+    str: The suffix of the backups taken with this config, '.enc' when
+    ENCRYPTION_KEY is set.
+    """
+    return ENCRYPTED_SUFFIX if config["ENCRYPTION_KEY"] else ""
+
+
+def key_id(master_key):
+    return hashlib.sha256(master_key).digest()[:8]
+
+
+def parse_master_keys(config):
+    """
+    Reads ENCRYPTION_KEY and the ENCRYPTION_PREVIOUS_KEYS still needed to
+    decrypt older backups after a rotation.
+    Returns:
+    dict: The 32-byte master keys by key ID, the current key first.
+    Raises:
+    ValueError: If a key is not 32 bytes of base64.
+    """
+    keys = {}
+    texts = [config["ENCRYPTION_KEY"]] + (
+        config["ENCRYPTION_PREVIOUS_KEYS"] or ""
+    ).split(",")
+    for text in texts:
+        if not text or not text.strip():
+            continue
+        try:
+            key = base64.b64decode(text.strip(), validate=True)
+        except ValueError:
+            key = b""
+        if len(key) != 32:
+            raise ValueError("Encryption keys must be 32 random bytes, base64-encoded")
+        keys[key_id(key)] = key
+    return keys
+
+
+def _nonce(index, final):
+    # The last chunk is sealed with its own nonce, so a file cut at a chunk
+    # boundary does not decrypt
+    return index.to_bytes(11, "big") + (b"\x01" if final else b"\x00")
+
+
+class _ChunkCipher:
+    """
+    Seals or opens batches of chunks, on a thread pool when `threads` > 1.
+    OpenSSL releases the GIL while it works, so batches use every core.
+    """
+
+    def __init__(self, threads):
+        self._executor = (
+            ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        )
+
+    def _map(self, function, jobs):
+        if self._executor is None or len(jobs) == 1:
+            return b"".join(map(function, jobs))
+        return b"".join(self._executor.map(function, jobs))
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+
+
+class ChunkEncryptor(_ChunkCipher):
+    """
+    Encrypts a stream with AES-256-GCM under a fresh data key, which is stored in
+    the header wrapped by the master key. The stream is cut into chunks of
+    `chunk_size` bytes sealed on their own, with a nonce made of the chunk index
+    and whether it is the last one. Chunks are sealed `threads` at a time, any
+    chunk can be decrypted without the ones before it, and a truncated or
+    reordered file does not decrypt.
+    Parameters:
+    master_key (bytes): The 32-byte key that wraps the data key.
+    chunk_size (int): The plaintext size of each chunk.
+    threads (int): The number of chunks sealed at once.
+    """
+
+    def __init__(self, master_key, chunk_size=1024 * 1024, threads=1):
+        _require_cryptography()
+        super().__init__(threads)
+        data_key = AESGCM.generate_key(256)
+        wrap_nonce = os.urandom(12)
+        prefix = _PREFIX.pack(MAGIC, VERSION, chunk_size, key_id(master_key))
+        self.header = (
+            prefix
+            + wrap_nonce
+            + AESGCM(master_key).encrypt(wrap_nonce, data_key, prefix)
+        )
+        self._aead = AESGCM(data_key)
+        self._chunk_size = chunk_size
+        self._batch_size = chunk_size * max(1, threads)
+        self._buffer = bytearray()
+        self._index = 0
+
+    def _seal(self, job):
+        index, chunk, final = job
+        return self._aead.encrypt(_nonce(index, final), chunk, self.header)
+
+    def _seal_buffered(self, size, final):
+        chunks = [
+            bytes(self._buffer[offset : min(offset + self._chunk_size, size)])
+            for offset in range(0, size, self._chunk_size)
+        ] or [b""]
+        del self._buffer[:size]
+        jobs = [
+            (self._index + number, chunk, final and number == len(chunks) - 1)
+            for number, chunk in enumerate(chunks)
+        ]
+        output = self._map(self._seal, jobs)
+        if self._index == 0:
+            output = self.header + output
+        self._index += len(chunks)
+        return output
+
+    def encrypt(self, data):
+        self._buffer += data
+        # Hold at least one byte back, the last chunk is only known at flush
+        if len(self._buffer) <= self._batch_size:
+            return b""
+        size = (len(self._buffer) - 1) // self._chunk_size * self._chunk_size
+        return self._seal_buffered(size, final=False)
+
+    def flush(self):
+        try:
+            return self._seal_buffered(len(self._buffer), final=True)
+        finally:
+            self.close()
+
+
+class ChunkDecryptor(_ChunkCipher):
+    """
+    Decrypts a stream written by ChunkEncryptor, with the master key it was
+    wrapped by. Every chunk is authenticated, so damaged, truncated or
+    reordered data raises instead of being returned.
+    Parameters:
+    master_keys (dict): The master keys by key ID, see `parse_master_keys`.
+    threads (int): The number of chunks opened at once.
+    """
+
+    def __init__(self, master_keys, threads=1):
+        _require_cryptography()
+        super().__init__(threads)
+        self._master_keys = master_keys
+        self._threads = max(1, threads)
+        self._buffer = bytearray()
+        self._aead = None
+        self._index = 0
+        self.chunk_size = None
+
+    def _read_header(self):
+        header = bytes(self._buffer[:HEADER_SIZE])
+        magic, version, chunk_size, wrapping_key, wrap_nonce, wrapped = _HEADER.unpack(
+            header
+        )
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not an encrypted backup")
+        if wrapping_key not in self._master_keys:
+            raise ValueError(
+                f"The backup was encrypted with an unknown master key {wrapping_key.hex()}"
+            )
+        try:
+            data_key = AESGCM(self._master_keys[wrapping_key]).decrypt(
+                wrap_nonce, wrapped, header[: _PREFIX.size]
+            )
+        except InvalidTag:
+            raise ValueError("The data key of the backup is damaged")
+        self.header = header
+        self.chunk_size = chunk_size
+        self._aead = AESGCM(data_key)
+        del self._buffer[:HEADER_SIZE]
+
+    def seek(self, index):
+        """
+        Makes the next data the chunk `index`, after the header was read.
+        """
+        self._index = index
+
+    def _open(self, job):
+        index, chunk, final = job
+        try:
+            return self._aead.decrypt(_nonce(index, final), chunk, self.header)
+        except InvalidTag:
+            raise ValueError(f"Chunk {index} of the backup is damaged or truncated")
+
+    def _open_buffered(self, count, final):
+        record = self.chunk_size + TAG_SIZE
+        jobs = [
+            (
+                self._index + number,
+                bytes(self._buffer[number * record : (number + 1) * record]),
+                final and number == count - 1,
+            )
+            for number in range(count)
+        ]
+        del self._buffer[: count * record]
+        self._index += count
+        return self._map(self._open, jobs)
+
+    def decrypt(self, data):
+        self._buffer += data
+        if self._aead is None:
+            if len(self._buffer) < HEADER_SIZE:
+                return b""
+            self._read_header()
+        record = self.chunk_size + TAG_SIZE
+        if len(self._buffer) <= record * self._threads:
+            return b""
+        # Hold the last chunk back, whether it is the final one is only known at flush
+        return self._open_buffered((len(self._buffer) - 1) // record, final=False)
+
+    def flush(self):
+        try:
+            if self._aead is None or len(self._buffer) < TAG_SIZE:
+                raise ValueError("The encrypted backup is truncated")
+            record = self.chunk_size + TAG_SIZE
+            count = -(-len(self._buffer) // record)
+            return self._open_buffered(count, final=True)
+        finally:
+            self.close()
+
+
+def encrypt_stream(chunks, config):
+    """
+    Encrypts a stream of chunks with the current master key of `config`.
+    Yields:
+    bytes: The encrypted stream, header first.
+    """
+    master_key = next(iter(parse_master_keys(config).values()))
+    encryptor = ChunkEncryptor(
+        master_key, config["ENCRYPTION_CHUNK_SIZE"], config["ENCRYPTION_THREADS"]
+    )
+    for chunk in chunks:
+        output = encryptor.encrypt(chunk)
+        if output:
+            yield output
+    yield encryptor.flush()
+
+
+def decrypt_stream(chunks, config):
+    """
+    Decrypts a stream of chunks with the master keys of `config`.
+    Yields:
+    bytes: The decrypted stream.
+    Raises:
+    ValueError: If the stream is damaged or truncated, or its key is unknown.
+    """
+    decryptor = ChunkDecryptor(parse_master_keys(config), config["ENCRYPTION_THREADS"])
+    for chunk in chunks:
+        output = decryptor.decrypt(chunk)
+        if output:
+            yield output
+    yield decryptor.flush()
+
+
+def check_encryption_config(config):
+    """
+    Checks that backups can be encrypted as configured, before a backup starts.
+    Raises:
+    ValueError: If ENCRYPTION_KEY is set but cannot be used.
+    """
+    if not config["ENCRYPTION_KEY"]:
+        return
+    _require_cryptography()
+    parse_master_keys(config)
+    # Chunks are named after their content, which is shared between backups
+    if config["DEDUP_STORE"]:
+        raise ValueError("The dedup store cannot be encrypted, unset DEDUP_STORE")
+
+
+def download_plain_stream(destination, file_name, chunk_size=1024 * 1024, start=0):
+    """
+    Streams a stored file as it was before it was encrypted: `.enc` files are
+    decrypted on the fly, other files are passed through. The file is read
+    from the local cache when it holds a valid copy.
+    Parameters:
+    destination (module): The destination module.
+    file_name (str): The name of the file at the destination.
+    chunk_size (int): The download chunk size.
+    start (int): The offset in the decrypted content to start from. Only the
+    chunks from that offset on are downloaded and decrypted.
+    Yields:
+    bytes: The content, chunk by chunk.
+    """
+    if not is_encrypted(file_name):
+        yield from cached_download_stream(destination, file_name, chunk_size, start)
+        return
+
+    config = current_app.config
+    decryptor = ChunkDecryptor(parse_master_keys(config), config["ENCRYPTION_THREADS"])
+    skip = 0
+    offset = 0
+    if start:
+        header = b""
+        stream = cached_download_stream(destination, file_name, HEADER_SIZE)
+        for chunk in stream:
+            header += chunk
+            if len(header) >= HEADER_SIZE:
+                break
+        stream.close()
+        decryptor.decrypt(header[:HEADER_SIZE])
+        index = start // decryptor.chunk_size
+        decryptor.seek(index)
+        offset = HEADER_SIZE + index * (decryptor.chunk_size + TAG_SIZE)
+        skip = start - index * decryptor.chunk_size
+
+    def plain(data):
+        nonlocal skip
+        if skip:
+            data, skip = data[skip:], max(0, skip - len(data))
+        return data
+
+    for chunk in cached_download_stream(destination, file_name, chunk_size, offset):
+        data = plain(decryptor.decrypt(chunk))
+        if data:
+            yield data
+    data = plain(decryptor.flush())
+    if data:
+        yield data
@@ -0,0 +1,154 @@
+import contextvars
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class StreamTee:
+    """
+    Splits one stream of chunks into several readers that consume it at their
+    own pace, so a single dump can be uploaded to several destinations at once.
+    The chunks are kept in a shared buffer of at most `capacity` chunks until
+    every reader went past them. When the buffer is full the source waits for
+    the slowest reader, so memory stays bounded and the dump is slowed down to
+    the pace of the slowest destination. A reader that fails is detached and no
+    longer holds the others back. An error of the source is raised in every
+    reader, so no destination completes a truncated upload.
+    Parameters:
+    chunks (iterable): The source stream.
+    names (list): The names of the readers.
+    capacity (int): The number of chunks the buffer can hold.
+    """
+
+    def __init__(self, chunks, names, capacity=8):
+        self._source = iter(chunks)
+        self._capacity = max(1, capacity)
+        self._buffer = deque()
+        # The index of the first chunk in the buffer, in the whole stream
+        self._start = 0
+        self._positions = dict.fromkeys(names, 0)
+        self._done = False
+        self._error = None
+        self._reading = False
+        self._condition = threading.Condition()
+
+    def _trim(self):
+        if not self._positions:
+            self._buffer.clear()
+            return
+        oldest = min(self._positions.values())
+        while self._start < oldest:
+            self._buffer.popleft()
+            self._start += 1
+
+    def _fill(self):
+        """
+        Reads the next chunk of the source, called with the condition held by
+        one reader at a time. The lock is released during the read.
+        """
+        self._reading = True
+        self._condition.release()
+        try:
+            chunk = next(self._source)
+        except StopIteration:
+            chunk = None
+            done, error = True, None
+        except Exception as e:
+            chunk = None
+            done, error = True, e
+        else:
+            done, error = False, None
+        finally:
+            self._condition.acquire()
+            self._reading = False
+        if chunk is not None:
+            self._buffer.append(chunk)
+        self._done = done
+        self._error = error
+        self._condition.notify_all()
+
+    def reader(self, name):
+        """
+        Returns:
+        generator: The chunks of the stream, for the reader `name`.
+        """
+        try:
+            while True:
+                with self._condition:
+                    while True:
+                        position = self._positions[name]
+                        if position < self._start + len(self._buffer):
+                            chunk = self._buffer[position - self._start]
+                            self._positions[name] = position + 1
+                            self._trim()
+                            self._condition.notify_all()
+                            break
+                        if self._error is not None:
+                            raise self._error
+                        if self._done:
+                            return
+                        # Read ahead unless the slowest reader is too far behind
+                        if not self._reading and len(self._buffer) < self._capacity:
+                            self._fill()
+                            continue
+                        self._condition.wait()
+                yield chunk
+        finally:
+            self.detach(name)
+
+    def detach(self, name):
+        """
+        Stops keeping chunks for a reader, once it finished or failed.
+        """
+        with self._condition:
+            if self._positions.pop(name, None) is not None:
+                self._trim()
+                self._condition.notify_all()
+
+
+def fan_out_upload(targets, file_name, chunks, capacity=8, journal=None):
+    """
+    Uploads one stream to several destination targets concurrently, each from
+    its own reader of a StreamTee. A destination that fails does not stop the
+    others.
+    Parameters:
+    targets (list): The DestinationTarget objects to upload to.
+    file_name (str): The name of the object to create at each destination.
+    chunks (iterable): The stream to upload.
+    capacity (int): The number of chunks buffered for the slowest destination.
+    journal (UploadJournal): Makes the upload resumable. Only used with a
+    single target, since a journal describes the upload to one destination.
+    Returns:
+    dict: Whether the upload succeeded, by target name.
+    """
+    if len(targets) == 1:
+        target = targets[0]
+        return {
+            target.name: target.upload_stream_to_destination(
+                file_name, chunks, journal=journal
+            )
+        }
+
+    tee = StreamTee(chunks, [target.name for target in targets], capacity)
+
+    def upload(target):
+        try:
+            return target.upload_stream_to_destination(
+                file_name, tee.reader(target.name)
+            )
+        except Exception as e:
+            logging.error(
+                f"[fan_out_upload] Error uploading {file_name} to {target.name}: {str(e)}"
+            )
+            return False
+        finally:
+            # A destination that gave up before the end must not stall the others
+            tee.detach(target.name)
+
+    with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        futures = {
+            target.name: executor.submit(contextvars.copy_context().run, upload, target)
+            for target in targets
+        }
+    return {name: future.result() for name, future in futures.items()}
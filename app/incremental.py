@@ -0,0 +1,355 @@
+import json
+import logging
+import subprocess
+from datetime import datetime
+from flask import current_app
+from .compression import get_decompressor
+from .db_backups import DB_QUERY_FUNCTIONS, DB_STREAM_FUNCTIONS
+from .destinations import DESTINATIONS
+from .encryption import download_plain_stream, plain_name
+
+CHAIN_SUFFIX = ".chain.json"
+
+# n_tup_* are cumulative per-table write counters, n_live_tup also moves on TRUNCATE
+POSTGRES_MARKERS_QUERY = """
+SELECT relid::regclass::text,
+       n_tup_ins || ':' || n_tup_upd || ':' || n_tup_del || ':' || n_live_tup
+FROM pg_stat_user_tables
+"""
+
+POSTGRES_SCHEMA_QUERY = """
+SELECT md5(coalesce(string_agg(
+    table_schema || '.' || table_name || '.' || column_name || ':' || data_type,
+    ',' ORDER BY table_schema, table_name, ordinal_position), ''))
+FROM information_schema.columns
+WHERE table_schema NOT IN ('pg_catalog', 'information_schema')
+"""
+
+POSTGRES_FOREIGN_KEYS_QUERY = """
+SELECT conrelid::regclass::text, confrelid::regclass::text
+FROM pg_constraint
+WHERE contype = 'f'
+"""
+
+MYSQL_MARKERS_QUERY = """
+SELECT TABLE_NAME, COALESCE(UPDATE_TIME, '')
+FROM information_schema.TABLES
+WHERE TABLE_SCHEMA = DATABASE() AND TABLE_TYPE = 'BASE TABLE'
+"""
+
+MYSQL_SCHEMA_QUERY = """
+SET SESSION group_concat_max_len = 1073741824;
+SELECT MD5(COALESCE(GROUP_CONCAT(
+    CONCAT(TABLE_NAME, '.', COLUMN_NAME, ':', COLUMN_TYPE)
+    ORDER BY TABLE_NAME, ORDINAL_POSITION SEPARATOR ','), ''))
+FROM information_schema.COLUMNS
+WHERE TABLE_SCHEMA = DATABASE()
+"""
+
+
+# The WAL position moves on any logged write to the cluster, the write counters
+# of the database also on writes to unlogged tables
+POSTGRES_DATABASE_MARKER_QUERY = """
+SELECT CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn()
+            ELSE pg_current_wal_lsn() END
+       || ':' || tup_inserted || ':' || tup_updated || ':' || tup_deleted
+FROM pg_stat_database
+WHERE datname = current_database()
+"""
+
+# The binary log position, and the executed GTIDs when GTIDs are on
+MYSQL_DATABASE_MARKER_QUERIES = ("SHOW BINARY LOG STATUS", "SHOW MASTER STATUS")
+
+
+def _quote_mysql(name):
+    return "`" + name.replace("`", "``") + "`"
+
+
+def get_table_markers(db_url, database_type, checksum=False):
+    """
+    Reads a cheap per-table change marker for every table, plus a fingerprint of
+    the schema. A table whose marker differs from the previous run has changed.
+    On Postgres the markers are the `pg_stat_user_tables` write counters.
+    On MySQL they are `information_schema` update times, falling back to
+    `CHECKSUM TABLE` where the update time is unknown (or for every table when
+    `checksum` is set).
+    Parameters:
+    db_url (str): The database connection URL.
+    database_type (str): 'postgres' or 'mysql'.
+    checksum (bool): Use `CHECKSUM TABLE` for every MySQL table.
+    Returns:
+    tuple: A dict mapping table names to markers, and the schema fingerprint.
+    """
+    run_query = DB_QUERY_FUNCTIONS[database_type]
+    if database_type == "postgres":
+        markers = dict(run_query(db_url, POSTGRES_MARKERS_QUERY))
+        fingerprint = run_query(db_url, POSTGRES_SCHEMA_QUERY)[0][0]
+        return markers, fingerprint
+
+    markers = dict(run_query(db_url, MYSQL_MARKERS_QUERY))
+    # InnoDB forgets UPDATE_TIME on restart, so those tables need a real checksum
+    unknown = [table for table, marker in markers.items() if checksum or not marker]
+    if unknown:
+        rows = run_query(
+            db_url, "CHECKSUM TABLE " + ", ".join(_quote_mysql(t) for t in unknown)
+        )
+        for name, value in rows:
+            markers[name.split(".", 1)[-1]] = "checksum:" + value
+    fingerprint = run_query(db_url, MYSQL_SCHEMA_QUERY)[-1][0]
+    return markers, fingerprint
+
+
+def get_database_marker(db_url, database_type):
+    """
+    Reads a cheap marker that moves whenever the database is written to: the
+    WAL position and the write counters of `pg_stat_database` on Postgres, the
+    binary log position on MySQL. Both also move on writes to other databases
+    of the same server, so a change can be reported where there was none, but
+    not the other way around.
+    Parameters:
+    db_url (str): The database connection URL.
+    database_type (str): 'postgres' or 'mysql'.
+    Returns:
+    str: The marker, or None if it cannot be read, such as on a MySQL server
+    without binary logging.
+    """
+    run_query = DB_QUERY_FUNCTIONS[database_type]
+    try:
+        if database_type == "postgres":
+            return run_query(db_url, POSTGRES_DATABASE_MARKER_QUERY)[0][0] or None
+        for statement in MYSQL_DATABASE_MARKER_QUERIES:
+            try:
+                row = run_query(db_url, statement)[0]
+            except subprocess.CalledProcessError:
+                # SHOW BINARY LOG STATUS only exists from MySQL 8.2
+                continue
+            # File, position, do and ignore filters, then the executed GTIDs
+            return ":".join([row[0], row[1]] + row[4:5])
+    except (subprocess.CalledProcessError, IndexError) as e:
+        logging.warning(f"[get_database_marker] Could not read the marker: {str(e)}")
+    return None
+
+
+def _referencing_closure(db_url, tables):
+    """
+    Adds every table that references one of `tables` through a foreign key,
+    recursively. Postgres only lets referenced tables be truncated together with
+    the tables that reference them.
+    """
+    references = DB_QUERY_FUNCTIONS["postgres"](db_url, POSTGRES_FOREIGN_KEYS_QUERY)
+    closure = set(tables)
+    changed = True
+    while changed:
+        changed = False
+        for referencing, referenced in references:
+            if referenced in closure and referencing not in closure:
+                closure.add(referencing)
+                changed = True
+    return closure
+
+
+def plan_backup(chain, markers, fingerprint, max_chain):
+    """
+    Decides whether the next backup can be an increment on top of `chain`.
+    Parameters:
+    chain (dict): The current chain manifest, or None.
+    markers (dict): The current table markers.
+    fingerprint (str): The current schema fingerprint.
+    max_chain (int): The maximum number of increments on top of a full base.
+    Returns:
+    list: The sorted names of the tables to re-dump, or None when a new full
+    base backup is needed.
+    """
+    if not chain:
+        return None
+    # Runs where no table changed add no file, and do not lengthen the chain
+    increments = [entry for entry in chain["entries"][1:] if entry["file"]]
+    if len(increments) >= max_chain:
+        return None
+    previous = chain["entries"][-1]
+    # New, dropped or altered tables can't be replayed as data-only increments
+    if chain["fingerprint"] != fingerprint or set(previous["markers"]) != set(markers):
+        return None
+    return sorted(
+        table for table in markers if markers[table] != previous["markers"][table]
+    )
+
+
+class _PrefixedStream:
+    """Yields a fixed prefix, then the output of a process."""
+
+    def __init__(self, prefix, stream):
+        self._prefix = prefix
+        self._stream = stream
+
+    def read(self, size=-1):
+        if self._prefix:
+            data, self._prefix = self._prefix, b""
+            return data
+        return self._stream.read(size)
+
+    def close(self):
+        self._stream.close()
+
+
+class _PrefixedProcess:
+    """
+    Wraps a dump process so its stdout starts with some extra SQL, while still
+    looking like a `subprocess.Popen` to `stream_compressed_backup`.
+    """
+
+    def __init__(self, prefix, process):
+        self._process = process
+        self.stdout = _PrefixedStream(prefix, process.stdout)
+
+    def wait(self):
+        return self._process.wait()
+
+    def poll(self):
+        return self._process.poll()
+
+    def kill(self):
+        self._process.kill()
+
+
+def open_increment_stream(db_url, database_type, tables):
+    """
+    Starts a data-only dump of `tables`, preceded by the SQL that empties them,
+    so replaying the increment on top of the previous backup replaces their rows.
+    Parameters:
+    db_url (str): The database connection URL.
+    database_type (str): 'postgres' or 'mysql'.
+    tables (list): The tables to dump.
+    Returns:
+    object: A process-like object with the increment SQL on its stdout.
+    """
+    if database_type == "postgres":
+        tables = sorted(_referencing_closure(db_url, tables))
+        prefix = f"TRUNCATE {', '.join(tables)};\n"
+        extra_args = ["--data-only"]
+        for table in tables:
+            extra_args += ["-t", table]
+        process = DB_STREAM_FUNCTIONS["postgres"](db_url, extra_args)
+    else:
+        prefix = "SET FOREIGN_KEY_CHECKS=0;\n" + "".join(
+            f"DELETE FROM {_quote_mysql(table)};\n" for table in tables
+        )
+        process = DB_STREAM_FUNCTIONS["mysql"](
+            db_url,
+            ["--no-create-info", "--skip-triggers", "--single-transaction"],
+            tables,
+        )
+    return _PrefixedProcess(prefix.encode(), process)
+
+
+def find_latest_chain(backups, label=None):
+    """
+    Loads the most recent chain manifest among the catalogued backups of a
+    database.
+    Parameters:
+    backups (list): The catalog entries, oldest first, as returned by
+    `find_backups`.
+    label (str): The label of the chain, or None for the unlabelled one.
+    Returns:
+    tuple: The chain manifest's file name and content, or (None, None).
+    """
+    destination = DESTINATIONS[current_app.config["UPLOAD_DESTINATION"]]
+    chains = [
+        entry
+        for entry in backups
+        if entry["format"] == "chain" and entry["label"] == label
+    ]
+    if not chains:
+        return None, None
+    chain_name = chains[-1]["file"]
+    content = destination.read_from_destination(chain_name)
+    if content is None:
+        logging.error(f"[find_latest_chain] Could not read chain manifest {chain_name}")
+        return None, None
+    return chain_name, json.loads(content)
+
+
+def save_chain(chain_name, chain):
+    """
+    Writes a chain manifest to the destination.
+    Returns:
+    bool: True if the manifest was written, False otherwise.
+    """
+    destination = DESTINATIONS[current_app.config["UPLOAD_DESTINATION"]]
+    return destination.upload_to_destination(
+        chain_name, json.dumps(chain, indent=2).encode()
+    )
+
+
+def new_chain(database_type, database_name, fingerprint):
+    return {
+        "database_type": database_type,
+        "database": database_name,
+        "fingerprint": fingerprint,
+        "entries": [],
+    }
+
+
+def add_chain_entry(chain, entry_type, file_name, markers, tables=None):
+    chain["entries"].append(
+        {
+            "type": entry_type,
+            "file": file_name,
+            "created": datetime.now().strftime("%Y%m%d%H%M%S"),
+            "tables": tables,
+            "markers": markers,
+        }
+    )
+
+
+def iter_chain_sql(chain, chunk_size=1024 * 1024):
+    """
+    Rebuilds a full logical dump from a chain: the base backup followed by every
+    increment, in order, decrypted and decompressed on the fly.
+    Parameters:
+    chain (dict): The chain manifest.
+    chunk_size (int): The download chunk size.
+    Yields:
+    bytes: The SQL of the rebuilt dump, chunk by chunk.
+    """
+    destination = DESTINATIONS[current_app.config["UPLOAD_DESTINATION"]]
+    for entry in chain["entries"]:
+        # Runs where no table changed are recorded without a file
+        if not entry["file"]:
+            continue
+        decompressor = get_decompressor(plain_name(entry["file"]))
+        for chunk in download_plain_stream(destination, entry["file"], chunk_size):
+            yield decompressor.decompress(chunk) if decompressor else chunk
+
+
+def chain_files(chain_name, chain):
+    """
+    Returns every file that belongs to a chain, manifest included.
+    """
+    return [chain_name] + [entry["file"] for entry in chain["entries"] if entry["file"]]
+
+
+def protected_chain_files(destination, candidates, cutoff_date):
+    """
+    Finds the files that must survive a trim because they belong to a chain that
+    is still in use: its base may be older than the cutoff, but increments newer
+    than the cutoff can only be restored on top of it.
+    Parameters:
+    destination (module): The destination module.
+    candidates (list): The files about to be deleted.
+    cutoff_date (datetime): The trim cutoff date.
+    Returns:
+    set: The names of the files to keep.
+    """
+    protected = set()
+    for file_name in candidates:
+        if not file_name.endswith(CHAIN_SUFFIX):
+            continue
+        content = destination.read_from_destination(file_name)
+        if content is None:
+            continue
+        chain = json.loads(content)
+        newest = datetime.strptime(chain["entries"][-1]["created"], "%Y%m%d%H%M%S")
+        if newest >= cutoff_date:
+            protected.update(chain_files(file_name, chain))
+    return protected
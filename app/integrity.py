@@ -0,0 +1,313 @@
+import base64
+import hashlib
+import io
+import json
+import tarfile
+from flask import current_app
+from .compression import get_decompressor
+from .db_backups import DB_QUERY_FUNCTIONS
+from .dedup import MANIFEST_SUFFIX, iter_manifest_data
+from .destinations.s3 import multipart_checksum, multipart_etag
+from .encryption import decrypt_stream, is_encrypted, plain_name
+from .incremental import CHAIN_SUFFIX, chain_files
+from .sharding import SHARDS_SUFFIX, shard_files
+from .util import ChunkedStreamReader
+
+# The SHA-256 of a backup is stored next to it in `<backup>.sha256`
+SIDECAR_SUFFIX = ".sha256"
+
+# Empties a scratch database before a test restore. The dumps recreate their
+# own schemas, but not `public`, which every PostgreSQL database starts with.
+POSTGRES_RESET_QUERY = """
+DO $$
+DECLARE schema_name text;
+BEGIN
+  FOR schema_name IN
+    SELECT nspname FROM pg_namespace
+    WHERE nspname NOT LIKE 'pg\\_%' AND nspname <> 'information_schema'
+  LOOP
+    EXECUTE format('DROP SCHEMA %I CASCADE', schema_name);
+  END LOOP;
+END $$;
+CREATE SCHEMA public;
+"""
+
+MYSQL_TABLES_QUERY = """
+SELECT TABLE_NAME FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE()
+"""
+
+# The tables a test restore created
+TABLE_COUNT_QUERIES = {
+    "postgres": """
+SELECT count(*) FROM information_schema.tables
+WHERE table_schema NOT IN ('pg_catalog', 'information_schema')
+""",
+    "mysql": """
+SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE()
+""",
+}
+
+
+def sidecar_name(file_name):
+    return file_name + SIDECAR_SUFFIX
+
+
+def write_sidecar(destination, file_name, checksum):
+    """
+    Stores the SHA-256 of a backup next to it, in the format of `sha256sum`,
+    so a downloaded copy can also be checked with `sha256sum -c`.
+    Returns:
+    bool: True if the sidecar was written.
+    """
+    return destination.upload_to_destination(
+        sidecar_name(file_name), f"{checksum}  {file_name}\n".encode()
+    )
+
+
+def read_sidecar(destination, file_name):
+    """
+    Returns:
+    str: The SHA-256 stored next to a backup, or None if it has no sidecar.
+    """
+    content = destination.read_from_destination(sidecar_name(file_name))
+    if not content:
+        return None
+    return content.split()[0].decode()
+
+
+class PartDigests:
+    """
+    Hashes a stream in the parts S3 stored it in, to check it against the ETag
+    and the part checksums of a multipart object. Every part but the last one
+    has the same size.
+    """
+
+    def __init__(self, part_size):
+        self.part_size = part_size
+        self.md5s = []
+        self.sha256s = []
+        self._start_part()
+
+    def _start_part(self):
+        self._md5 = hashlib.md5()
+        self._sha256 = hashlib.sha256()
+        self._filled = 0
+
+    def _end_part(self):
+        self.md5s.append(self._md5.digest())
+        self.sha256s.append(self._sha256.digest())
+        self._start_part()
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            size = min(len(view), self.part_size - self._filled)
+            self._md5.update(view[:size])
+            self._sha256.update(view[:size])
+            self._filled += size
+            view = view[size:]
+            if self._filled == self.part_size:
+                self._end_part()
+
+    def finish(self):
+        if self._filled or not self.md5s:
+            self._end_part()
+
+
+def _check_content(file_name, chunks):
+    """
+    Reads a backup through to its end the way a restore would. Download errors
+    are raised, the stream is read to its end whatever the content.
+    Returns:
+    str: Why the content is not usable, or None if it is.
+    """
+    if file_name.endswith(".tar"):
+        try:
+            with tarfile.open(
+                fileobj=io.BufferedReader(ChunkedStreamReader(chunks)), mode="r|"
+            ) as archive:
+                if not any(True for _ in archive):
+                    return "the archive is empty"
+        except tarfile.TarError as e:
+            return f"the archive is damaged: {str(e)}"
+        return None
+    decompressor = get_decompressor(file_name)
+    problem = None
+    for chunk in chunks:
+        if decompressor is None:
+            continue
+        try:
+            decompressor.decompress(chunk)
+        except Exception as e:
+            problem = f"the compressed stream is damaged: {str(e)}"
+            decompressor = None
+    if decompressor and not decompressor.complete:
+        problem = "the compressed stream is truncated"
+    return problem
+
+
+def verify_file(destination, file_name, entry=None, chunk_size=1024 * 1024):
+    """
+    Streams a stored file back and checks it, without writing it to disk:
+    its size and SHA-256 against the sidecar, the upload metadata and the
+    catalog, its ETag and SHA-256 checksum against the ones S3 computed when
+    it was uploaded, part by part for multipart objects, and that it
+    decrypts, decompresses or unpacks to its end.
+    Parameters:
+    destination (module): The destination module.
+    file_name (str): The name of the file.
+    entry (dict): The catalog entry of the file, if any.
+    chunk_size (int): The download chunk size.
+    Returns:
+    dict: The file, whether it passed, the outcome of each check (None when
+    there was nothing to check against) and the errors found.
+    """
+    report = {"file": file_name, "ok": True, "checks": {}, "errors": []}
+
+    def check(name, passed, error):
+        report["checks"][name] = passed
+        if passed is False:
+            report["ok"] = False
+            report["errors"].append(error)
+
+    stat = destination.stat_destination_file(file_name)
+    if stat is None:
+        check("exists", False, "the file does not exist")
+        return report
+    entry = entry or {}
+    expected = (
+        read_sidecar(destination, file_name)
+        or stat.get("sha256")
+        or entry.get("checksum")
+    )
+
+    digest = hashlib.sha256()
+    md5 = hashlib.md5()
+    parts = PartDigests(stat["part_size"]) if stat.get("parts") else None
+    size = 0
+
+    def hashed(chunks):
+        nonlocal size
+        for chunk in chunks:
+            digest.update(chunk)
+            if parts:
+                parts.update(chunk)
+            elif "etag" in stat:
+                md5.update(chunk)
+            size += len(chunk)
+            yield chunk
+
+    chunks = hashed(destination.download_stream_from_destination(file_name, chunk_size))
+    try:
+        if is_encrypted(file_name):
+            # The hashes cover the stored ciphertext, only the content check
+            # sees the decrypted stream
+            try:
+                problem = _check_content(
+                    plain_name(file_name), decrypt_stream(chunks, current_app.config)
+                )
+            except ValueError as e:
+                problem = f"the file does not decrypt: {str(e)}"
+        else:
+            problem = _check_content(file_name, chunks)
+        # A tar archive ends before its padding does, and a damaged one earlier
+        for _ in chunks:
+            pass
+    except Exception as e:
+        check("content", False, f"the file could not be read: {str(e)}")
+        return report
+    check("content", problem is None, problem)
+
+    check(
+        "size",
+        size == stat["size"] and entry.get("size") in (None, size),
+        f"{size} bytes were read, {stat['size']} are stored and {entry.get('size')} were uploaded",
+    )
+    check(
+        "sha256",
+        digest.hexdigest() == expected if expected else None,
+        f"the SHA-256 is {digest.hexdigest()}, {expected} was uploaded",
+    )
+    if parts:
+        parts.finish()
+    # KMS-encrypted objects have an ETag that is not computed from their content
+    if "etag" in stat and stat.get("encryption") != "aws:kms":
+        etag = multipart_etag(parts.md5s) if parts else md5.hexdigest()
+        check(
+            "etag", etag == stat["etag"], f"the ETag is {etag}, S3 has {stat['etag']}"
+        )
+    if stat.get("checksum"):
+        checksum = (
+            multipart_checksum(parts.sha256s)
+            if parts
+            else base64.b64encode(digest.digest()).decode()
+        )
+        check(
+            "s3_checksum",
+            checksum == stat["checksum"].split("-")[0],
+            f"the S3 checksum is {checksum}, S3 has {stat['checksum']}",
+        )
+    return report
+
+
+def verify_backup(destination, file_name, entries=None, chunk_size=1024 * 1024):
+    """
+    Verifies a backup with every file it is restored from: the base and the
+    increments of a chain, the parts of a sharded backup, and for a dedup
+    manifest the chunks it references, which are checked against the SHA-256
+    they are named after.
+    Parameters:
+    destination (module): The destination module.
+    file_name (str): The name of the backup.
+    entries (dict): The catalog entries of the database, by file name.
+    chunk_size (int): The download chunk size.
+    Returns:
+    list: The report of each file, see `verify_file`.
+    """
+    entries = entries or {}
+    report = verify_file(destination, file_name, entries.get(file_name), chunk_size)
+    if not report["ok"] or not file_name.endswith(
+        (CHAIN_SUFFIX, MANIFEST_SUFFIX, SHARDS_SUFFIX)
+    ):
+        return [report]
+    manifest = json.loads(destination.read_from_destination(file_name))
+    if file_name.endswith(MANIFEST_SUFFIX):
+        try:
+            for _ in iter_manifest_data(destination, manifest):
+                pass
+            report["checks"]["chunks"] = True
+        except Exception as e:
+            report["checks"]["chunks"] = False
+            report["ok"] = False
+            report["errors"].append(str(e))
+        return [report]
+    files = (
+        shard_files(file_name, manifest)
+        if file_name.endswith(SHARDS_SUFFIX)
+        else chain_files(file_name, manifest)
+    )
+    return [report] + [
+        verify_file(destination, part, entries.get(part), chunk_size)
+        for part in files[1:]
+    ]
+
+
+def reset_scratch_database(db_url, database_type):
+    """
+    Drops everything in a scratch database, so a test restore starts empty.
+    """
+    if database_type == "postgres":
+        DB_QUERY_FUNCTIONS["postgres"](db_url, POSTGRES_RESET_QUERY)
+        return
+    tables = [row[0] for row in DB_QUERY_FUNCTIONS["mysql"](db_url, MYSQL_TABLES_QUERY)]
+    if tables:
+        DB_QUERY_FUNCTIONS["mysql"](
+            db_url,
+            "SET FOREIGN_KEY_CHECKS = 0; DROP TABLE "
+            + ", ".join(f"`{table}`" for table in tables),
+        )
+
+
+def count_tables(db_url, database_type):
+    rows = DB_QUERY_FUNCTIONS[database_type](db_url, TABLE_COUNT_QUERIES[database_type])
+    return int(rows[0][0])
@@ -0,0 +1,324 @@
+import contextvars
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from . import metrics
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    dedup_key TEXT NOT NULL,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,
+    progress TEXT,
+    result TEXT,
+    error TEXT,
+    pid INTEGER,
+    created TEXT NOT NULL,
+    started TEXT,
+    finished TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_active ON jobs (dedup_key, status);
+"""
+
+ACTIVE_STATUSES = ("queued", "running")
+
+# Seconds between two progress writes for the same job, stage changes excepted
+PROGRESS_INTERVAL = 1.0
+
+_current_job = contextvars.ContextVar("current_job", default=None)
+
+
+def _now():
+    return datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobStore:
+    """
+    Keeps the state of background jobs in a local SQLite database, so it is
+    shared by every gunicorn worker of the dyno and survives worker restarts.
+    Each operation opens its own short-lived connection, which keeps the store
+    safe to use from any thread.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as connection:
+            connection.executescript(SCHEMA)
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def create(self, kind, dedup_key, params):
+        """
+        Records a new queued job, unless a job with the same key is still queued
+        or running. The check and the insert run in one write transaction, so
+        concurrent requests in different workers cannot both create a job.
+        Returns:
+        tuple: The job ID, and whether a new job was created.
+        """
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT id FROM jobs WHERE dedup_key = ? AND status IN (?, ?)",
+                (dedup_key, *ACTIVE_STATUSES),
+            ).fetchone()
+            if row:
+                connection.execute("COMMIT")
+                return row["id"], False
+            job_id = uuid.uuid4().hex
+            connection.execute(
+                "INSERT INTO jobs (id, kind, dedup_key, params, status, pid, created)"
+                " VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                (job_id, kind, dedup_key, json.dumps(params), os.getpid(), _now()),
+            )
+            connection.execute("COMMIT")
+            return job_id, True
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        finally:
+            connection.close()
+
+    def update(self, job_id, **fields):
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        connection = self._connect()
+        try:
+            connection.execute(
+                f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id)
+            )
+        finally:
+            connection.close()
+
+    def get(self, job_id):
+        """
+        Returns:
+        dict: The job, with its params, progress and result decoded, or None.
+        """
+        connection = self._connect()
+        try:
+            row = connection.execute(
+                "SELECT * FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        finally:
+            connection.close()
+        return self._decode(row) if row else None
+
+    def list(self, status=None, limit=100):
+        connection = self._connect()
+        try:
+            if status:
+                rows = connection.execute(
+                    "SELECT * FROM jobs WHERE status = ? ORDER BY created DESC LIMIT ?",
+                    (status, limit),
+                ).fetchall()
+            else:
+                rows = connection.execute(
+                    "SELECT * FROM jobs ORDER BY created DESC LIMIT ?", (limit,)
+                ).fetchall()
+        finally:
+            connection.close()
+        return [self._decode(row) for row in rows]
+
+    def orphaned(self):
+        """
+        Returns:
+        list: The queued or running jobs owned by a process that no longer runs.
+        """
+        connection = self._connect()
+        try:
+            rows = connection.execute(
+                "SELECT * FROM jobs WHERE status IN (?, ?)", ACTIVE_STATUSES
+            ).fetchall()
+        finally:
+            connection.close()
+        return [
+            dict(self._decode(row), pid=row["pid"])
+            for row in rows
+            if not _pid_alive(row["pid"])
+        ]
+
+    def claim(self, job_id, previous_pid):
+        """
+        Takes over an orphaned job for this process. Only one of the processes
+        racing to recover the same job succeeds.
+        Returns:
+        bool: True if this process now owns the job.
+        """
+        connection = self._connect()
+        try:
+            cursor = connection.execute(
+                "UPDATE jobs SET pid = ? WHERE id = ? AND pid = ?",
+                (os.getpid(), job_id, previous_pid),
+            )
+        finally:
+            connection.close()
+        return cursor.rowcount == 1
+
+    @staticmethod
+    def _decode(row):
+        job = dict(row)
+        for name in ("params", "progress", "result"):
+            if job[name] is not None:
+                job[name] = json.loads(job[name])
+        del job["pid"]
+        return job
+
+
+class JobQueue:
+    """
+    Runs backup jobs in a bounded pool of background threads, so the HTTP task
+    endpoints can answer immediately with a job ID instead of holding the
+    request open for the whole backup.
+    Parameters:
+    store (JobStore): Where job state is kept.
+    functions (dict): Maps each job kind to the function that runs it.
+    workers (int): The maximum number of jobs running at once in this process.
+    resumable (tuple): The job kinds that pick up where they left off, so they
+    are run again rather than failed when a restart interrupted them.
+    """
+
+    def __init__(self, store, functions, workers=2, resumable=()):
+        self.store = store
+        self.functions = functions
+        self.resumable = resumable
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, workers), thread_name_prefix="job"
+        )
+        self._recover()
+
+    def _recover(self):
+        # Jobs of a dead process: queued ones are run again, running ones may
+        # have been half done, so they are failed and left for the caller to
+        # retry, unless they can resume
+        for job in self.store.orphaned():
+            if not self.store.claim(job["id"], job["pid"]):
+                continue
+            if job["status"] == "running" and job["kind"] not in self.resumable:
+                self.store.update(
+                    job["id"],
+                    status="failed",
+                    error="Interrupted by a restart",
+                    finished=_now(),
+                )
+                continue
+            logging.info(f"[JobQueue] Resuming queued job {job['id']}")
+            self._executor.submit(
+                contextvars.Context().run,
+                self._run,
+                job["id"],
+                job["kind"],
+                job["params"],
+                None,
+            )
+
+    def submit(self, kind, dedup_key, **params):
+        """
+        Queues a job, or returns the job already queued or running for the same
+        key, such as a second backup request for a database being backed up.
+        Returns:
+        tuple: The job ID, and whether a new job was queued.
+        """
+        job_id, created = self.store.create(kind, dedup_key, params)
+        if created:
+            # Each job runs in a fresh context, so no state leaks from the previous job
+            self._executor.submit(
+                contextvars.Context().run,
+                self._run,
+                job_id,
+                kind,
+                params,
+                time.monotonic(),
+            )
+        return job_id, created
+
+    def _run(self, job_id, kind, params, queued_at):
+        token = _current_job.set((self.store, job_id, {"last_write": 0.0}))
+        if queued_at is not None:
+            metrics.record_queue_wait(time.monotonic() - queued_at)
+        self.store.update(job_id, status="running", started=_now())
+        try:
+            result = self.functions[kind](**params)
+            self.store.update(
+                job_id,
+                status="succeeded",
+                result=json.dumps(result, default=str),
+                finished=_now(),
+            )
+        except SystemExit:
+            # The task functions exit on failure, after logging the reason
+            self.store.update(
+                job_id,
+                status="failed",
+                error="Job failed, see the logs for details",
+                finished=_now(),
+            )
+        except Exception as e:
+            logging.error(f"[JobQueue] Job {job_id} failed: {str(e)}")
+            self.store.update(job_id, status="failed", error=str(e), finished=_now())
+        finally:
+            _current_job.reset(token)
+
+
+def report_progress(stage, **fields):
+    """
+    Records the progress of the job running in the current thread, if any.
+    Writes are throttled to one per PROGRESS_INTERVAL unless the stage changes,
+    so it can be called for every chunk of a stream.
+    Parameters:
+    stage (str): The current stage, such as 'dump' or 'upload'.
+    fields: Extra progress details, such as the number of bytes processed.
+    """
+    current = _current_job.get()
+    if current is None:
+        return
+    store, job_id, state = current
+    now = time.monotonic()
+    if state.get("stage") == stage and now - state["last_write"] < PROGRESS_INTERVAL:
+        return
+    state["stage"] = stage
+    state["last_write"] = now
+    try:
+        store.update(job_id, progress=json.dumps({"stage": stage, **fields}))
+    except sqlite3.Error as e:
+        logging.warning(f"[report_progress] Could not record progress: {str(e)}")
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue(config, functions, resumable=()):
+    """
+    Returns the job queue of this process, creating it on first use.
+    """
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue(
+                JobStore(config["JOBS_DB_PATH"]),
+                functions,
+                config["JOB_WORKERS"],
+                resumable,
+            )
+        return _queue
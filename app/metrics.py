@@ -0,0 +1,393 @@
+import contextvars
+import cProfile
+import io
+import logging
+import pstats
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+_current_run = contextvars.ContextVar("current_run", default=None)
+_queue_wait = contextvars.ContextVar("queue_wait", default=None)
+
+
+class RunMetrics:
+    """
+    Timings and counters for a single backup run.
+    Stages are 'dump' (waiting on the dump process), 'compress' and 'upload'
+    (waiting on the destination). In a streaming backup they overlap in time, so
+    each one only counts the time the pipeline spent blocked on it, which shows
+    the stage that limits the throughput.
+    Counters are updated from worker threads, so they are guarded by a lock.
+    """
+
+    def __init__(self, kind, config_var):
+        self.kind = kind
+        self.config_var = config_var
+        self.status = None
+        self.skipped = False
+        self.queue_wait = _queue_wait.get()
+        self.stages = defaultdict(float)
+        self.counters = defaultdict(int)
+        self._start = time.monotonic()
+        self.duration = None
+        self._lock = threading.Lock()
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] += seconds
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def skip(self):
+        """
+        Marks the run as skipped, such as a backup of a database that has not
+        changed. A skipped run that ends normally is recorded as 'skipped'.
+        """
+        self.skipped = True
+
+    def finish(self, status):
+        self.status = status
+        self.duration = time.monotonic() - self._start
+
+    def summary(self):
+        """
+        Returns:
+        dict: The stage timings in seconds, the counters, and the derived
+        compression ratio and throughputs in MB/s.
+        """
+        duration = (
+            self.duration
+            if self.duration is not None
+            else time.monotonic() - self._start
+        )
+        with self._lock:
+            stages = dict(self.stages)
+            counters = dict(self.counters)
+        dumped = counters.get("bytes_dumped", 0)
+        compressed = counters.get("bytes_compressed", 0)
+        upload_seconds = stages.get("upload", 0.0)
+        return {
+            "duration": round(duration, 3),
+            "stages": {stage: round(value, 3) for stage, value in stages.items()},
+            "counters": counters,
+            "compression_ratio": round(dumped / compressed, 2) if compressed else None,
+            "throughput_mb_per_s": round(dumped / duration / 1e6, 2)
+            if duration
+            else None,
+            "upload_mb_per_s": round(compressed / upload_seconds / 1e6, 2)
+            if upload_seconds
+            else None,
+            "queue_wait": round(self.queue_wait, 3)
+            if self.queue_wait is not None
+            else None,
+        }
+
+    def format(self):
+        """
+        Returns:
+        str: The summary as text, for notifications.
+        """
+        summary = self.summary()
+        lines = [f"Duration: {summary['duration']}s"]
+        if summary["queue_wait"] is not None:
+            lines.append(f"Queue wait: {summary['queue_wait']}s")
+        for stage, seconds in summary["stages"].items():
+            lines.append(f"Stage {stage}: {seconds}s")
+        for name, value in sorted(summary["counters"].items()):
+            lines.append(f"{name}: {value}")
+        if summary["compression_ratio"] is not None:
+            lines.append(f"Compression ratio: {summary['compression_ratio']}")
+        if summary["throughput_mb_per_s"] is not None:
+            lines.append(f"Throughput: {summary['throughput_mb_per_s']} MB/s")
+        if summary["upload_mb_per_s"] is not None:
+            lines.append(f"Upload: {summary['upload_mb_per_s']} MB/s")
+        return "\n".join(lines)
+
+
+class MetricsRegistry:
+    """
+    Aggregates the runs of this process into Prometheus counters and gauges.
+    Each web or worker process keeps its own registry.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.runs = defaultdict(int)
+        self.stage_seconds = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.queue_wait_seconds = 0.0
+        self.queue_wait_count = 0
+        self.last_runs = {}
+
+    def record(self, run):
+        summary = run.summary()
+        with self._lock:
+            self.runs[(run.kind, run.status)] += 1
+            for stage, seconds in summary["stages"].items():
+                self.stage_seconds[(run.kind, stage)] += seconds
+            for name, value in summary["counters"].items():
+                self.counters[(run.kind, name)] += value
+            self.last_runs[(run.kind, run.config_var)] = (
+                summary,
+                run.status,
+                time.time(),
+            )
+
+    def record_queue_wait(self, seconds):
+        with self._lock:
+            self.queue_wait_seconds += seconds
+            self.queue_wait_count += 1
+
+    def render(self):
+        """
+        Returns:
+        str: The metrics in the Prometheus text exposition format.
+        """
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(
+                    f'{key}="{str(val)}"' for key, val in labels.items()
+                )
+                lines.append(
+                    f"{name}{{{label_text}}} {value}"
+                    if label_text
+                    else f"{name} {value}"
+                )
+
+        with self._lock:
+            metric(
+                "db_backup_runs_total",
+                "counter",
+                "Runs by kind and status.",
+                [({"kind": k, "status": s}, v) for (k, s), v in self.runs.items()],
+            )
+            metric(
+                "db_backup_stage_seconds_total",
+                "counter",
+                "Time the pipeline spent blocked on each stage.",
+                [
+                    ({"kind": k, "stage": s}, round(v, 6))
+                    for (k, s), v in self.stage_seconds.items()
+                ],
+            )
+            for name in sorted({name for _, name in self.counters}):
+                metric(
+                    f"db_backup_{name}_total",
+                    "counter",
+                    f"Total {name.replace('_', ' ')}.",
+                    [
+                        ({"kind": k}, v)
+                        for (k, n), v in self.counters.items()
+                        if n == name
+                    ],
+                )
+            metric(
+                "db_backup_queue_wait_seconds_total",
+                "counter",
+                "Time jobs spent queued before running.",
+                [({}, round(self.queue_wait_seconds, 6))],
+            )
+            metric(
+                "db_backup_queued_jobs_total",
+                "counter",
+                "Jobs that waited in the queue.",
+                [({}, self.queue_wait_count)],
+            )
+            last = sorted(self.last_runs.items(), key=lambda item: item[0])
+            metric(
+                "db_backup_last_duration_seconds",
+                "gauge",
+                "Duration of the last run per config var.",
+                [
+                    ({"kind": k, "config_var": c}, summary["duration"])
+                    for (k, c), (summary, _, _) in last
+                ],
+            )
+            metric(
+                "db_backup_last_success",
+                "gauge",
+                "Whether the last run per config var succeeded, or was skipped.",
+                [
+                    ({"kind": k, "config_var": c}, int(status != "failed"))
+                    for (k, c), (_, status, _) in last
+                ],
+            )
+            metric(
+                "db_backup_last_run_timestamp_seconds",
+                "gauge",
+                "When the last run per config var finished.",
+                [
+                    ({"kind": k, "config_var": c}, round(finished, 3))
+                    for (k, c), (_, _, finished) in last
+                ],
+            )
+            metric(
+                "db_backup_last_compression_ratio",
+                "gauge",
+                "Compression ratio of the last run per config var.",
+                [
+                    ({"kind": k, "config_var": c}, summary["compression_ratio"])
+                    for (k, c), (summary, _, _) in last
+                    if summary["compression_ratio"] is not None
+                ],
+            )
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+
+@contextmanager
+def track_run(kind, config_var):
+    """
+    Collects the metrics of a run in the current context, and adds them to the
+    process registry when it ends. A run that raises, or exits, is recorded as
+    failed, and one that was skipped as skipped.
+    Parameters:
+    kind (str): The kind of run, such as 'backup' or 'restore'.
+    config_var (str): The config var of the database.
+    Yields:
+    RunMetrics: The metrics of the run.
+    """
+    run = RunMetrics(kind, config_var)
+    token = _current_run.set(run)
+    status = "failed"
+    try:
+        yield run
+        status = "skipped" if run.skipped else "success"
+    finally:
+        _current_run.reset(token)
+        run.finish(status)
+        REGISTRY.record(run)
+        logging.info(f"[track_run] {kind} {config_var} {status}: {run.summary()}")
+
+
+def add_time(stage, seconds):
+    """
+    Adds time to a stage of the run in the current context, if any.
+    """
+    run = _current_run.get()
+    if run is not None:
+        run.add_time(stage, seconds)
+
+
+def count(name, value=1):
+    """
+    Increments a counter of the run in the current context, if any.
+    """
+    run = _current_run.get()
+    if run is not None:
+        run.count(name, value)
+
+
+@contextmanager
+def stage(name):
+    """
+    Times a block of code as a stage of the run in the current context.
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        add_time(name, time.monotonic() - start)
+
+
+def count_bytes(chunks, name):
+    """
+    Passes a stream of chunks through, counting their bytes in a counter.
+    """
+    for chunk in chunks:
+        count(name, len(chunk))
+        yield chunk
+
+
+def mark_end(chunks, ends):
+    """
+    Passes a stream of chunks through, appending the time it ended to `ends`,
+    so the work its consumer does after the last chunk can be timed.
+    """
+    yield from chunks
+    ends.append(time.monotonic())
+
+
+def record_queue_wait(seconds):
+    """
+    Records how long a job waited in the queue. Runs started in the current
+    context afterwards report it in their summary.
+    """
+    _queue_wait.set(seconds)
+    REGISTRY.record_queue_wait(seconds)
+
+
+PROFILE_MODES = ("cprofile", "tracemalloc")
+
+# Held by the run being profiled. Both profilers would mix up the runs of
+# concurrent backups, tracemalloc is even started and stopped for the process.
+_profiling = threading.Lock()
+
+
+@contextmanager
+def profile_run(mode, name):
+    """
+    Profiles a single run, asked for with the run's own profile option. With
+    'cprofile', the stats are written to `<name>.prof` and the slowest
+    functions are logged. cProfile only sees the calling thread, so the time
+    spent in the worker threads of the pipeline (part uploads, parallel
+    compression, fan-out readers, the parallel MySQL engine) only shows as the
+    time the run waited on them. With 'tracemalloc', the peak memory and the
+    lines that allocated the most are logged, for every thread. Only one run
+    is profiled at a time, the others run without profiling.
+    Parameters:
+    mode (str): 'cprofile', 'tracemalloc', or None to disable profiling.
+    name (str): The name of the run, used for the stats file.
+    """
+    if mode not in PROFILE_MODES:
+        yield
+        return
+    if not _profiling.acquire(blocking=False):
+        logging.warning(
+            f"[profile_run] Another run is being profiled, not profiling {name}"
+        )
+        yield
+        return
+    try:
+        if mode == "cprofile":
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                profiler.dump_stats(f"{name}.prof")
+                output = io.StringIO()
+                pstats.Stats(profiler, stream=output).sort_stats(
+                    "cumulative"
+                ).print_stats(20)
+                logging.info(
+                    f"[profile_run] Profile saved to {name}.prof\n{output.getvalue()}"
+                )
+        else:
+            tracemalloc.start()
+            try:
+                yield
+            finally:
+                snapshot = tracemalloc.take_snapshot()
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                top = "\n".join(
+                    str(statistic) for statistic in snapshot.statistics("lineno")[:10]
+                )
+                logging.info(
+                    f"[profile_run] Peak traced memory: {peak / 1e6:.1f} MB\n{top}"
+                )
+    finally:
+        _profiling.release()
@@ -0,0 +1,227 @@
+import contextvars
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from .cache import cached_read
+from .catalog import find_backups
+from .compression import get_decompressor
+from .db_backups import (
+    DB_RESTORE_FUNCTIONS,
+    open_copy_restore_postgres,
+    restore_backup_postgres_directory,
+)
+from .dedup import CHUNK_PREFIX, MANIFEST_SUFFIX, iter_manifest_data
+from .encryption import download_plain_stream, plain_name
+from .incremental import CHAIN_SUFFIX, iter_chain_sql
+from .sharding import SHARDS_SUFFIX, iter_part_data, iter_shards_sql
+from . import metrics
+from .jobs import report_progress
+from .util import parse_backup_timestamp
+
+
+def is_restorable(file_name):
+    """
+    Tells whether a destination file is a backup that can be restored on its own,
+    rather than a dedup chunk, an increment that only makes sense in its chain,
+    a part of a sharded backup or a base backup for point-in-time recovery.
+    """
+    if file_name.startswith(CHUNK_PREFIX) or ".inc." in file_name:
+        return False
+    if ".base." in file_name:
+        return False
+    if parse_backup_timestamp(file_name) is None:
+        return False
+    if ".shard" in file_name and not file_name.endswith(SHARDS_SUFFIX):
+        return False
+    file_name = plain_name(file_name)
+    return (
+        file_name.endswith((MANIFEST_SUFFIX, CHAIN_SUFFIX, SHARDS_SUFFIX, ".tar"))
+        or get_decompressor(file_name) is not None
+    )
+
+
+def find_latest_backup(destination, database):
+    """
+    Finds the most recent restorable backup of a database in its catalog,
+    leaving out labelled backups. A full base that has a chain manifest is
+    replaced by its chain, so the increments taken on top of it are restored too.
+    Parameters:
+    destination (module): The destination module.
+    database (str): The name of the database.
+    Returns:
+    str: The name of the latest backup, or None if there is none.
+    """
+    entries = [
+        entry
+        for entry in find_backups(destination, database)
+        if entry["label"] is None and is_restorable(entry["file"])
+    ]
+    chains = {
+        entry["file"][: -len(CHAIN_SUFFIX)]
+        for entry in entries
+        if entry["format"] == "chain"
+    }
+    candidates = [
+        entry
+        for entry in entries
+        if entry["format"] == "chain" or entry["file"].split(".", 1)[0] not in chains
+    ]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda entry: entry["timestamp"])["file"]
+
+
+def iter_backup_data(destination, file_name, chunk_size=1024 * 1024):
+    """
+    Streams a backup from the destination as its uncompressed content: a logical
+    dump for compressed files, chains, dedup manifests and sharded backups, or the
+    raw archive for directory-format `.tar` backups. Encrypted backups are
+    decrypted on the fly. Nothing is written to disk, but for the copies kept
+    in the local cache when CACHE_DIR is set.
+    Parameters:
+    destination (module): The destination module.
+    file_name (str): The name of the backup at the destination.
+    chunk_size (int): The download chunk size.
+    Yields:
+    bytes: The backup content, chunk by chunk.
+    """
+    if file_name.endswith((MANIFEST_SUFFIX, CHAIN_SUFFIX, SHARDS_SUFFIX)):
+        content = cached_read(destination, file_name)
+        if content is None:
+            raise RuntimeError(f"Manifest not found: {file_name}")
+        if file_name.endswith(MANIFEST_SUFFIX):
+            yield from iter_manifest_data(destination, json.loads(content))
+        elif file_name.endswith(SHARDS_SUFFIX):
+            yield from iter_shards_sql(destination, json.loads(content), chunk_size)
+        else:
+            yield from iter_chain_sql(json.loads(content), chunk_size)
+        return
+
+    decompressor = get_decompressor(plain_name(file_name))
+    for chunk in download_plain_stream(destination, file_name, chunk_size):
+        yield decompressor.decompress(chunk) if decompressor else chunk
+
+
+def pipe_to_process(chunks, process):
+    """
+    Writes a stream of chunks to a process's stdin and waits for it to exit.
+    If the stream fails part way, the process is killed before its input is
+    closed, so a partial dump is never committed as if it were complete.
+    Parameters:
+    chunks (iterable): An iterable of bytes objects.
+    process (subprocess.Popen): A process started with stdin=PIPE.
+    Returns:
+    bool: True if the whole stream was written and the process exited cleanly.
+    """
+    total = 0
+    try:
+        for chunk in chunks:
+            process.stdin.write(chunk)
+            total += len(chunk)
+            metrics.count("bytes_restored", len(chunk))
+            report_progress("restore", bytes=total)
+        process.stdin.close()
+    except BrokenPipeError:
+        # The process exited early, its return code tells why
+        pass
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    return process.wait() == 0
+
+
+def restore_stream(destination, file_name, db_url, database_type, chunk_size):
+    """
+    Restores a logical backup by piping it, decompressed on the fly, into
+    `psql` or `mysql`.
+    Returns:
+    bool: True if the restore succeeded, False otherwise.
+    """
+    process = DB_RESTORE_FUNCTIONS[database_type](db_url)
+    try:
+        return pipe_to_process(
+            iter_backup_data(destination, file_name, chunk_size), process
+        )
+    except Exception as e:
+        logging.error(f"[restore_stream] Error restoring {file_name}: {str(e)}")
+        return False
+
+
+def restore_directory_archive(destination, file_name, db_url, jobs, chunk_size):
+    """
+    Restores a directory-format PostgreSQL backup with parallel `pg_restore -j`.
+    Parallel restore reads the table files at random, so unlike the other backup
+    kinds the archive has to land on disk: it is streamed straight into `tar -x`
+    and the extracted directory is removed once the restore is done.
+    Returns:
+    bool: True if the restore succeeded, False otherwise.
+    """
+    scratch = tempfile.mkdtemp(prefix="restore_")
+    try:
+        process = subprocess.Popen(
+            ["tar", "-xf", "-", "-C", scratch], stdin=subprocess.PIPE
+        )
+        if not pipe_to_process(
+            iter_backup_data(destination, file_name, chunk_size), process
+        ):
+            logging.error(f"[restore_directory_archive] Error extracting {file_name}")
+            return False
+        backup_directory = os.path.join(scratch, plain_name(file_name)[: -len(".tar")])
+        return restore_backup_postgres_directory(db_url, backup_directory, jobs)
+    except Exception as e:
+        logging.error(
+            f"[restore_directory_archive] Error restoring {file_name}: {str(e)}"
+        )
+        return False
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def restore_shards(destination, file_name, db_url, database_type, jobs, chunk_size):
+    """
+    Restores a sharded backup: the schema first, then the rows of every table and
+    every shard with up to `jobs` parts loaded at once, then the indexes,
+    constraints and triggers. Each part is loaded in its own session, so unlike a
+    single-stream restore a failure part way leaves a partly restored database.
+    Returns:
+    bool: True if every part was restored, False otherwise.
+    """
+    try:
+        content = cached_read(destination, file_name)
+        if content is None:
+            raise RuntimeError(f"Manifest not found: {file_name}")
+        manifest = json.loads(content)
+    except Exception as e:
+        logging.error(f"[restore_shards] Error reading {file_name}: {str(e)}")
+        return False
+
+    def restore_part(part):
+        if part["format"] == "copy":
+            process = open_copy_restore_postgres(
+                db_url, part["table"], part.get("columns")
+            )
+        else:
+            process = DB_RESTORE_FUNCTIONS[database_type](db_url)
+        try:
+            if pipe_to_process(iter_part_data(destination, part, chunk_size), process):
+                return True
+            logging.error(f"[restore_shards] Error restoring {part['file']}")
+        except Exception as e:
+            logging.error(f"[restore_shards] Error restoring {part['file']}: {str(e)}")
+        return False
+
+    for stage in ("pre", "data", "post"):
+        parts = [part for part in manifest["parts"] if part["stage"] == stage]
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            futures = [
+                executor.submit(contextvars.copy_context().run, restore_part, part)
+                for part in parts
+            ]
+        if not all(future.result() for future in futures):
+            return False
+    return True
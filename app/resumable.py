@@ -0,0 +1,93 @@
+import json
+import logging
+import threading
+
+JOURNAL_PREFIX = "journal_"
+
+
+def journal_name(series):
+    return f"{JOURNAL_PREFIX}{series}.json"
+
+
+class UploadJournal:
+    """
+    The state of an in-flight streaming upload, kept at the destination next to
+    the backups, so a new dyno can resume an upload that a restart cut short.
+    There is one journal per series of backups, `[<label>_]<database>`.
+    The destination modules record the upload they started (the S3 multipart
+    upload ID or the FTP partial file) and the SHA-256 of every part they sent.
+    A dump cannot be resumed, so a resumed backup re-runs it, and the parts of
+    the new stream that hash the same as a recorded part are not sent again.
+    Parameters:
+    destination (module): The destination module.
+    series (str): The backup name without its timestamp.
+    """
+
+    def __init__(self, destination, series):
+        self.destination = destination
+        self.name = journal_name(series)
+        self._lock = threading.Lock()
+        content, _ = destination.read_versioned_from_destination(self.name)
+        self.state = json.loads(content) if content else {}
+
+    def _write(self):
+        content = json.dumps(self.state).encode()
+        if not self.destination.upload_to_destination(self.name, content):
+            logging.warning(f"[UploadJournal] Could not save the journal {self.name}")
+
+    def start(self, file_name):
+        """
+        Starts a new journal for an upload, replacing any previous state.
+        """
+        with self._lock:
+            self.state = {"file": file_name, "parts": {}}
+            self._write()
+
+    def save(self, **fields):
+        with self._lock:
+            self.state.update(fields)
+            self._write()
+
+    def add_part(self, number, part):
+        """
+        Records a part once the destination has stored it. Parts may complete
+        in any order, from several threads.
+        """
+        with self._lock:
+            self.state.setdefault("parts", {})[str(number)] = part
+            self._write()
+
+    def parts(self):
+        with self._lock:
+            return dict(self.state.get("parts", {}))
+
+    def clear(self):
+        """
+        Removes the journal once its upload completed.
+        """
+        with self._lock:
+            self.state = {}
+            self.destination.delete_file_from_destination(self.name)
+
+
+def resume_or_start(destination, series, file_name):
+    """
+    Opens the journal of a series. An upload of the same format left unfinished
+    by a previous run is resumed under its original name, otherwise a new
+    upload is journaled under `file_name`.
+    Parameters:
+    destination (module): The destination module.
+    series (str): The backup name without its timestamp.
+    file_name (str): The name of a new backup of the series.
+    Returns:
+    tuple: The journal, and the name to upload the backup as.
+    """
+    journal = UploadJournal(destination, series)
+    previous = journal.state.get("file")
+    # The extension follows the `_<timestamp>` after the series
+    extension = file_name[len(series) + 15 :]
+    if previous and previous[len(series) + 15 :] == extension:
+        logging.info(f"[resume_or_start] Resuming the interrupted upload of {previous}")
+        return journal, previous
+    journal.start(file_name)
+    return journal, file_name
@@ -0,0 +1,190 @@
+import os
+from datetime import datetime, timedelta
+from .incremental import CHAIN_SUFFIX
+
+# Tier name and the strftime format of the period it keeps one backup for,
+# finest first. Weeks are ISO weeks, so they never straddle two years.
+TIERS = (
+    ("hourly", "%Y%m%d%H"),
+    ("daily", "%Y%m%d"),
+    ("weekly", "%G%V"),
+    ("monthly", "%Y%m"),
+)
+TIER_NAMES = [name for name, _ in TIERS]
+
+# Steps between the moments sampled to list the periods a backup covers, small
+# enough not to skip a period
+PERIOD_STEPS = {
+    "hourly": timedelta(hours=1),
+    "daily": timedelta(days=1),
+    "weekly": timedelta(days=1),
+    "monthly": timedelta(days=1),
+}
+
+
+def _parse_tier_map(text):
+    mapping = {}
+    for item in filter(None, (part.strip() for part in text.split(","))):
+        name, _, value = item.partition("=")
+        name = name.strip().lower()
+        if name not in TIER_NAMES or not value.strip():
+            raise ValueError(f"Invalid retention setting: {item}")
+        mapping[name] = value.strip()
+    return mapping
+
+
+def parse_policy(text):
+    """
+    Parses a retention policy such as `hourly=24,daily=7,weekly=4,monthly=12`.
+    Tiers that are left out keep nothing.
+    Returns:
+    dict: The number of backups to keep per tier.
+    Raises:
+    ValueError: If the policy is malformed or would keep nothing at all.
+    """
+    try:
+        policy = {name: int(count) for name, count in _parse_tier_map(text).items()}
+    except ValueError as e:
+        raise ValueError(f"Invalid retention policy {text!r}: {str(e)}")
+    if any(count < 0 for count in policy.values()) or not any(policy.values()):
+        raise ValueError(f"Invalid retention policy {text!r}: it must keep something")
+    return policy
+
+
+def parse_storage_classes(text):
+    """
+    Parses the S3 storage class of each tier, such as
+    `weekly=STANDARD_IA,monthly=GLACIER_IR`.
+    Returns:
+    dict: The storage class per tier.
+    """
+    return {
+        name: storage_class.upper()
+        for name, storage_class in _parse_tier_map(text or "").items()
+    }
+
+
+def resolve_policy(config, db_var, label=None):
+    """
+    Finds the policy of a series of backups. Labelled backups are only retained
+    by `RETENTION_POLICY_<LABEL>`, with the label upper-cased and dashes
+    replaced by underscores. Unlabelled backups are retained by
+    `RETENTION_POLICY_<CONFIG_VAR>`, then `RETENTION_POLICY`.
+    Returns:
+    dict: The parsed policy, or None if no policy applies.
+    """
+    if label:
+        name = f"RETENTION_POLICY_{label.upper().replace('-', '_')}"
+        return parse_policy(os.getenv(name)) if os.getenv(name) else None
+    name = f"RETENTION_POLICY_{db_var}"
+    if os.getenv(name):
+        return parse_policy(os.getenv(name))
+    if config["RETENTION_POLICY"]:
+        return parse_policy(config["RETENTION_POLICY"])
+    return None
+
+
+def validate_policies(config):
+    """
+    Parses every configured retention policy, so a malformed one is reported
+    before anything is deleted.
+    Raises:
+    ValueError: If a policy is malformed.
+    """
+    if config["RETENTION_POLICY"]:
+        parse_policy(config["RETENTION_POLICY"])
+    for name, value in os.environ.items():
+        if name.startswith("RETENTION_POLICY_") and value:
+            parse_policy(value)
+
+
+def retention_units(entries):
+    """
+    Picks the catalog entries that retention decides on. Increments and the
+    base of a chain, like the parts of a sharded backup, are restored through
+    their manifest, so they are kept or deleted together with it rather than on
+    their own.
+    """
+    chains = {
+        entry["file"][: -len(CHAIN_SUFFIX)]
+        for entry in entries
+        if entry["format"] == "chain"
+    }
+    return [
+        entry
+        for entry in entries
+        if entry["format"] not in ("incremental", "shard")
+        and (entry["format"] == "chain" or entry["file"].split(".", 1)[0] not in chains)
+    ]
+
+
+def covered_periods(entry, tier):
+    """
+    Lists the periods of a tier a backup stands for, newest first: the one it
+    was taken in, and when later runs were skipped because the database had
+    not changed, every period up to the last of them (`unchanged_until`).
+    Yields:
+    str: The periods, formatted like the tier's period format.
+    """
+    period_format = dict(TIERS)[tier]
+    created = datetime.strptime(entry["timestamp"], "%Y%m%d%H%M%S")
+    moment = datetime.strptime(
+        entry.get("unchanged_until") or entry["timestamp"], "%Y%m%d%H%M%S"
+    )
+    previous = None
+    while moment > created:
+        period = moment.strftime(period_format)
+        if period != previous:
+            previous = period
+            yield period
+        moment -= PERIOD_STEPS[tier]
+    if created.strftime(period_format) != previous:
+        yield created.strftime(period_format)
+
+
+def plan_retention(entries, policy, storage_classes=None):
+    """
+    Decides which backups of one series a grandfather-father-son policy keeps,
+    in a single pass from the newest backup to the oldest. Each tier keeps the
+    newest backup of each of its most recent periods, so a backup can be kept
+    by several tiers at once. A backup also stands for the periods of the runs
+    skipped after it because the database had not changed, so a skipped hour
+    still takes an hourly slot. Kept backups only held by coarser tiers can be
+    moved to a cheaper storage class, chosen by the finest tier that keeps them.
+    Parameters:
+    entries (list): The catalog entries of the series.
+    policy (dict): The number of backups to keep per tier.
+    storage_classes (dict): The storage class per tier, if any.
+    Returns:
+    list: One decision per entry, newest first, with the tiers that keep it and
+    the storage class it should be in.
+    """
+    storage_classes = storage_classes or {}
+    last_period = {}
+    kept = dict.fromkeys(TIER_NAMES, 0)
+    decisions = []
+    for entry in sorted(entries, key=lambda entry: entry["timestamp"], reverse=True):
+        tiers = []
+        for name in TIER_NAMES:
+            for period in covered_periods(entry, name):
+                if kept[name] >= policy.get(name, 0):
+                    break
+                # A newer backup already holds this period
+                if name in last_period and period >= last_period[name]:
+                    continue
+                last_period[name] = period
+                kept[name] += 1
+                if name not in tiers:
+                    tiers.append(name)
+        decisions.append(
+            {
+                "file": entry["file"],
+                "label": entry["label"],
+                "timestamp": entry["timestamp"],
+                "format": entry["format"],
+                "keep": bool(tiers),
+                "tiers": tiers,
+                "storage_class": storage_classes.get(tiers[0]) if tiers else None,
+            }
+        )
+    return decisions
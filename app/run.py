@@ -1,19 +1,130 @@
-from .backup_manager import manual_backup, trim_backup_history
+from .backup_manager import (
+    manual_backup,
+    batch_backup,
+    trim_backup_history,
+    rebuild_backup,
+    restore_backup,
+    list_backups,
+    apply_retention,
+    verify_backup_integrity,
+    archive_logs,
+    restore_to_time,
+)
+from .compression import compare_codecs
+from .metrics import PROFILE_MODES
 import sys
 
 if __name__ == "__main__":
     if len(sys.argv) > 1:
         if sys.argv[1] == "manual_backup":
-            manual_backup(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
+            args = [arg for arg in sys.argv[2:] if not arg.startswith("--profile=")]
+            profile = next(
+                (
+                    arg[len("--profile=") :]
+                    for arg in sys.argv[2:]
+                    if arg.startswith("--profile=")
+                ),
+                None,
+            )
+            if profile and profile not in PROFILE_MODES:
+                print(
+                    f"Invalid profile: {profile}, use one of {', '.join(PROFILE_MODES)}"
+                )
+                sys.exit(1)
+            manual_backup(args[0], args[1] if len(args) > 1 else None, profile)
+        elif sys.argv[1] == "batch_backup":
+            db_vars = sys.argv[2] if len(sys.argv) > 2 else "all"
+            results = batch_backup(
+                None if db_vars == "all" else db_vars.split(","),
+                sys.argv[3] if len(sys.argv) > 3 else None,
+            )
+            for result in results:
+                print(
+                    f"{result['config_var']}: {result['status']} ({result['duration']}s) {result['backup_file'] or result['error']}"
+                )
+            if any(result["status"] != "success" for result in results):
+                sys.exit(1)
+        elif sys.argv[1] == "compare_codecs":
+            print(
+                f"{'codec':<8}{'level':>6}{'threads':>8}{'seconds':>10}{'MB/s':>10}{'ratio':>8}"
+            )
+            for result in compare_codecs(sys.argv[2]):
+                print(
+                    f"{result['codec']:<8}{result['level']:>6}{result['threads']:>8}{result['seconds']:>10}{result['mb_per_s']:>10}{result['ratio']:>8}"
+                )
+        elif sys.argv[1] == "rebuild_backup":
+            if len(sys.argv) > 3:
+                with open(sys.argv[3], "wb") as output:
+                    rebuild_backup(sys.argv[2], output)
+            else:
+                rebuild_backup(sys.argv[2], sys.stdout.buffer)
+        elif sys.argv[1] == "restore":
+            restore_backup(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
+        elif sys.argv[1] in ("list_backups", "rebuild_catalog"):
+            entries = list_backups(
+                sys.argv[2],
+                sys.argv[3] if len(sys.argv) > 3 else None,
+                rebuild=sys.argv[1] == "rebuild_catalog",
+            )
+            print(
+                f"{'file':<60}{'label':<16}{'timestamp':<16}{'size':>14}  {'codec':<6}{'format':<13}checksum"
+            )
+            for entry in entries:
+                print(
+                    f"{entry['file']:<60}{entry['label'] or '':<16}{entry['timestamp']:<16}{entry['size'] if entry['size'] is not None else '':>14}  {entry['codec'] or '':<6}{entry['format']:<13}{(entry['checksum'] or '')[:16]}"
+                )
+        elif sys.argv[1] in ("apply_retention", "plan_retention"):
+            result = apply_retention(
+                sys.argv[2],
+                sys.argv[3] if len(sys.argv) > 3 else None,
+                dry_run=sys.argv[1] == "plan_retention",
+            )
+            print(
+                f"{'file':<60}{'label':<16}{'action':<8}{'tiers':<30}{'storage class'}"
+            )
+            for decision in result["plan"]:
+                print(
+                    f"{decision['file']:<60}{decision['label'] or '':<16}{'keep' if decision['keep'] else 'delete':<8}{','.join(decision['tiers']):<30}{decision['storage_class'] or ''}"
+                )
+            if result.get("failed"):
+                sys.exit(1)
+        elif sys.argv[1] in ("verify", "verify_restore"):
+            backup_file = sys.argv[3] if len(sys.argv) > 3 else None
+            result = verify_backup_integrity(
+                sys.argv[2],
+                None if backup_file == "sample" else backup_file,
+                restore=sys.argv[1] == "verify_restore",
+                sample=backup_file == "sample",
+            )
+            print(f"{'destination':<16}{'file':<60}{'result':<8}errors")
+            for name, reports in result["destinations"].items():
+                for report in reports:
+                    print(
+                        f"{name:<16}{report['file']:<60}{'ok' if report['ok'] else 'FAILED':<8}{'; '.join(report['errors'])}"
+                    )
+            if result["restore"]:
+                print(
+                    f"Test restore: {result['restore']['tables']} tables restored"
+                    if result["restore"]["ok"]
+                    else f"Test restore: FAILED, {result['restore']['error']}"
+                )
+            if not result["ok"]:
+                sys.exit(1)
         elif sys.argv[1] == "trim_history":
             trim_backup_history(sys.argv[2], sys.argv[3])
+        elif sys.argv[1] == "archive":
+            archive_logs(sys.argv[2])
+        elif sys.argv[1] == "restore_to_time":
+            restore_to_time(
+                sys.argv[2], sys.argv[3], sys.argv[4] if len(sys.argv) > 4 else None
+            )
         else:
             print(
-                "Usage: python -m app.run [manual_backup|trim_history] [CONFIG_VAR] [LABEL|DAYS]"
+                "Usage: python -m app.run [manual_backup|batch_backup|trim_history|apply_retention|plan_retention|restore|restore_to_time|archive|verify|verify_restore|list_backups|rebuild_catalog|compare_codecs|rebuild_backup] [CONFIG_VAR|CONFIG_VAR,...|all|SAMPLE_FILE|MANIFEST] [LABEL|DAYS|POLICY|BACKUP_FILE|TIME|sample|OUTPUT_FILE] [DATA_DIRECTORY]"
             )
             sys.exit(1)
     else:
         print(
-            "Usage: python -m app.run [manual_backup|trim_history] [CONFIG_VAR] [LABEL|DAYS]"
+            "Usage: python -m app.run [manual_backup|batch_backup|trim_history|apply_retention|plan_retention|restore|restore_to_time|archive|verify|verify_restore|list_backups|rebuild_catalog|compare_codecs|rebuild_backup] [CONFIG_VAR|CONFIG_VAR,...|all|SAMPLE_FILE|MANIFEST] [LABEL|DAYS|POLICY|BACKUP_FILE|TIME|sample|OUTPUT_FILE] [DATA_DIRECTORY]"
         )
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
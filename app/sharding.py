@@ -0,0 +1,380 @@
+import fnmatch
+import math
+from contextlib import contextmanager
+from .compression import get_decompressor
+from .encryption import download_plain_stream, plain_name
+from .db_backups import (
+    DB_QUERY_FUNCTIONS,
+    DB_STREAM_FUNCTIONS,
+    open_copy_stream_postgres,
+    open_snapshot_mysql,
+    open_snapshot_postgres,
+)
+from .util import parse_connection_url
+
+SHARDS_SUFFIX = ".shards.json"
+
+# Every table with its size and, when its primary key is a single integer
+# column, the name of that column. Names are quoted and schema-qualified, since
+# pg_dump output clears the search path.
+POSTGRES_TABLES_QUERY = """
+SELECT quote_ident(n.nspname) || '.' || quote_ident(c.relname),
+       pg_table_size(c.oid),
+       coalesce(quote_ident(a.attname), '')
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+LEFT JOIN pg_index i ON i.indrelid = c.oid AND i.indisprimary AND i.indnkeyatts = 1
+LEFT JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = i.indkey[0]
+    AND a.atttypid IN ('int2'::regtype, 'int4'::regtype, 'int8'::regtype)
+WHERE c.relkind = 'r'
+  AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+  AND n.nspname NOT LIKE 'pg\\_%'
+"""
+
+MYSQL_TABLES_QUERY = """
+SELECT t.TABLE_NAME, COALESCE(t.DATA_LENGTH, 0),
+       IF(COUNT(k.COLUMN_NAME) = 1
+          AND MAX(k.DATA_TYPE) IN ('tinyint', 'smallint', 'mediumint', 'int', 'bigint'),
+          MAX(k.COLUMN_NAME), '')
+FROM information_schema.TABLES t
+LEFT JOIN information_schema.COLUMNS k
+    ON k.TABLE_SCHEMA = t.TABLE_SCHEMA AND k.TABLE_NAME = t.TABLE_NAME
+    AND k.COLUMN_KEY = 'PRI'
+WHERE t.TABLE_SCHEMA = DATABASE() AND t.TABLE_TYPE = 'BASE TABLE'
+GROUP BY t.TABLE_NAME, t.DATA_LENGTH
+"""
+
+TABLES_QUERIES = {"postgres": POSTGRES_TABLES_QUERY, "mysql": MYSQL_TABLES_QUERY}
+
+# The columns the rows of a PostgreSQL shard are copied with. Generated columns
+# are computed again on restore and cannot be copied into.
+POSTGRES_COLUMNS_QUERY = """
+SELECT quote_ident(attname)
+FROM pg_attribute
+WHERE attrelid = '{table}'::regclass AND attnum > 0
+  AND NOT attisdropped AND attgenerated = ''
+ORDER BY attnum
+"""
+
+
+def _quote_mysql(name):
+    return "`" + name.replace("`", "``") + "`"
+
+
+def parse_table_list(text):
+    return [name.strip() for name in (text or "").split(",") if name.strip()]
+
+
+def table_filter(config):
+    """
+    Returns:
+    tuple: The BACKUP_INCLUDE_TABLES and BACKUP_EXCLUDE_TABLES patterns.
+    """
+    return (
+        parse_table_list(config["BACKUP_INCLUDE_TABLES"]),
+        parse_table_list(config["BACKUP_EXCLUDE_TABLES"]),
+    )
+
+
+def is_selected(table, include, exclude):
+    """
+    Tells whether a table passes the include and exclude filters. Patterns use
+    shell-style wildcards and match the table name with or without its schema.
+    """
+
+    def matches(patterns):
+        names = (table, table.rsplit(".", 1)[-1].replace('"', ""))
+        return any(
+            fnmatch.fnmatchcase(name, pattern) for pattern in patterns for name in names
+        )
+
+    return (not include or matches(include)) and not matches(exclude)
+
+
+def table_filter_args(config, db_url, database_type):
+    """
+    Translates the table filters into arguments of the dump functions. pg_dump
+    matches the patterns itself, with `-t` and `-T`. mysqldump only takes plain
+    names, so the patterns are matched against the tables of the database.
+    Parameters:
+    config (dict): The app config.
+    db_url (str): The database connection URL.
+    database_type (str): 'postgres' or 'mysql'.
+    Returns:
+    tuple: The extra dump arguments, and the tables to dump or None for all of them.
+    Raises:
+    ValueError: If the filters leave no table to dump.
+    """
+    include, exclude = table_filter(config)
+    if not include and not exclude:
+        return [], None
+    if database_type == "postgres":
+        return [arg for pattern in exclude for arg in ("-T", pattern)], include or None
+
+    tables = [row[0] for row in DB_QUERY_FUNCTIONS["mysql"](db_url, MYSQL_TABLES_QUERY)]
+    selected = [table for table in tables if is_selected(table, include, exclude)]
+    if not selected:
+        raise ValueError("The table filters leave no table to back up")
+    if include:
+        return [], selected
+    database_name = parse_connection_url(db_url)["database_name"]
+    return [
+        f"--ignore-table={database_name}.{table}"
+        for table in tables
+        if table not in selected
+    ], None
+
+
+def _split_range(low, high, count):
+    """
+    Splits the keys from `low` to `high` into `count` ranges of about the same
+    width. The first and last ranges are open, so rows inserted outside of the
+    bounds before the snapshot was taken are not lost.
+    Returns:
+    list: (lower, upper) bounds, lower included and upper excluded, None when open.
+    """
+    bounds = sorted({low + (high - low + 1) * i // count for i in range(1, count)})
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+def list_tables(db_url, database_type, include=(), exclude=()):
+    """
+    Returns:
+    list: The tables that pass the filters, largest first.
+    """
+    rows = DB_QUERY_FUNCTIONS[database_type](db_url, TABLES_QUERIES[database_type])
+    return [
+        table
+        for table, size, key in sorted(rows, key=lambda row: -int(row[1]))
+        if is_selected(table, include, exclude)
+    ]
+
+
+def plan_shards(db_url, database_type, shard_size, include=(), exclude=()):
+    """
+    Picks the tables larger than `shard_size` and splits each into ranges of its
+    primary key, about `shard_size` bytes each if the keys are evenly spread.
+    Only tables with a single integer primary key column can be split.
+    Parameters:
+    db_url (str): The database connection URL.
+    database_type (str): 'postgres' or 'mysql'.
+    shard_size (int): The table size above which a table is sharded, in bytes.
+    include (list): Only shard tables matching these patterns.
+    exclude (list): Never shard tables matching these patterns.
+    Returns:
+    list: One dict per shard with its table, key column and key range, and on
+    PostgreSQL the columns its rows are copied with.
+    """
+    run_query = DB_QUERY_FUNCTIONS[database_type]
+    shards = []
+    for table, size, key in run_query(db_url, TABLES_QUERIES[database_type]):
+        if not key or int(size) <= shard_size:
+            continue
+        if not is_selected(table, include, exclude):
+            continue
+        if database_type == "postgres":
+            query = f"SELECT min({key}), max({key}) FROM ONLY {table}"
+        else:
+            query = f"SELECT MIN({_quote_mysql(key)}), MAX({_quote_mysql(key)}) FROM {_quote_mysql(table)}"
+        low, high = run_query(db_url, query)[0]
+        # An empty table has no bounds
+        if low in ("", "NULL"):
+            continue
+        shard = {"table": table, "key": key}
+        if database_type == "postgres":
+            shard["columns"] = [
+                row[0]
+                for row in run_query(
+                    db_url,
+                    POSTGRES_COLUMNS_QUERY.format(table=table.replace("'", "''")),
+                )
+            ]
+        for lower, upper in _split_range(
+            int(low), int(high), math.ceil(int(size) / shard_size)
+        ):
+            shards.append(dict(shard, range=[lower, upper]))
+    return shards
+
+
+def plan_parts(database_type, shards, tables=None, whole_tables=None):
+    """
+    Lists the parts of a sharded backup in restore order: the schema, the rows of
+    the tables that are not sharded, the shards, then the indexes, constraints
+    and triggers, so the shards of a table can be loaded in parallel.
+    Parameters:
+    database_type (str): 'postgres' or 'mysql'.
+    shards (list): The shards, see `plan_shards`.
+    tables (list): The tables the backup is limited to, if any.
+    whole_tables (list): The tables that are not sharded, each dumped as its
+    own part by the parallel MySQL engine. Otherwise they are dumped together.
+    Returns:
+    list: One dict per part with its stage ('pre', 'data' or 'post'), format
+    ('sql', or 'copy' for the rows of a PostgreSQL shard), table and key range,
+    and the columns of a 'copy' part.
+    """
+    sharded = {shard["table"] for shard in shards}
+    parts = [{"stage": "pre", "format": "sql", "table": None}]
+    if whole_tables is not None:
+        for table in whole_tables:
+            if table not in sharded:
+                parts.append(
+                    {
+                        "stage": "data",
+                        "format": "sql",
+                        "table": table,
+                        "key": None,
+                        "range": None,
+                    }
+                )
+    # mysqldump dumps every table when given none
+    elif database_type == "postgres" or not tables or set(tables) - sharded:
+        parts.append({"stage": "data", "format": "sql", "table": None})
+    for shard in shards:
+        part = {
+            "stage": "data",
+            "format": "copy" if database_type == "postgres" else "sql",
+            "table": shard["table"],
+            "key": shard["key"],
+            "range": shard["range"],
+        }
+        if "columns" in shard:
+            part["columns"] = shard["columns"]
+        parts.append(part)
+    parts.append({"stage": "post", "format": "sql", "table": None})
+    return parts
+
+
+def _range_condition(key, lower, upper):
+    conditions = []
+    if lower is not None:
+        conditions.append(f"{key} >= {lower}")
+    if upper is not None:
+        conditions.append(f"{key} < {upper}")
+    return " AND ".join(conditions)
+
+
+def copy_columns(part):
+    """
+    Returns:
+    str: The column list of a 'copy' part, or `*` for parts planned before
+    columns were recorded.
+    """
+    return ", ".join(part["columns"]) if part.get("columns") else "*"
+
+
+def open_part_stream(
+    db_url, database_type, part, sharded, snapshot=None, extra_args=None, tables=None
+):
+    """
+    Starts the dump of one part of a sharded backup.
+    Parameters:
+    db_url (str): The database connection URL.
+    database_type (str): 'postgres' or 'mysql'.
+    part (dict): The part, see `plan_parts`.
+    sharded (list): The tables whose rows are dumped as shards.
+    snapshot (str): The exported PostgreSQL snapshot every part is read from, or
+    the MySQL snapshot the rows of each table are read from.
+    extra_args (list): The table filter arguments, see `table_filter_args`.
+    tables (list): The tables the backup is limited to, if any.
+    Returns:
+    subprocess.Popen: The running dump process.
+    """
+    extra_args = list(extra_args or [])
+    if database_type == "postgres":
+        if part["format"] == "copy":
+            key = part["key"]
+            return open_copy_stream_postgres(
+                db_url,
+                f"SELECT {copy_columns(part)} FROM ONLY {part['table']} WHERE {_range_condition(key, *part['range'])}",
+                snapshot,
+            )
+        if snapshot:
+            extra_args.append(f"--snapshot={snapshot}")
+        if part["stage"] == "pre":
+            extra_args.append("--section=pre-data")
+        elif part["stage"] == "post":
+            extra_args.append("--section=post-data")
+        else:
+            extra_args.append("--section=data")
+            for table in sharded:
+                extra_args += ["--exclude-table-data", table]
+        return DB_STREAM_FUNCTIONS["postgres"](db_url, extra_args, tables)
+
+    if part["table"]:
+        condition = None
+        if part["key"]:
+            condition = _range_condition(_quote_mysql(part["key"]), *part["range"])
+        return snapshot.open_rows_stream(part["table"], condition)
+    # The schema, before and after the rows
+    if part["stage"] == "pre":
+        extra_args += ["--no-data", "--skip-triggers", "--single-transaction"]
+    else:
+        extra_args += ["--no-data", "--no-create-info", "--single-transaction"]
+    return DB_STREAM_FUNCTIONS["mysql"](db_url, extra_args, tables)
+
+
+@contextmanager
+def exported_snapshot(db_url, database_type, connections=0):
+    """
+    Holds a snapshot open while the parts of a backup are dumped, so they all see
+    the database as of the same instant. On MySQL, the snapshot is shared
+    between the `connections` of the parallel engine, which reads the rows of
+    every part. mysqldump processes can't share one, so they only dump the
+    schema.
+    Yields:
+    str: The PostgreSQL snapshot ID, or a MySQLSnapshot.
+    """
+    if database_type != "postgres":
+        snapshot = open_snapshot_mysql(db_url, max(2, connections))
+        try:
+            yield snapshot
+        finally:
+            snapshot.close()
+        return
+    process, snapshot = open_snapshot_postgres(db_url)
+    try:
+        yield snapshot
+    finally:
+        try:
+            process.stdin.write("COMMIT;\n")
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        process.wait()
+
+
+def shard_files(manifest_name, manifest):
+    """
+    Returns every file of a sharded backup, manifest included.
+    """
+    return [manifest_name] + [part["file"] for part in manifest["parts"]]
+
+
+def iter_part_data(destination, part, chunk_size=1024 * 1024):
+    """
+    Streams one part of a sharded backup, decrypted and decompressed on the fly.
+    """
+    decompressor = get_decompressor(plain_name(part["file"]))
+    for chunk in download_plain_stream(destination, part["file"], chunk_size):
+        yield decompressor.decompress(chunk) if decompressor else chunk
+
+
+def iter_shards_sql(destination, manifest, chunk_size=1024 * 1024):
+    """
+    Rebuilds a single logical dump from a sharded backup, its parts one after
+    the other. The rows of PostgreSQL shards are framed as `COPY` statements,
+    the way pg_dump writes them.
+    Parameters:
+    destination (module): The destination module.
+    manifest (dict): The sharded backup manifest.
+    chunk_size (int): The download chunk size.
+    Yields:
+    bytes: The SQL of the rebuilt dump, chunk by chunk.
+    """
+    for part in manifest["parts"]:
+        if part["format"] == "copy":
+            columns = f" ({copy_columns(part)})" if part.get("columns") else ""
+            yield f"COPY {part['table']}{columns} FROM stdin;\n".encode()
+        yield from iter_part_data(destination, part, chunk_size)
+        if part["format"] == "copy":
+            yield b"\\.\n"
@@ -0,0 +1,221 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from .db_backups import DB_QUERY_FUNCTIONS
+from . import metrics
+
+# Sessions doing work on the source database, and its replication lag in seconds.
+# On a primary the lag is the one of its slowest replica, on a replica its own.
+# The backup's own pg_dump session is left out.
+POSTGRES_LOAD_QUERY = """
+SELECT
+  (SELECT count(*) FROM pg_stat_activity
+   WHERE state = 'active' AND pid <> pg_backend_pid() AND application_name <> 'pg_dump'),
+  COALESCE(
+    CASE WHEN pg_is_in_recovery()
+      THEN EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+      ELSE (SELECT EXTRACT(EPOCH FROM max(replay_lag)) FROM pg_stat_replication)
+    END,
+    0
+  )
+"""
+
+# The lag is the one of the last transaction applied by a replica worker (MySQL 8+)
+MYSQL_LOAD_QUERY = """
+SELECT
+  (SELECT COUNT(*) FROM information_schema.PROCESSLIST
+   WHERE COMMAND NOT IN ('Sleep', 'Daemon', 'Binlog Dump', 'Binlog Dump GTID')
+   AND ID <> CONNECTION_ID()),
+  (SELECT COALESCE(MAX(TIMESTAMPDIFF(MICROSECOND,
+     LAST_APPLIED_TRANSACTION_ORIGINAL_COMMIT_TIMESTAMP,
+     LAST_APPLIED_TRANSACTION_END_APPLY_TIMESTAMP)) / 1000000, 0)
+   FROM performance_schema.replication_applier_status_by_worker)
+"""
+
+LOAD_QUERIES = {"postgres": POSTGRES_LOAD_QUERY, "mysql": MYSQL_LOAD_QUERY}
+
+# The adaptive mode halves the rates while the source is under load, down to
+# this share of the configured rates, and gives back this share once it is not
+MIN_RATE_FACTOR = 0.05
+RATE_FACTOR_STEP = 0.1
+
+
+class TokenBucket:
+    """
+    Limits the rate of a byte stream. One bucket is shared by every job of the
+    process, so concurrent backups share the limit instead of each getting it.
+    A consumer that takes more than the tokens available goes into debt and
+    sleeps it off, so chunks larger than the burst size still pass, and waiting
+    consumers are served in the order they arrived.
+    Parameters:
+    rate (float): The rate in bytes per second, or None for no limit.
+    burst (float): The bytes that can pass at once after an idle period.
+    Defaults to one second at the full rate.
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+        self.rate = None
+        self.burst = None
+        self.set_rate(rate, burst)
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+        self._updated = now
+
+    def set_rate(self, rate, burst=None):
+        with self._lock:
+            self._refill()
+            self.rate = rate or None
+            self.burst = burst or rate or None
+            if self.burst is not None:
+                self._tokens = min(self._tokens, self.burst)
+
+    def consume(self, amount):
+        """
+        Takes `amount` bytes from the bucket, sleeping until they are available.
+        Returns:
+        float: The number of seconds spent waiting.
+        """
+        with self._lock:
+            if not self.rate:
+                return 0.0
+            self._refill()
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+_buckets = {"dump": TokenBucket(), "upload": TokenBucket()}
+_base_rates = {"dump": None, "upload": None}
+# The rate factor each monitored database asks for. The most loaded one wins.
+_load_factors = {}
+_state_lock = threading.Lock()
+
+
+def get_bucket(name):
+    """
+    Returns the process-wide bucket limiting the 'dump' or 'upload' stage.
+    """
+    return _buckets[name]
+
+
+def limit(chunks, bucket):
+    """
+    Passes a stream of chunks through a bucket, at most at its rate.
+    """
+    for chunk in chunks:
+        metrics.add_time("throttle", bucket.consume(len(chunk)))
+        yield chunk
+
+
+def _apply_rates():
+    factor = min(_load_factors.values(), default=1.0)
+    for name, bucket in _buckets.items():
+        base = _base_rates[name]
+        bucket.set_rate(base * factor if base else None, base)
+
+
+def configure(config):
+    """
+    Sets the rates of the buckets from THROTTLE_DUMP_RATE and THROTTLE_UPLOAD_RATE.
+    """
+    with _state_lock:
+        _base_rates["dump"] = config["THROTTLE_DUMP_RATE"]
+        _base_rates["upload"] = config["THROTTLE_UPLOAD_RATE"]
+        _apply_rates()
+
+
+def sample_load(db_url, database_type):
+    """
+    Returns:
+    tuple: The number of active sessions on the database, and its replication
+    lag in seconds.
+    """
+    rows = DB_QUERY_FUNCTIONS[database_type](db_url, LOAD_QUERIES[database_type])
+    active, lag = rows[0]
+    return int(active), float(lag or 0)
+
+
+def _monitor(key, db_url, database_type, config, stop):
+    factor = 1.0
+    warned = False
+    while not stop.wait(config["THROTTLE_ADAPTIVE_INTERVAL"]):
+        try:
+            active, lag = sample_load(db_url, database_type)
+        except Exception as e:
+            if not warned:
+                logging.warning(
+                    f"[throttle] Could not sample the load of the source database, keeping the current rates: {str(e)}"
+                )
+                warned = True
+            continue
+        if (
+            lag > config["THROTTLE_MAX_REPLICATION_LAG"]
+            or active > config["THROTTLE_MAX_ACTIVE_CONNECTIONS"]
+        ):
+            new_factor = max(MIN_RATE_FACTOR, factor / 2)
+        else:
+            new_factor = min(1.0, factor + RATE_FACTOR_STEP)
+        if new_factor != factor:
+            logging.info(
+                f"[throttle] {active} active sessions, {lag:.1f}s replication lag: rates at {new_factor:.0%}"
+            )
+            factor = new_factor
+            with _state_lock:
+                # The backup may have ended while the load was being sampled
+                if stop.is_set():
+                    return
+                _load_factors[key] = factor
+                _apply_rates()
+
+
+@contextmanager
+def throttled(db_url, database_type, config):
+    """
+    Applies the configured rate limits to the backups run inside the block.
+    With THROTTLE_ADAPTIVE, the load of the source database is also sampled
+    every THROTTLE_ADAPTIVE_INTERVAL seconds: the rates are halved each time the
+    replication lag or the number of active sessions is over its threshold,
+    and recover step by step once both are back under it.
+    Parameters:
+    db_url (str): The URL of the database being backed up.
+    database_type (str): 'postgres' or 'mysql'.
+    config (dict): The app config.
+    """
+    configure(config)
+    adaptive = config["THROTTLE_ADAPTIVE"] and (
+        config["THROTTLE_DUMP_RATE"] or config["THROTTLE_UPLOAD_RATE"]
+    )
+    if not adaptive:
+        yield
+        return
+    key = object()
+    stop = threading.Event()
+    with _state_lock:
+        _load_factors[key] = 1.0
+    monitor = threading.Thread(
+        target=_monitor,
+        args=(key, db_url, database_type, config, stop),
+        name="throttle-monitor",
+        daemon=True,
+    )
+    monitor.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        # A load query still running is left to finish on its own
+        monitor.join(timeout=5)
+        with _state_lock:
+            del _load_factors[key]
+            _apply_rates()
@@ -1,27 +1,39 @@
 import logging
 import os
-import gzip
-import shutil
+import io
+import re
+import subprocess
+import time
+from datetime import datetime
 from urllib.parse import urlparse
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import json
+from . import metrics
+from .compression import get_compressor, get_extension
 
 
-def compress_backup(backup_file):
+def compress_backup(backup_file, codec="gzip", level=None, threads=1):
     """
-    Compresses a backup file using gzip.
+    Compresses a backup file with the given codec. The compressed copy is written
+    next to it, with the codec's extension appended to the name.
     Parameters:
     backup_file (str): The path of the backup file to be compressed.
+    codec (str): The compression codec, one of 'gzip', 'pgzip', 'zstd' or 'lz4'.
+    level (int): The compression level. Defaults to the codec's own default.
+    threads (int): The number of threads to compress with.
     Returns:
     bool: True if the compression was successful, False otherwise.
     """
     try:
-        with open(backup_file, "rb") as f_in, gzip.open(
-            backup_file + ".gz", "wb"
+        compressor = get_compressor(codec, level, threads)
+        with open(backup_file, "rb") as f_in, open(
+            backup_file + get_extension(codec), "wb"
         ) as f_out:
-            shutil.copyfileobj(f_in, f_out)
+            for chunk in iter(lambda: f_in.read(1024 * 1024), b""):
+                f_out.write(compressor.compress(chunk))
+            f_out.write(compressor.flush())
         return True
     except FileNotFoundError as e:
         logging.error(f"[compress_backup] Error: File {backup_file} not found.")
@@ -31,6 +43,125 @@ def compress_backup(backup_file):
         return False
 
 
+def stream_compressed_backup(
+    process, chunk_size=1024 * 1024, compress=True, compressor=None, rate_limiter=None
+):
+    """
+    Reads a dump process's stdout and yields it compressed, chunk by chunk.
+    Only one chunk is held in memory at a time, so memory use does not depend on
+    the size of the database.
+    Parameters:
+    process (subprocess.Popen): A running dump process with stdout=PIPE.
+    chunk_size (int): The number of bytes to read from the process per chunk.
+    compress (bool): Set to False to pass through output that is already compressed.
+    compressor (object): The compressor to use, from `get_compressor`. Defaults to gzip.
+    rate_limiter (TokenBucket): Limits the rate the dump is read at. Reading
+    slower makes the dump process block on its pipe, which slows it down too.
+    Yields:
+    bytes: Compressed chunks, forming a valid compressed stream when concatenated.
+    Raises:
+    RuntimeError: If the dump process exits with a non-zero return code. This
+    happens after the last chunk, so the consumer can abort a partial upload.
+    """
+    if not compress:
+        compressor = None
+    elif compressor is None:
+        compressor = get_compressor("gzip")
+    while True:
+        # Time blocked on the dump process, the compressor and the consumer is
+        # recorded against the 'dump', 'compress' and 'upload' stages
+        started = time.monotonic()
+        chunk = process.stdout.read(chunk_size)
+        metrics.add_time("dump", time.monotonic() - started)
+        if not chunk:
+            break
+        metrics.count("bytes_dumped", len(chunk))
+        if rate_limiter is not None:
+            metrics.add_time("throttle", rate_limiter.consume(len(chunk)))
+        if compressor is None:
+            started = time.monotonic()
+            yield chunk
+            metrics.add_time("upload", time.monotonic() - started)
+            continue
+        started = time.monotonic()
+        compressed = compressor.compress(chunk)
+        metrics.add_time("compress", time.monotonic() - started)
+        if compressed:
+            metrics.count("bytes_compressed", len(compressed))
+            started = time.monotonic()
+            yield compressed
+            metrics.add_time("upload", time.monotonic() - started)
+    if compressor is not None:
+        started = time.monotonic()
+        compressed = compressor.flush()
+        metrics.add_time("compress", time.monotonic() - started)
+        metrics.count("bytes_compressed", len(compressed))
+        yield compressed
+
+    process.stdout.close()
+    returncode = process.wait()
+    if returncode != 0:
+        raise RuntimeError(
+            f"[stream_compressed_backup] Dump process failed with return code: {returncode}"
+        )
+
+
+def open_tar_stream(directory, names=None):
+    """
+    Starts `tar` to package a directory as an uncompressed tar stream on stdout.
+    The archive contains the directory itself, under its base name.
+    Parameters:
+    directory (str): The path of the directory to package.
+    names (list): Only package these files of the directory, at the top of the
+    archive.
+    Returns:
+    subprocess.Popen: The running `tar` process, with the archive available on its stdout.
+    """
+    directory = os.path.abspath(directory)
+    if names is not None:
+        return subprocess.Popen(
+            ["tar", "-cf", "-", "-C", directory, "--"] + list(names),
+            stdout=subprocess.PIPE,
+        )
+    return subprocess.Popen(
+        [
+            "tar",
+            "-cf",
+            "-",
+            "-C",
+            os.path.dirname(directory),
+            os.path.basename(directory),
+        ],
+        stdout=subprocess.PIPE,
+    )
+
+
+class ChunkedStreamReader(io.RawIOBase):
+    """
+    A read-only file object over an iterator of byte chunks. This lets streamed
+    backups be handed to APIs that expect a file, such as `ftplib.storbinary`
+    or `boto3`'s `upload_fileobj`.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            try:
+                self._buffer = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
 def parse_connection_url(ConnectionUrl):
     """
     Parses a database connection URL and returns the database type and connection details.
@@ -50,6 +181,49 @@ def parse_connection_url(ConnectionUrl):
     }
 
 
+def parse_backup_timestamp(file_name):
+    """
+    Extracts the creation timestamp from a backup name such as
+    `label_dbname_20240101120000.tar` or `dbname_20240101120000.gz`.
+    Parameters:
+    file_name (str): The name of the backup.
+    Returns:
+    datetime: The creation timestamp, or None if the name has none.
+    """
+    match = re.search(r"_(\d{14})(?:\.[A-Za-z0-9.]+)?$", file_name)
+    if not match:
+        return None
+    try:
+        return datetime.strptime(match.group(1), "%Y%m%d%H%M%S")
+    except ValueError:
+        return None
+
+
+def discover_database_vars(environ=None):
+    """
+    Finds the config vars that hold a supported database connection URL, such as
+    `DATABASE_URL` or the `HEROKU_POSTGRESQL_<COLOR>_URL` attachments. Heroku
+    sets `DATABASE_URL` to the URL of the primary attachment, so a database is
+    only listed once, under its attachment name rather than `DATABASE_URL`.
+    Parameters:
+    environ (dict): The environment to search. Defaults to os.environ.
+    Returns:
+    list: The sorted names of the matching config vars.
+    """
+    environ = os.environ if environ is None else environ
+    names = {}
+    for name, value in sorted(environ.items()):
+        if not (
+            name.endswith("_URL")
+            and isinstance(value, str)
+            and value.startswith(("postgres://", "mysql://"))
+        ):
+            continue
+        if value not in names or names[value] == "DATABASE_URL":
+            names[value] = name
+    return sorted(names.values())
+
+
 # The `SMTP_CREDENTIALS` JSON object should look like this:
 # ```json
 # {
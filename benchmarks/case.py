@@ -0,0 +1,77 @@
+"""
+Runs a single benchmark case in its own process, so its peak RSS is not mixed
+with the other cases. The case is configured through the environment by
+`benchmarks.run` and its result is printed as JSON.
+"""
+import json
+import resource
+import sys
+import time
+
+from app import metrics
+from app.backup_manager import manual_backup
+
+
+def peak_rss_kb():
+    """
+    Returns:
+    int: The peak RSS of this process in kilobytes. VmHWM starts over on exec,
+    unlike ru_maxrss which keeps the peak of the process that forked this one,
+    such as the benchmark runner with its servers.
+    """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def main():
+    label = sys.argv[1]
+    start = time.monotonic()
+    try:
+        backup_file = manual_backup("BENCH_DATABASE_URL", label)
+        status = "success"
+    except SystemExit:
+        backup_file = None
+        status = "failed"
+    wall = time.monotonic() - start
+
+    summary = metrics.REGISTRY.last_runs.get(("backup", "BENCH_DATABASE_URL"))
+    summary = summary[0] if summary else {"stages": {}, "counters": {}}
+    dumped = summary["counters"].get("bytes_dumped", 0)
+    compressed = summary["counters"].get("bytes_compressed", 0)
+    stages = summary["stages"]
+
+    def mb_per_s(size, stage):
+        return round(size / stages[stage] / 1e6, 1) if stages.get(stage) else None
+
+    print(
+        json.dumps(
+            {
+                "status": status,
+                "backup_file": backup_file,
+                "wall_seconds": round(wall, 3),
+                "peak_rss_mb": round(peak_rss_kb() / 1024, 1),
+                "peak_child_rss_mb": round(
+                    resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1
+                ),
+                "bytes_dumped": dumped,
+                "bytes_compressed": compressed,
+                "compression_ratio": summary.get("compression_ratio"),
+                "stages": stages,
+                "dump_mb_per_s": mb_per_s(dumped, "dump"),
+                "compress_mb_per_s": mb_per_s(dumped, "compress"),
+                "upload_mb_per_s": mb_per_s(compressed, "upload"),
+                "end_to_end_mb_per_s": round(dumped / wall / 1e6, 1) if wall else None,
+            }
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import random
+import string
+
+# Words repeated across rows, the compressible part of a synthetic dump
+VOCABULARY = [
+    "".join(random.Random(i).choices(string.ascii_lowercase, k=6 + i % 5))
+    for i in range(512)
+]
+
+
+def generate_dump(path, size_mb, entropy=0.3, seed=0):
+    """
+    Writes a synthetic SQL dump of about `size_mb` megabytes, made of INSERT
+    statements like the ones `pg_dump` and `mysqldump` produce.
+    Parameters:
+    path (str): The path of the dump to write.
+    size_mb (float): The target size in megabytes.
+    entropy (float): The share of each row that is random, between 0 (rows
+    made of repeated words, very compressible) and 1 (random hex, barely
+    compressible).
+    seed (int): The random seed, so the same arguments give the same dump.
+    Returns:
+    int: The size of the dump in bytes.
+    """
+    rng = random.Random(seed)
+    target = int(size_mb * 1024 * 1024)
+    row_payload = 200
+    random_chars = int(row_payload * entropy)
+    size = 0
+    row = 0
+    with open(path, "wb") as file:
+        file.write(b"CREATE TABLE bench (id bigint PRIMARY KEY, body text);\n")
+        while size < target:
+            lines = []
+            for _ in range(1000):
+                words = " ".join(
+                    rng.choice(VOCABULARY)
+                    for _ in range((row_payload - random_chars) // 8)
+                )
+                noise = rng.randbytes(random_chars // 2 + 1).hex()[:random_chars]
+                lines.append(f"INSERT INTO bench VALUES ({row}, '{words} {noise}');\n")
+                row += 1
+            data = "".join(lines).encode()
+            file.write(data)
+            size += len(data)
+    return size
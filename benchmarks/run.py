@@ -0,0 +1,277 @@
+"""
+Benchmarks the backup pipeline end to end against local stand-ins: a
+synthetic dump replayed by stub `pg_dump`/`mysqldump` executables, a moto S3
+server and a pyftpdlib FTP server. Each case runs `manual_backup` in its own
+process and reports wall time, peak RSS and per-stage throughput.
+
+Usage: python -m benchmarks.run [--size-mb N] [--entropy E] [--modes ...]
+       [--destinations ...] [--codecs ...] [--compare COMMIT|FILE]
+
+Results are saved to benchmarks/results/<commit>.json, so the results of two
+commits can be compared with --compare.
+"""
+import argparse
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+from .datagen import generate_dump
+from .standins import start_ftp, start_s3
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+RESULTS_DIR = os.path.join(BENCHMARKS_DIR, "results")
+CACHE_DIR = os.path.join(tempfile.gettempdir(), "db-backup-bench")
+
+# Mode name: the config vars that select it in manual_backup
+MODES = {
+    "file": {"BACKUP_STREAMING": "false"},
+    "stream": {"BACKUP_STREAMING": "true"},
+    "directory": {"POSTGRES_DUMP_FORMAT": "directory"},
+    "dedup": {"DEDUP_STORE": "true"},
+    # A fixed test key, streamed like the 'stream' mode to show the cost of encryption
+    "encrypted": {
+        "BACKUP_STREAMING": "true",
+        "ENCRYPTION_KEY": "YmVuY2htYXJrLWtleS1ub3QtZm9yLXByb2R1Y3Rpb24=",
+    },
+}
+
+
+def current_commit():
+    """
+    Returns:
+    str: The short hash of HEAD, with '-dirty' when the tree has local changes.
+    """
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=REPO_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + ("-dirty" if dirty else "")
+
+
+def run_case(case, dump_file, s3_endpoint, ftp_port, ftp_root):
+    """
+    Runs one case in a fresh process, in a scratch working directory, against
+    an empty bucket or FTP directory.
+    Returns:
+    dict: The case parameters and its measurements.
+    """
+    mode, destination, codec, database = case
+    label = f"bench-{mode}-{codec}"
+    scratch = tempfile.mkdtemp(prefix="bench_")
+    env = dict(os.environ)
+    env.update(MODES[mode])
+    env.update(
+        {
+            "PATH": os.path.join(BENCHMARKS_DIR, "bin") + os.pathsep + env["PATH"],
+            "PYTHONPATH": REPO_DIR,
+            "BENCH_DUMP_FILE": dump_file,
+            "BENCH_DATABASE_URL": f"{database}://bench:bench@127.0.0.1:5432/bench",
+            "UPLOAD_DESTINATION": destination,
+            "COMPRESSION_CODEC": codec,
+            "JOBS_DB_PATH": os.path.join(scratch, "jobs.sqlite3"),
+            "LOG_LEVEL": "WARNING",
+        }
+    )
+    if destination == "S3":
+        bucket = f"bench-{datetime.now().strftime('%H%M%S%f')}"
+        env.update(
+            {
+                "AWS_ENDPOINT_URL": s3_endpoint,
+                "AWS_ACCESS_KEY_ID": "bench",
+                "AWS_SECRET_ACCESS_KEY": "bench",
+                "AWS_S3_REGION": "us-east-1",
+                "AWS_S3_BUCKET": bucket,
+            }
+        )
+        import boto3
+
+        boto3.client(
+            "s3",
+            endpoint_url=s3_endpoint,
+            region_name="us-east-1",
+            aws_access_key_id="bench",
+            aws_secret_access_key="bench",
+        ).create_bucket(Bucket=bucket)
+    else:
+        for name in os.listdir(ftp_root):
+            os.remove(os.path.join(ftp_root, name))
+        env.update(
+            {
+                "FTP_HOSTNAME": "127.0.0.1",
+                "FTP_PORT": str(ftp_port),
+                "FTP_USER": "bench",
+                "FTP_PASS": "bench",
+            }
+        )
+
+    try:
+        process = subprocess.run(
+            [sys.executable, "-m", "benchmarks.case", label],
+            cwd=scratch,
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    lines = process.stdout.strip().splitlines()
+    try:
+        result = json.loads(lines[-1])
+    except (IndexError, ValueError):
+        result = {"status": "error", "error": process.stderr.strip()[-2000:]}
+    return {
+        "mode": mode,
+        "destination": destination,
+        "codec": codec,
+        "database": database,
+        **result,
+    }
+
+
+def print_results(results, baseline=None):
+    """
+    Prints one row per case, with the change in wall time and peak RSS against
+    the baseline results when given.
+    """
+    baseline = {
+        (r["mode"], r["destination"], r["codec"], r["database"]): r
+        for r in (baseline or [])
+    }
+    print(
+        f"{'mode':<10}{'dest':<5}{'codec':<7}{'db':<9}{'status':<8}{'wall s':>8}"
+        f"{'RSS MB':>8}{'ratio':>7}{'dump':>8}{'comp':>8}{'upload':>8}{'e2e':>8}"
+        f"{'Δwall':>8}{'ΔRSS':>8}"
+    )
+    for r in results:
+        before = baseline.get((r["mode"], r["destination"], r["codec"], r["database"]))
+
+        def delta(key):
+            if not before or not before.get(key) or r.get(key) is None:
+                return ""
+            return f"{(r[key] - before[key]) / before[key] * 100:+.0f}%"
+
+        def value(key):
+            return "" if r.get(key) is None else r[key]
+
+        print(
+            f"{r['mode']:<10}{r['destination']:<5}{r['codec']:<7}{r['database']:<9}"
+            f"{r['status']:<8}{value('wall_seconds'):>8}{value('peak_rss_mb'):>8}"
+            f"{value('compression_ratio'):>7}{value('dump_mb_per_s'):>8}"
+            f"{value('compress_mb_per_s'):>8}{value('upload_mb_per_s'):>8}"
+            f"{value('end_to_end_mb_per_s'):>8}{delta('wall_seconds'):>8}"
+            f"{delta('peak_rss_mb'):>8}"
+        )
+        if r.get("error"):
+            print(f"    {r['error'].splitlines()[-1]}")
+
+
+def load_results(reference):
+    path = (
+        reference
+        if os.path.exists(reference)
+        else os.path.join(RESULTS_DIR, f"{reference}.json")
+    )
+    with open(path) as file:
+        return json.load(file)["results"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run")
+    parser.add_argument("--size-mb", type=float, default=256)
+    parser.add_argument(
+        "--entropy",
+        type=float,
+        default=0.3,
+        help="Share of random data in each row, from 0 to 1",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument("--destinations", default="S3,FTP")
+    parser.add_argument("--codecs", default="gzip,zstd")
+    parser.add_argument("--databases", default="postgres")
+    parser.add_argument("--compare", help="A commit or results file to compare against")
+    parser.add_argument("--no-save", action="store_true", help="Don't save the results")
+    args = parser.parse_args(argv)
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    dump_file = os.path.join(
+        CACHE_DIR, f"dump_{args.size_mb}mb_{args.entropy}_{args.seed}.sql"
+    )
+    if not os.path.exists(dump_file):
+        print(f"Generating a {args.size_mb} MB dump with entropy {args.entropy}...")
+        generate_dump(dump_file + ".tmp", args.size_mb, args.entropy, args.seed)
+        os.replace(dump_file + ".tmp", dump_file)
+
+    s3_server, s3_endpoint = start_s3()
+    ftp_root = tempfile.mkdtemp(prefix="bench_ftp_")
+    ftp_server, ftp_port = start_ftp(ftp_root)
+
+    cases = [
+        case
+        for case in itertools.product(
+            args.modes.split(","),
+            args.destinations.upper().split(","),
+            args.codecs.split(","),
+            args.databases.split(","),
+        )
+        # Only PostgreSQL has a directory format
+        if not (case[0] == "directory" and case[3] != "postgres")
+    ]
+    results = []
+    try:
+        for case in cases:
+            print(f"Running {' '.join(case)}...", file=sys.stderr)
+            results.append(run_case(case, dump_file, s3_endpoint, ftp_port, ftp_root))
+    finally:
+        s3_server.stop()
+        ftp_server.close_all()
+        shutil.rmtree(ftp_root, ignore_errors=True)
+
+    baseline = load_results(args.compare) if args.compare else None
+    print_results(results, baseline)
+
+    if not args.no_save:
+        commit = current_commit()
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"{commit}.json")
+        with open(path, "w") as file:
+            json.dump(
+                {
+                    "commit": commit,
+                    "date": datetime.now().isoformat(timespec="seconds"),
+                    "size_mb": args.size_mb,
+                    "entropy": args.entropy,
+                    "seed": args.seed,
+                    "cpu_count": os.cpu_count(),
+                    "results": results,
+                },
+                file,
+                indent=2,
+            )
+        print(f"Results saved to {os.path.relpath(path, REPO_DIR)}")
+
+    if any(result["status"] != "success" for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+import logging
+import socket
+import threading
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_s3():
+    """
+    Starts a local S3 stand-in (moto's server mode) on a free port.
+    Returns:
+    tuple: The server, to stop it, and the endpoint URL.
+    """
+    from moto.server import ThreadedMotoServer
+
+    port = _free_port()
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False)
+    server.start()
+    return server, f"http://127.0.0.1:{port}"
+
+
+def start_ftp(root, user="bench", password="bench"):
+    """
+    Starts a local FTP server (pyftpdlib) serving `root`, on a free port.
+    Returns:
+    tuple: The server, to stop it with `close_all()`, and its port.
+    """
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.log import config_logging
+    from pyftpdlib.servers import ThreadedFTPServer
+
+    # Otherwise every FTP command of the benchmarks is logged
+    config_logging(level=logging.WARNING)
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(user, password, root, perm="elradfmwMT")
+
+    class Handler(FTPHandler):
+        pass
+
+    Handler.authorizer = authorizer
+    port = _free_port()
+    server = ThreadedFTPServer(("127.0.0.1", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, port
@@ -0,0 +1,72 @@
+import os
+import threading
+
+import pytest
+
+# The app reads its config from the environment when it is imported
+os.environ.setdefault("UPLOAD_DESTINATION", "S3")
+os.environ.setdefault("AWS_S3_BUCKET", "test-backups")
+os.environ.setdefault("AWS_S3_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+
+from app.backup_manager import app as flask_app  # noqa: E402
+from app.destinations import ftp, s3  # noqa: E402
+
+
+@pytest.fixture
+def app_context():
+    with flask_app.app_context():
+        yield flask_app
+
+
+@pytest.fixture
+def s3_bucket(app_context):
+    """
+    An empty bucket on a moto S3 stand-in, used by the S3 destination module.
+    """
+    moto = pytest.importorskip("moto")
+    with moto.mock_aws():
+        # Clients created against another mock must not be reused
+        s3._clients.clear()
+        s3.get_client().create_bucket(Bucket=app_context.config["AWS_S3_BUCKET"])
+        yield s3
+        s3._clients.clear()
+
+
+@pytest.fixture
+def ftp_server(app_context, tmp_path, monkeypatch):
+    """
+    A local pyftpdlib server, used by the FTP destination module.
+    Yields:
+    pathlib.Path: The directory the server stores its files in.
+    """
+    pytest.importorskip("pyftpdlib")
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+
+    root = tmp_path / "ftp"
+    root.mkdir()
+    authorizer = DummyAuthorizer()
+    authorizer.add_user("user", "password", str(root), perm="elradfmwMT")
+    handler = type("Handler", (FTPHandler,), {"authorizer": authorizer})
+    server = ThreadedFTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    for name, value in (
+        ("FTP_HOSTNAME", "127.0.0.1"),
+        ("FTP_PORT", server.address[1]),
+        ("FTP_USER", "user"),
+        ("FTP_PASS", "password"),
+    ):
+        monkeypatch.setitem(app_context.config, name, value)
+    ftp._pools.clear()
+    try:
+        yield root
+    finally:
+        for pool in ftp._pools.values():
+            pool.close()
+        ftp._pools.clear()
+        server.close_all()
+        thread.join(5)
@@ -0,0 +1,309 @@
+import io
+import os
+import shutil
+import subprocess
+import tarfile
+import time
+from datetime import datetime
+
+import pytest
+
+from app.archiver import (
+    ARCHIVE_PREFIX,
+    add_batch,
+    parse_target_time,
+    plan_recovery,
+    prune_archive,
+    read_archive_index,
+    spool_files,
+    write_archive_index,
+    write_recovery_config,
+)
+from app.backup_manager import archive_segments
+from app.catalog import new_entry, update_catalog
+from app.db_backups import DB_QUERY_FUNCTIONS
+from app.db_backups.mysql import open_binlog_receiver_mysql, replay_binlogs_mysql
+from app.db_backups.postgres import open_wal_receiver_postgres
+from app.destinations import DestinationTarget
+from app.restore import iter_backup_data
+
+
+def batch(name, archived_at):
+    return {"file": name, "segments": [name], "archived_at": archived_at}
+
+
+INDEX = {
+    "batches": [
+        batch("b3", "20260101030000"),
+        batch("b1", "20260101010000"),
+        batch("b2", "20260101020000"),
+    ],
+    "partial": {"file": "p", "archived_at": "20260101033000"},
+}
+
+
+def names(batches):
+    return [batch["file"] for batch in batches]
+
+
+def test_recovery_stops_at_the_first_batch_after_the_target():
+    batches, partial = plan_recovery(INDEX, "20260101000000", "20260101013000")
+    assert names(batches) == ["b1", "b2"]
+    assert partial is None
+
+
+def test_recovery_skips_the_batches_before_the_base_backup():
+    batches, partial = plan_recovery(INDEX, "20260101015000", "20260101021000")
+    assert names(batches) == ["b2", "b3"]
+    assert partial is None
+
+
+def test_recovery_past_the_last_batch_uses_the_partial_segment():
+    batches, partial = plan_recovery(INDEX, "20260101000000", "20260101040000")
+    assert names(batches) == ["b1", "b2", "b3"]
+    assert partial == INDEX["partial"]
+
+
+def test_a_partial_segment_older_than_the_base_backup_is_not_used():
+    batches, partial = plan_recovery(INDEX, "20260101035000", "20260101040000")
+    assert batches == []
+    assert partial is None
+
+
+def test_postgres_spool(tmp_path):
+    for name in (
+        "000000010000000000000002",
+        "000000010000000000000001",
+        "00000002.history",
+        "000000010000000000000003.partial",
+        "stray.tmp",
+    ):
+        (tmp_path / name).write_bytes(b"")
+    complete, partial = spool_files(str(tmp_path), "postgres")
+    assert complete == [
+        "000000010000000000000001",
+        "000000010000000000000002",
+        "00000002.history",
+    ]
+    assert partial == "000000010000000000000003.partial"
+
+
+def test_mysql_spool(tmp_path):
+    for name in ("binlog.000002", "binlog.000001", "binlog.index"):
+        (tmp_path / name).write_bytes(b"")
+    assert spool_files(str(tmp_path), "mysql") == (["binlog.000001"], "binlog.000002")
+
+
+def test_empty_spool(tmp_path):
+    assert spool_files(str(tmp_path), "mysql") == ([], None)
+    assert spool_files(str(tmp_path), "postgres") == ([], None)
+
+
+@pytest.mark.parametrize("text", ["2026-01-02 03:04:05", "20260102030405"])
+def test_parse_target_time(text):
+    assert parse_target_time(text) == datetime(2026, 1, 2, 3, 4, 5)
+
+
+def test_parse_target_time_rejects_other_formats():
+    with pytest.raises(ValueError):
+        parse_target_time("yesterday")
+
+
+def test_recovery_config(tmp_path):
+    data_directory = tmp_path / "data"
+    data_directory.mkdir()
+    (data_directory / "postgresql.auto.conf").write_text("work_mem = '64MB'\n")
+
+    write_recovery_config(
+        str(data_directory), "archived_wal", datetime(2026, 1, 2, 3, 4, 5)
+    )
+
+    config = (data_directory / "postgresql.auto.conf").read_text()
+    assert config.startswith("work_mem = '64MB'\n")
+    wal_directory = os.path.abspath("archived_wal")
+    assert f'restore_command = \'cp "{wal_directory}/%f" "%p"\'' in config
+    assert "recovery_target_time = '2026-01-02 03:04:05'" in config
+    assert "recovery_target_action = 'promote'" in config
+    assert (data_directory / "recovery.signal").read_bytes() == b""
+
+
+def test_prune_archive_keeps_what_the_oldest_base_backup_needs(s3_bucket):
+    index = {"batches": [], "partial": None, "database_type": "postgres"}
+    for name, archived_at in (
+        ("b1", "20260101000000"),
+        ("b2", "20260101020000"),
+        ("b3", "20260101040000"),
+    ):
+        s3_bucket.upload_to_destination(name, b"wal")
+        add_batch(index, name, [name], archived_at)
+    write_archive_index(s3_bucket, "db", index)
+    update_catalog(
+        s3_bucket,
+        "db",
+        add=[
+            new_entry("db_20260101010000.base.tar.gz", "db", "postgres"),
+            new_entry("db_20260101030000.base.tar.gz", "db", "postgres"),
+            # Only physical base backups count on PostgreSQL
+            new_entry("db_20260101023000.sql.gz", "db", "postgres"),
+        ],
+    )
+
+    assert prune_archive(s3_bucket, "db") == ["b1"]
+
+    index = read_archive_index(s3_bucket, "db")
+    assert names(index["batches"]) == ["b2", "b3"]
+    assert s3_bucket.read_from_destination("b1") is None
+    assert s3_bucket.read_from_destination("b2") == b"wal"
+    # Nothing left before the oldest base backup
+    assert prune_archive(s3_bucket, "db") == []
+
+
+def test_prune_archive_needs_a_base_backup(s3_bucket):
+    index = {"batches": [], "partial": None, "database_type": "mysql"}
+    add_batch(index, "b1", ["binlog.000001"], "20260101000000")
+    write_archive_index(s3_bucket, "db", index)
+    # A sharded backup without a binary log position cannot be replayed onto
+    update_catalog(
+        s3_bucket, "db", add=[new_entry("db_20260102000000.shards.json", "db", "mysql")]
+    )
+    assert prune_archive(s3_bucket, "db") == []
+    assert names(read_archive_index(s3_bucket, "db")["batches"]) == ["b1"]
+
+
+def batch_content(destination, file_name):
+    data = b"".join(iter_backup_data(destination, file_name))
+    with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+        return {
+            member.name: archive.extractfile(member).read()
+            for member in archive.getmembers()
+        }
+
+
+def test_archive_segments_round_trip(s3_bucket, tmp_path):
+    spool = tmp_path / "spool"
+    spool.mkdir()
+    first, second = "000000010000000000000001", "000000010000000000000002"
+    (spool / first).write_bytes(b"first")
+    (spool / (second + ".partial")).write_bytes(b"second, in progress")
+    target = DestinationTarget("S3", "S3")
+    indexes = {"S3": read_archive_index(target, "db")}
+
+    assert archive_segments([target], indexes, "db", "postgres", str(spool))
+
+    # The completed segment left the spool, the one being written stays
+    assert sorted(os.listdir(spool)) == [second + ".partial"]
+    index = read_archive_index(s3_bucket, "db")
+    (batch,) = index["batches"]
+    assert batch["segments"] == [first]
+    assert batch_content(s3_bucket, batch["file"]) == {first: b"first"}
+    assert index["partial"]["segment"] == second
+    assert batch_content(s3_bucket, index["partial"]["file"]) == {
+        second + ".partial": b"second, in progress"
+    }
+
+    # The segment is completed, its snapshot is not needed anymore
+    os.rename(spool / (second + ".partial"), spool / second)
+    assert archive_segments([target], indexes, "db", "postgres", str(spool))
+
+    index = read_archive_index(s3_bucket, "db")
+    assert [batch["segments"] for batch in index["batches"]] == [[first], [second]]
+    assert index["partial"] is None
+    assert not [
+        name
+        for name in s3_bucket.fetch_destination_filelist(prefix=ARCHIVE_PREFIX)
+        if ".partial" in name
+    ]
+    assert os.listdir(spool) == []
+
+
+def server_url(name, *programs):
+    """
+    Returns:
+    str: The URL of a local server to run the integration tests against, from
+    the `name` environment variable. The test is skipped when it is not set, or
+    when a client program it needs is not installed.
+    """
+    url = os.getenv(name)
+    if not url:
+        pytest.skip(f"{name} is not set")
+    for program in programs:
+        if shutil.which(program) is None:
+            pytest.skip(f"{program} is not installed")
+    return url
+
+
+def wait_for(condition, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out")
+        time.sleep(0.2)
+
+
+def test_mysql_binlogs_replay_up_to_a_time(tmp_path):
+    url = server_url("TEST_MYSQL_URL", "mysql", "mysqlbinlog")
+    query = DB_QUERY_FUNCTIONS["mysql"]
+    query(
+        url,
+        "DROP TABLE IF EXISTS pitr_test; CREATE TABLE pitr_test (id INT PRIMARY KEY)",
+    )
+
+    def position():
+        for statement in ("SHOW BINARY LOG STATUS", "SHOW MASTER STATUS"):
+            try:
+                file, offset = query(url, statement)[0][:2]
+                return file, int(offset)
+            except (subprocess.CalledProcessError, IndexError):
+                continue
+        pytest.skip("Binary logging is off")
+
+    start_file, start_position = position()
+    query(url, "INSERT INTO pitr_test VALUES (1), (2), (3)")
+    time.sleep(1.1)
+    target_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    time.sleep(1.1)
+    query(url, "DELETE FROM pitr_test")
+    end_file, end_position = position()
+    if end_file != start_file:
+        pytest.skip("The server rotated its binary log during the test")
+
+    spool = tmp_path / "spool"
+    spool.mkdir()
+    receiver = open_binlog_receiver_mysql(url, str(spool), start_file)
+    try:
+        # The receiver has caught up once it wrote the DELETE
+        wait_for(
+            lambda: (spool / start_file).exists()
+            and (spool / start_file).stat().st_size >= end_position
+        )
+    finally:
+        receiver.terminate()
+        receiver.wait()
+
+    assert replay_binlogs_mysql(
+        url, [str(spool / start_file)], start_position, target_time
+    )
+    assert query(url, "SELECT COUNT(*) FROM pitr_test") == [["3"]]
+    query(url, "DROP TABLE pitr_test")
+
+
+def test_postgres_wal_receiver_fills_the_spool(tmp_path):
+    url = server_url("TEST_POSTGRES_URL", "psql", "pg_receivewal")
+    query = DB_QUERY_FUNCTIONS["postgres"]
+    spool = tmp_path / "spool"
+    spool.mkdir()
+    receiver = open_wal_receiver_postgres(url, str(spool), "pitr_test")
+    try:
+        wait_for(lambda: spool_files(str(spool), "postgres")[1] is not None)
+        query(url, "SELECT pg_switch_wal()")
+        wait_for(lambda: spool_files(str(spool), "postgres")[0])
+    finally:
+        receiver.terminate()
+        receiver.wait()
+        query(url, "SELECT pg_drop_replication_slot('pitr_test')")
+    complete, _ = spool_files(str(spool), "postgres")
+    assert all(
+        os.path.getsize(spool / name) == 16 * 1024 * 1024
+        for name in complete
+        if not name.endswith(".history")
+    )
@@ -0,0 +1,124 @@
+import os
+
+import pytest
+
+from app import dedup
+from app.destinations import ftp
+from app.dedup import (
+    CHUNK_PREFIX,
+    MANIFEST_SUFFIX,
+    collect_garbage,
+    iter_manifest_data,
+    store_stream,
+)
+
+
+def pieces(data, size=64 * 1024):
+    for offset in range(0, len(data), size):
+        yield data[offset : offset + size]
+
+
+def chunks_of(destination):
+    return set(destination.fetch_destination_filelist(prefix=CHUNK_PREFIX))
+
+
+def test_store_and_rebuild_a_dump(s3_bucket):
+    data = os.urandom(1024 * 1024)
+    manifest = store_stream(
+        s3_bucket, pieces(data), "db_1" + MANIFEST_SUFFIX, average_size=64 * 1024
+    )
+    assert manifest["size"] == len(data)
+    assert manifest["reused_chunks"] == 0
+    assert len(chunks_of(s3_bucket)) == manifest["new_chunks"] > 1
+    assert b"".join(iter_manifest_data(s3_bucket, manifest)) == data
+    assert not dedup._pending_chunks
+
+
+def test_a_second_dump_reuses_the_unchanged_chunks(s3_bucket):
+    data = os.urandom(1024 * 1024)
+    first = store_stream(
+        s3_bucket, pieces(data), "db_1" + MANIFEST_SUFFIX, average_size=64 * 1024
+    )
+    changed = data + os.urandom(1000)
+    second = store_stream(
+        s3_bucket, pieces(changed), "db_2" + MANIFEST_SUFFIX, average_size=64 * 1024
+    )
+    assert second["reused_chunks"] >= len(first["chunks"]) - 1
+    assert second["new_chunks"] <= 2
+    assert b"".join(iter_manifest_data(s3_bucket, second)) == changed
+
+
+def test_a_reused_chunk_deleted_during_the_backup_fails_it(s3_bucket):
+    data = os.urandom(256 * 1024)
+    store_stream(
+        s3_bucket, pieces(data), "db_1" + MANIFEST_SUFFIX, average_size=64 * 1024
+    )
+
+    def deleting_stream():
+        yield from pieces(data)
+        # A GC on another dyno
+        for name in chunks_of(s3_bucket):
+            s3_bucket.delete_file_from_destination(name)
+
+    with pytest.raises(RuntimeError, match="deleted during the backup"):
+        store_stream(
+            s3_bucket,
+            deleting_stream(),
+            "db_2" + MANIFEST_SUFFIX,
+            average_size=64 * 1024,
+        )
+    assert s3_bucket.read_from_destination("db_2" + MANIFEST_SUFFIX) is None
+    assert not dedup._pending_chunks
+
+
+def test_gc_keeps_referenced_and_recent_chunks(s3_bucket):
+    data = os.urandom(256 * 1024)
+    manifest = store_stream(
+        s3_bucket, pieces(data), "db_1" + MANIFEST_SUFFIX, average_size=64 * 1024
+    )
+    s3_bucket.upload_to_destination(CHUNK_PREFIX + "0" * 64 + ".gz", b"orphan")
+
+    assert collect_garbage(s3_bucket) == ([], {})
+
+    deleted, errors = collect_garbage(s3_bucket, grace_period=-1)
+    assert deleted == [CHUNK_PREFIX + "0" * 64 + ".gz"]
+    assert errors == {}
+    assert len(chunks_of(s3_bucket)) == len(manifest["chunks"])
+
+
+def test_gc_deletes_the_chunks_of_deleted_backups(s3_bucket):
+    data = os.urandom(256 * 1024)
+    store_stream(
+        s3_bucket, pieces(data), "db_1" + MANIFEST_SUFFIX, average_size=64 * 1024
+    )
+    s3_bucket.delete_file_from_destination("db_1" + MANIFEST_SUFFIX)
+    deleted, _ = collect_garbage(s3_bucket, grace_period=-1)
+    assert set(deleted) and not chunks_of(s3_bucket)
+
+
+def test_gc_keeps_the_chunks_of_a_running_backup(s3_bucket):
+    name = CHUNK_PREFIX + "1" * 64 + ".gz"
+    s3_bucket.upload_to_destination(name, b"pending")
+    with dedup._pending_lock:
+        dedup._pending_chunks[name] += 1
+    try:
+        assert collect_garbage(s3_bucket, grace_period=-1) == ([], {})
+    finally:
+        with dedup._pending_lock:
+            del dedup._pending_chunks[name]
+    assert collect_garbage(s3_bucket, grace_period=-1) == ([name], {})
+
+
+def test_gc_on_ftp(ftp_server):
+    data = os.urandom(256 * 1024)
+    manifest = store_stream(
+        ftp, pieces(data), "db_1" + MANIFEST_SUFFIX, average_size=64 * 1024
+    )
+    ftp.upload_to_destination(CHUNK_PREFIX + "0" * 64 + ".gz", b"orphan")
+
+    assert collect_garbage(ftp) == ([], {})
+    assert collect_garbage(ftp, grace_period=-1) == (
+        [CHUNK_PREFIX + "0" * 64 + ".gz"],
+        {},
+    )
+    assert b"".join(iter_manifest_data(ftp, manifest)) == data
@@ -0,0 +1,106 @@
+import base64
+import os
+
+import pytest
+
+pytest.importorskip("cryptography")
+
+from app.encryption import (  # noqa: E402
+    HEADER_SIZE,
+    TAG_SIZE,
+    decrypt_stream,
+    encrypt_stream,
+    parse_master_keys,
+)
+
+
+def new_key():
+    return base64.b64encode(os.urandom(32)).decode()
+
+
+def make_config(key, previous=None, chunk_size=1024, threads=1):
+    return {
+        "ENCRYPTION_KEY": key,
+        "ENCRYPTION_PREVIOUS_KEYS": previous,
+        "ENCRYPTION_CHUNK_SIZE": chunk_size,
+        "ENCRYPTION_THREADS": threads,
+    }
+
+
+def encrypt(data, config, piece=700):
+    pieces = [data[offset : offset + piece] for offset in range(0, len(data), piece)]
+    return b"".join(encrypt_stream(pieces, config))
+
+
+def decrypt(data, config, piece=500):
+    pieces = [data[offset : offset + piece] for offset in range(0, len(data), piece)]
+    return b"".join(decrypt_stream(pieces, config))
+
+
+@pytest.mark.parametrize("size", [0, 1, 1023, 1024, 1025, 10 * 1024 + 7])
+@pytest.mark.parametrize("threads", [1, 4])
+def test_round_trip(size, threads):
+    config = make_config(new_key(), threads=threads)
+    data = os.urandom(size)
+    encrypted = encrypt(data, config)
+    # A header, then every chunk with its tag, an empty last chunk included
+    chunks = max(1, -(-size // 1024))
+    assert len(encrypted) == HEADER_SIZE + size + chunks * TAG_SIZE
+    assert decrypt(encrypted, config) == data
+
+
+def test_truncation_at_a_chunk_boundary_is_detected():
+    config = make_config(new_key())
+    encrypted = encrypt(os.urandom(4096), config)
+    record = 1024 + TAG_SIZE
+    with pytest.raises(ValueError, match="damaged or truncated"):
+        decrypt(encrypted[: HEADER_SIZE + 2 * record], config)
+
+
+def test_truncation_inside_a_chunk_is_detected():
+    config = make_config(new_key())
+    encrypted = encrypt(os.urandom(4096), config)
+    with pytest.raises(ValueError):
+        decrypt(encrypted[:-100], config)
+
+
+def test_a_file_cut_before_its_data_is_detected():
+    config = make_config(new_key())
+    encrypted = encrypt(b"data", config)
+    with pytest.raises(ValueError, match="truncated"):
+        decrypt(encrypted[: HEADER_SIZE - 1], config)
+
+
+def test_a_damaged_chunk_is_detected():
+    config = make_config(new_key())
+    encrypted = bytearray(encrypt(os.urandom(4096), config))
+    encrypted[HEADER_SIZE + 1500] ^= 1
+    with pytest.raises(ValueError, match="Chunk 1"):
+        decrypt(bytes(encrypted), config)
+
+
+def test_reordered_chunks_are_detected():
+    config = make_config(new_key())
+    encrypted = encrypt(os.urandom(4096), config)
+    record = 1024 + TAG_SIZE
+    header, body = encrypted[:HEADER_SIZE], encrypted[HEADER_SIZE:]
+    swapped = body[record : 2 * record] + body[:record] + body[2 * record :]
+    with pytest.raises(ValueError):
+        decrypt(header + swapped, config)
+
+
+def test_an_unknown_key_is_reported():
+    encrypted = encrypt(b"data", make_config(new_key()))
+    with pytest.raises(ValueError, match="unknown master key"):
+        decrypt(encrypted, make_config(new_key()))
+
+
+def test_a_previous_key_still_decrypts_after_a_rotation():
+    old = new_key()
+    encrypted = encrypt(b"old backup", make_config(old))
+    assert decrypt(encrypted, make_config(new_key(), previous=old)) == b"old backup"
+
+
+def test_keys_must_be_32_bytes():
+    with pytest.raises(ValueError):
+        parse_master_keys(make_config(base64.b64encode(b"short").decode()))
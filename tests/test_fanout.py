@@ -0,0 +1,103 @@
+import threading
+
+import pytest
+
+from app.destinations import DestinationTarget
+from app.fanout import StreamTee, fan_out_upload
+
+
+def counting(chunks, pulled):
+    for chunk in chunks:
+        pulled.append(chunk)
+        yield chunk
+
+
+def test_every_reader_gets_the_whole_stream():
+    chunks = [bytes([i]) * 10 for i in range(20)]
+    tee = StreamTee(chunks, ["a", "b", "c"], capacity=3)
+    results = {}
+
+    def read(name):
+        results[name] = list(tee.reader(name))
+
+    threads = [threading.Thread(target=read, args=(name,)) for name in "abc"]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert results == {"a": chunks, "b": chunks, "c": chunks}
+
+
+def test_source_waits_for_the_slowest_reader():
+    pulled = []
+    tee = StreamTee(counting(range(100), pulled), ["fast", "slow"], capacity=4)
+    fast = tee.reader("fast")
+    slow = tee.reader("slow")
+    assert next(slow) == 0
+    received = []
+
+    def read_fast():
+        for chunk in fast:
+            received.append(chunk)
+
+    thread = threading.Thread(target=read_fast, daemon=True)
+    thread.start()
+    thread.join(0.5)
+    # The fast reader is blocked once the buffer holds `capacity` chunks
+    assert thread.is_alive()
+    assert len(pulled) <= 5
+    assert received == list(range(len(received)))
+
+    assert list(slow) == list(range(1, 100))
+    thread.join(5)
+    assert received == list(range(100))
+
+
+def test_a_detached_reader_does_not_hold_the_others_back():
+    tee = StreamTee(range(50), ["gone", "reader"], capacity=2)
+    tee.detach("gone")
+    assert list(tee.reader("reader")) == list(range(50))
+
+
+def test_a_source_error_is_raised_in_every_reader():
+    def failing():
+        yield b"first"
+        raise OSError("dump died")
+
+    tee = StreamTee(failing(), ["a", "b"], capacity=4)
+    a, b = tee.reader("a"), tee.reader("b")
+    assert next(a) == b"first"
+    assert next(b) == b"first"
+    with pytest.raises(OSError):
+        next(a)
+    with pytest.raises(OSError):
+        next(b)
+
+
+def test_fan_out_upload_to_several_buckets(s3_bucket):
+    s3_bucket.get_client().create_bucket(Bucket="test-backups-eu")
+    targets = [
+        DestinationTarget("S3", "S3"),
+        DestinationTarget("S3_EU", "S3", {"AWS_S3_BUCKET": "test-backups-eu"}),
+    ]
+    chunks = [bytes([i]) * 1000 for i in range(50)]
+
+    results = fan_out_upload(targets, "db_20260101000000.gz", chunks, capacity=2)
+
+    assert results == {"S3": True, "S3_EU": True}
+    for target in targets:
+        assert target.read_from_destination("db_20260101000000.gz") == b"".join(chunks)
+
+
+def test_fan_out_upload_survives_a_failed_target(s3_bucket):
+    # The bucket of the second target does not exist
+    targets = [
+        DestinationTarget("S3", "S3"),
+        DestinationTarget("S3_EU", "S3", {"AWS_S3_BUCKET": "missing-bucket"}),
+    ]
+    chunks = [bytes([i]) * 1000 for i in range(50)]
+
+    results = fan_out_upload(targets, "db_20260101000000.gz", chunks, capacity=2)
+
+    assert results == {"S3": True, "S3_EU": False}
+    assert targets[0].read_from_destination("db_20260101000000.gz") == b"".join(chunks)
@@ -0,0 +1,46 @@
+import json
+
+from app.catalog import find_backups, new_entry, update_catalog
+from app.incremental import add_chain_entry, find_latest_chain, new_chain, plan_backup
+
+
+def chain_with(*files):
+    chain = new_chain("postgres", "db", "schema")
+    for index, file_name in enumerate(files):
+        add_chain_entry(
+            chain, "incremental" if index else "full", file_name, {"t": index}, ["t"]
+        )
+    return chain
+
+
+def test_runs_without_changes_do_not_count_toward_the_chain_length():
+    chain = chain_with("base", None, None, None, "inc1")
+    assert plan_backup(chain, {"t": 5}, "schema", max_chain=2) == ["t"]
+    chain = chain_with("base", "inc1", None, "inc2")
+    assert plan_backup(chain, {"t": 5}, "schema", max_chain=2) is None
+
+
+def test_an_unchanged_database_has_nothing_to_back_up():
+    chain = chain_with("base", None)
+    assert plan_backup(chain, {"t": 1}, "schema", max_chain=2) == []
+
+
+def test_find_latest_chain_reads_the_catalog(s3_bucket):
+    for name in ("db_20260101000000.chain.json", "db_20260102000000.chain.json"):
+        s3_bucket.upload_to_destination(name, json.dumps({"name": name}).encode())
+    update_catalog(
+        s3_bucket,
+        "db",
+        add=[
+            new_entry("db_20260101000000.chain.json", "db", "postgres", label=""),
+            new_entry("db_20260102000000.chain.json", "db", "postgres", label=""),
+            new_entry("db_20260103000000.sql.gz", "db", "postgres", label=""),
+            new_entry("daily_db_20260104000000.chain.json", "db", "postgres"),
+        ],
+    )
+
+    name, chain = find_latest_chain(find_backups(s3_bucket, "db"))
+
+    assert name == "db_20260102000000.chain.json"
+    assert chain == {"name": name}
+    assert find_latest_chain(find_backups(s3_bucket, "db"), "hourly") == (None, None)
@@ -0,0 +1,71 @@
+import gzip
+import hashlib
+import os
+
+import pytest
+
+from app.destinations.s3 import MIN_PART_SIZE
+from app.integrity import verify_file, write_sidecar
+
+
+def gzipped(size):
+    # Stored, not compressed, so the object has the size asked for
+    return gzip.compress(os.urandom(size), compresslevel=0)
+
+
+@pytest.fixture
+def multipart(app_context, monkeypatch):
+    monkeypatch.setitem(app_context.config, "S3_MULTIPART_PART_SIZE", MIN_PART_SIZE)
+
+
+def upload(destination, file_name, data, multipart):
+    if multipart:
+        chunks = (data[i : i + 1024 * 1024] for i in range(0, len(data), 1024 * 1024))
+        assert destination.upload_stream_to_destination(file_name, chunks)
+    else:
+        assert destination.upload_to_destination(file_name, data)
+    assert write_sidecar(destination, file_name, hashlib.sha256(data).hexdigest())
+
+
+@pytest.mark.parametrize("parts", [1, 3])
+def test_an_intact_file_passes(s3_bucket, multipart, parts):
+    data = gzipped((parts - 1) * MIN_PART_SIZE + 1000)
+    upload(s3_bucket, "db_20260101000000.sql.gz", data, parts > 1)
+
+    report = verify_file(s3_bucket, "db_20260101000000.sql.gz")
+
+    assert report["ok"], report["errors"]
+    assert report["checks"]["sha256"]
+    assert report["checks"]["etag"]
+    if parts > 1:
+        assert s3_bucket.stat_destination_file("db_20260101000000.sql.gz")["parts"] == 3
+        assert report["checks"]["s3_checksum"]
+
+
+@pytest.mark.parametrize("parts", [1, 3])
+def test_a_changed_sidecar_fails(s3_bucket, multipart, parts):
+    data = gzipped((parts - 1) * MIN_PART_SIZE + 1000)
+    upload(s3_bucket, "db_20260101000000.sql.gz", data, parts > 1)
+    write_sidecar(s3_bucket, "db_20260101000000.sql.gz", "0" * 64)
+
+    report = verify_file(s3_bucket, "db_20260101000000.sql.gz")
+
+    assert not report["ok"]
+    assert report["checks"]["sha256"] is False
+    # What S3 stored is still what was uploaded
+    assert report["checks"]["content"]
+    assert report["checks"]["etag"]
+
+
+def test_a_truncated_file_fails(s3_bucket, multipart):
+    data = gzipped(2 * MIN_PART_SIZE + 1000)
+    upload(s3_bucket, "db_20260101000000.sql.gz", data, True)
+    # Replaced by its first half, as a damaged copy would be
+    s3_bucket.upload_to_destination("db_20260101000000.sql.gz", data[: len(data) // 2])
+
+    report = verify_file(s3_bucket, "db_20260101000000.sql.gz", {"size": len(data)})
+
+    assert not report["ok"]
+    assert report["checks"]["content"] is False
+    assert report["checks"]["size"] is False
+    assert report["checks"]["sha256"] is False
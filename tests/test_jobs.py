@@ -0,0 +1,128 @@
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from app.jobs import JobQueue, JobStore, report_progress
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(str(tmp_path / "jobs.sqlite3"))
+
+
+def run_all(queue):
+    """
+    Waits for every job submitted to a queue to finish.
+    """
+    queue._executor.shutdown(wait=True)
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, "-c", ""])
+    process.wait()
+    return process.pid
+
+
+def test_a_duplicate_submit_returns_the_running_job(store):
+    started, release = threading.Event(), threading.Event()
+
+    def backup(db_var):
+        started.set()
+        release.wait(5)
+        return f"{db_var}.gz"
+
+    queue = JobQueue(store, {"backup": backup})
+    job_id, created = queue.submit("backup", "backup:DATABASE_URL", db_var="db")
+    assert created
+    assert started.wait(5)
+
+    assert queue.submit("backup", "backup:DATABASE_URL", db_var="db") == (
+        job_id,
+        False,
+    )
+    # Another database gets its own job
+    other_id, created = queue.submit("backup", "backup:OTHER_URL", db_var="other")
+    assert created and other_id != job_id
+
+    release.set()
+    run_all(queue)
+    assert store.get(job_id)["status"] == "succeeded"
+    assert store.get(job_id)["result"] == "db.gz"
+    # Once finished, the same key queues a new job
+    assert store.create("backup", "backup:DATABASE_URL", {})[1]
+
+
+def test_a_job_that_exits_is_failed(store):
+    def backup():
+        sys.exit(1)
+
+    def restore():
+        raise RuntimeError("psql died")
+
+    queue = JobQueue(store, {"backup": backup, "restore": restore})
+    backup_id, _ = queue.submit("backup", "backup")
+    restore_id, _ = queue.submit("restore", "restore")
+    run_all(queue)
+
+    job = store.get(backup_id)
+    assert job["status"] == "failed"
+    assert job["error"] == "Job failed, see the logs for details"
+    assert job["finished"]
+    assert store.get(restore_id)["error"] == "psql died"
+
+
+def test_progress_writes_are_throttled(store):
+    def backup():
+        report_progress("dump")
+        report_progress("dump", bytes=1)
+        report_progress("upload", bytes=2)
+        report_progress("upload", bytes=3)
+
+    queue = JobQueue(store, {"backup": backup})
+    job_id, _ = queue.submit("backup", "backup")
+    run_all(queue)
+
+    # The second write of each stage came too soon after the first
+    assert store.get(job_id)["progress"] == {"stage": "upload", "bytes": 2}
+    # Outside of a job, progress is not recorded anywhere
+    report_progress("dump")
+
+
+def test_the_jobs_of_a_dead_process_are_recovered(store):
+    runs = []
+
+    def backup(db_var):
+        runs.append(db_var)
+
+    queued_id, _ = store.create("backup", "backup:a", {"db_var": "a"})
+    running_id, _ = store.create("backup", "backup:b", {"db_var": "b"})
+    resumable_id, _ = store.create("resumable", "resumable:c", {"db_var": "c"})
+    live_id, _ = store.create("backup", "backup:d", {"db_var": "d"})
+    pid = dead_pid()
+    for job_id, status in (
+        (queued_id, "queued"),
+        (running_id, "running"),
+        (resumable_id, "running"),
+    ):
+        store.update(job_id, status=status, pid=pid)
+
+    queue = JobQueue(
+        store,
+        {"backup": backup, "resumable": backup},
+        resumable=("resumable",),
+    )
+    run_all(queue)
+
+    assert sorted(runs) == ["a", "c"]
+    assert store.get(queued_id)["status"] == "succeeded"
+    assert store.get(resumable_id)["status"] == "succeeded"
+    job = store.get(running_id)
+    assert job["status"] == "failed"
+    assert job["error"] == "Interrupted by a restart"
+    # The job of this process, which is alive, is left alone
+    assert store.get(live_id)["status"] == "queued"
+    # A recovered job is owned by this process, and not recovered twice
+    assert not store.orphaned()
+    assert not store.claim(queued_id, pid)
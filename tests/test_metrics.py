@@ -0,0 +1,39 @@
+import tracemalloc
+
+from app import metrics
+
+
+def test_cprofile_saves_the_stats_of_the_run(tmp_path):
+    with metrics.profile_run("cprofile", str(tmp_path / "db_20260101000000")):
+        sum(range(1000))
+    assert (tmp_path / "db_20260101000000.prof").stat().st_size > 0
+
+
+def test_only_one_run_is_profiled_at_a_time():
+    with metrics.profile_run("tracemalloc", "first"):
+        assert tracemalloc.is_tracing()
+        with metrics.profile_run("tracemalloc", "second"):
+            pass
+        # The second run did not stop the tracing of the first
+        assert tracemalloc.is_tracing()
+    assert not tracemalloc.is_tracing()
+    # The lock was released
+    with metrics.profile_run("tracemalloc", "third"):
+        assert tracemalloc.is_tracing()
+
+
+def test_runs_are_not_profiled_unless_asked(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with metrics.profile_run(None, "db"):
+        assert not tracemalloc.is_tracing()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_mark_end_notes_when_the_stream_ended():
+    ends = []
+    chunks = metrics.mark_end(iter([b"a", b"b"]), ends)
+    assert next(chunks) == b"a"
+    assert next(chunks) == b"b"
+    assert ends == []
+    assert list(chunks) == []
+    assert len(ends) == 1
@@ -0,0 +1,80 @@
+import os
+import threading
+
+import pytest
+
+from app.destinations import s3
+from app.destinations.s3 import MIN_PART_SIZE, multipart_upload
+
+
+class FlakyClient:
+    """
+    Wraps an S3 client whose `upload_part` of a given part number fails
+    `failures` times before going through.
+    """
+
+    def __init__(self, client, part_number, failures):
+        self._client = client
+        self.part_number = part_number
+        self.failures = failures
+        self.attempts = 0
+        self._lock = threading.Lock()
+
+    def upload_part(self, **params):
+        if params["PartNumber"] == self.part_number:
+            with self._lock:
+                self.attempts += 1
+                if self.attempts <= self.failures:
+                    raise ConnectionError("Connection reset by peer")
+        return self._client.upload_part(**params)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(s3.time, "sleep", lambda seconds: None)
+
+
+def pieces(data, size=1024 * 1024):
+    return (data[offset : offset + size] for offset in range(0, len(data), size))
+
+
+def test_a_failed_part_is_retried(s3_bucket):
+    client = FlakyClient(s3_bucket.get_client(), part_number=2, failures=1)
+    data = os.urandom(2 * MIN_PART_SIZE + 1000)
+
+    multipart_upload(
+        client,
+        "test-backups",
+        "db_20260101000000.gz",
+        pieces(data),
+        part_size=MIN_PART_SIZE,
+        max_attempts=3,
+    )
+
+    assert client.attempts == 2
+    assert s3_bucket.read_from_destination("db_20260101000000.gz") == data
+    assert s3_bucket.stat_destination_file("db_20260101000000.gz")["parts"] == 3
+
+
+def test_a_part_that_keeps_failing_aborts_the_upload(s3_bucket):
+    client = FlakyClient(s3_bucket.get_client(), part_number=2, failures=3)
+    data = os.urandom(3 * MIN_PART_SIZE)
+
+    with pytest.raises(ConnectionError):
+        multipart_upload(
+            client,
+            "test-backups",
+            "db_20260101000000.gz",
+            pieces(data),
+            part_size=MIN_PART_SIZE,
+            max_attempts=3,
+        )
+
+    assert client.attempts == 3
+    assert s3_bucket.read_from_destination("db_20260101000000.gz") is None
+    # Without a journal, nothing is kept to be resumed
+    uploads = client.list_multipart_uploads(Bucket="test-backups")
+    assert uploads.get("Uploads", []) == []
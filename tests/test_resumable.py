@@ -0,0 +1,159 @@
+import os
+
+import pytest
+
+from app import metrics
+from app.destinations import ftp
+from app.destinations.s3 import MIN_PART_SIZE, multipart_upload
+from app.resumable import UploadJournal, journal_name, resume_or_start
+
+
+class Interrupted(Exception):
+    pass
+
+
+def pieces(data, size, fail_after=None):
+    """
+    Yields `data` in pieces of `size` bytes, and raises once `fail_after` bytes
+    were yielded, like a dyno restarted in the middle of an upload.
+    """
+    for offset in range(0, len(data), size):
+        if fail_after is not None and offset >= fail_after:
+            raise Interrupted()
+        yield data[offset : offset + size]
+
+
+def test_resume_or_start_resumes_an_upload_of_the_same_format(s3_bucket):
+    journal, name = resume_or_start(s3_bucket, "db", "db_20260101000000.dump.gz")
+    assert name == "db_20260101000000.dump.gz"
+    assert journal.state == {"file": name, "parts": {}}
+    journal.add_part(1, {"sha256": "00"})
+
+    journal, name = resume_or_start(s3_bucket, "db", "db_20260102000000.dump.gz")
+    assert name == "db_20260101000000.dump.gz"
+    assert journal.parts() == {"1": {"sha256": "00"}}
+
+    # Another format starts over under the new name
+    journal, name = resume_or_start(s3_bucket, "db", "db_20260102000000.sql.gz")
+    assert name == "db_20260102000000.sql.gz"
+    assert journal.parts() == {}
+
+    journal.clear()
+    assert s3_bucket.read_from_destination(journal_name("db")) is None
+
+
+def test_an_interrupted_multipart_upload_reuses_its_stored_parts(s3_bucket):
+    client = s3_bucket.get_client()
+    bucket = "test-backups"
+    key = "db_20260101000000.dump.gz"
+    data = os.urandom(3 * MIN_PART_SIZE + 1000)
+    journal = UploadJournal(s3_bucket, "db")
+    journal.start(key)
+
+    with pytest.raises(Interrupted):
+        multipart_upload(
+            client,
+            bucket,
+            key,
+            pieces(data, 1024 * 1024, fail_after=2 * MIN_PART_SIZE + 1024 * 1024),
+            part_size=MIN_PART_SIZE,
+            concurrency=1,
+            journal=journal,
+        )
+    assert sorted(journal.parts()) == ["1", "2"]
+
+    journal = UploadJournal(s3_bucket, "db")
+    with metrics.track_run("backup", "DATABASE_URL") as run:
+        multipart_upload(
+            client,
+            bucket,
+            key,
+            pieces(data, 1024 * 1024),
+            part_size=MIN_PART_SIZE,
+            concurrency=2,
+            journal=journal,
+        )
+    assert run.counters["parts_reused"] == 2
+    assert client.get_object(Bucket=bucket, Key=key)["Body"].read() == data
+
+
+def test_a_changed_stream_only_reuses_the_matching_parts(s3_bucket):
+    client = s3_bucket.get_client()
+    bucket = "test-backups"
+    key = "db_20260101000000.dump.gz"
+    data = os.urandom(3 * MIN_PART_SIZE)
+    journal = UploadJournal(s3_bucket, "db")
+    journal.start(key)
+    with pytest.raises(Interrupted):
+        multipart_upload(
+            client,
+            bucket,
+            key,
+            pieces(data, 1024 * 1024, fail_after=2 * MIN_PART_SIZE + 1024 * 1024),
+            part_size=MIN_PART_SIZE,
+            concurrency=1,
+            journal=journal,
+        )
+
+    changed = data[:MIN_PART_SIZE] + os.urandom(2 * MIN_PART_SIZE)
+    with metrics.track_run("backup", "DATABASE_URL") as run:
+        multipart_upload(
+            client,
+            bucket,
+            key,
+            pieces(changed, 1024 * 1024),
+            part_size=MIN_PART_SIZE,
+            journal=UploadJournal(s3_bucket, "db"),
+        )
+    assert run.counters["parts_reused"] == 1
+    assert client.get_object(Bucket=bucket, Key=key)["Body"].read() == changed
+
+
+def test_an_interrupted_ftp_upload_reuses_its_stored_segments(
+    ftp_server, app_context, monkeypatch
+):
+    monkeypatch.setitem(app_context.config, "FTP_SEGMENT_SIZE", 1000)
+    file_name = "db_20260101000000.dump.gz"
+    data = os.urandom(5500)
+    journal = UploadJournal(ftp, "db")
+    journal.start(file_name)
+
+    with pytest.raises(Interrupted):
+        ftp.resumable_upload(file_name, pieces(data, 250, fail_after=3000), journal)
+    assert sorted(journal.parts()) == ["0", "1", "2"]
+    assert (ftp_server / (file_name + ftp.PARTIAL_SUFFIX)).exists()
+
+    journal = UploadJournal(ftp, "db")
+    with metrics.track_run("backup", "DATABASE_URL") as run:
+        ftp.resumable_upload(file_name, pieces(data, 250), journal)
+    assert run.counters["parts_reused"] == 3
+    assert (ftp_server / file_name).read_bytes() == data
+    assert not (ftp_server / (file_name + ftp.PARTIAL_SUFFIX)).exists()
+    assert ftp.read_from_destination(journal_name("db")) is None
+
+
+def test_a_changed_ftp_stream_is_overwritten_from_the_first_difference(
+    ftp_server, app_context, monkeypatch
+):
+    monkeypatch.setitem(app_context.config, "FTP_SEGMENT_SIZE", 1000)
+    file_name = "db_20260101000000.dump.gz"
+    data = os.urandom(5500)
+    journal = UploadJournal(ftp, "db")
+    journal.start(file_name)
+    with pytest.raises(Interrupted):
+        ftp.resumable_upload(file_name, pieces(data, 250, fail_after=4000), journal)
+
+    # Shorter than what was stored
+    changed = data[:1000] + os.urandom(1500)
+    with metrics.track_run("backup", "DATABASE_URL") as run:
+        # The server keeps the old tail past the new end, so this run gives up
+        with pytest.raises(RuntimeError):
+            ftp.resumable_upload(
+                file_name, pieces(changed, 250), UploadJournal(ftp, "db")
+            )
+    assert run.counters["parts_reused"] == 1
+    assert not (ftp_server / (file_name + ftp.PARTIAL_SUFFIX)).exists()
+
+    # And the next one starts over
+    ftp.resumable_upload(file_name, pieces(changed, 250), UploadJournal(ftp, "db"))
+    assert (ftp_server / file_name).read_bytes() == changed
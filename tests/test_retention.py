@@ -0,0 +1,119 @@
+import pytest
+
+from app.retention import (
+    covered_periods,
+    parse_policy,
+    plan_retention,
+    resolve_policy,
+    validate_policies,
+)
+
+
+def entry(timestamp, unchanged_until=None, label=None):
+    entry = {
+        "file": f"db_{timestamp}.gz",
+        "label": label,
+        "timestamp": timestamp,
+        "format": "dump",
+    }
+    if unchanged_until:
+        entry["unchanged_until"] = unchanged_until
+    return entry
+
+
+def test_parse_policy():
+    assert parse_policy("hourly=24, daily=7,monthly=12") == {
+        "hourly": 24,
+        "daily": 7,
+        "monthly": 12,
+    }
+
+
+@pytest.mark.parametrize(
+    "text", ["", "daily=0", "yearly=1", "daily=seven", "daily=-1,weekly=2", "daily"]
+)
+def test_parse_policy_rejects_malformed_policies(text):
+    with pytest.raises(ValueError):
+        parse_policy(text)
+
+
+def test_a_backup_covers_the_period_it_was_taken_in():
+    assert list(covered_periods(entry("20260105103000"), "daily")) == ["20260105"]
+
+
+def test_a_backup_covers_the_periods_of_the_runs_skipped_after_it():
+    backup = entry("20260105103000", unchanged_until="20260105133000")
+    assert list(covered_periods(backup, "hourly")) == [
+        "2026010513",
+        "2026010512",
+        "2026010511",
+        "2026010510",
+    ]
+    assert list(covered_periods(backup, "daily")) == ["20260105"]
+
+
+def test_covered_weeks_are_iso_weeks():
+    # 2026-01-01 is a Thursday in ISO week 1 of 2026
+    backup = entry("20251229000000", unchanged_until="20260105000000")
+    assert list(covered_periods(backup, "weekly")) == ["202602", "202601"]
+
+
+def test_plan_retention_keeps_the_newest_backup_of_each_period():
+    entries = [
+        entry(f"202601{day:02d}{hour:02d}0000")
+        for day in range(1, 11)
+        for hour in (0, 12)
+    ]
+    decisions = plan_retention(entries, {"hourly": 3, "daily": 4})
+
+    kept = {decision["timestamp"]: decision["tiers"] for decision in decisions}
+    assert [decision["timestamp"] for decision in decisions] == sorted(
+        kept, reverse=True
+    )
+    assert {timestamp for timestamp, tiers in kept.items() if tiers} == {
+        "20260110120000",
+        "20260110000000",
+        "20260109120000",
+        "20260108120000",
+        "20260107120000",
+    }
+    assert kept["20260110120000"] == ["hourly", "daily"]
+    assert kept["20260108120000"] == ["daily"]
+
+
+def test_plan_retention_moves_coarse_backups_to_cheaper_storage():
+    entries = [entry(f"202601{day:02d}000000") for day in range(1, 32)]
+    decisions = plan_retention(
+        entries, {"daily": 2, "monthly": 2}, {"monthly": "GLACIER_IR"}
+    )
+    by_timestamp = {decision["timestamp"]: decision for decision in decisions}
+    assert by_timestamp["20260131000000"]["tiers"] == ["daily", "monthly"]
+    assert by_timestamp["20260131000000"]["storage_class"] is None
+    assert [decision["keep"] for decision in decisions].count(True) == 2
+
+
+def test_a_skipped_hour_takes_an_hourly_slot():
+    entries = [
+        entry("20260105100000", unchanged_until="20260105120000"),
+        entry("20260105090000"),
+    ]
+    decisions = plan_retention(entries, {"hourly": 3})
+    assert [decision["keep"] for decision in decisions] == [True, False]
+
+
+def test_labelled_series_only_use_their_own_policy(monkeypatch):
+    config = {"RETENTION_POLICY": "daily=7"}
+    monkeypatch.setenv("RETENTION_POLICY_DATABASE_URL", "daily=3")
+    assert resolve_policy(config, "DATABASE_URL") == {"daily": 3}
+    assert resolve_policy(config, "OTHER_URL") == {"daily": 7}
+    assert resolve_policy(config, "DATABASE_URL", "pre-deploy") is None
+
+    monkeypatch.setenv("RETENTION_POLICY_PRE_DEPLOY", "monthly=6")
+    assert resolve_policy(config, "DATABASE_URL", "pre-deploy") == {"monthly": 6}
+
+
+def test_validate_policies_reports_a_malformed_policy(monkeypatch):
+    validate_policies({"RETENTION_POLICY": "daily=7"})
+    monkeypatch.setenv("RETENTION_POLICY_NIGHTLY", "daily=many")
+    with pytest.raises(ValueError):
+        validate_policies({"RETENTION_POLICY": "daily=7"})
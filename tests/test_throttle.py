@@ -0,0 +1,72 @@
+import pytest
+
+from app import throttle
+from app.throttle import TokenBucket
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    A fake monotonic clock that sleeping moves forward.
+    """
+    now = [1000.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    monkeypatch.setattr(throttle.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(throttle.time, "sleep", sleep)
+    return now, sleeps
+
+
+def test_a_bucket_without_rate_never_waits(clock):
+    _, sleeps = clock
+    bucket = TokenBucket()
+    assert bucket.consume(10**9) == 0.0
+    assert sleeps == []
+
+
+def test_a_bucket_starts_empty_and_waits_for_its_rate(clock):
+    _, sleeps = clock
+    bucket = TokenBucket(rate=1000)
+    assert bucket.consume(500) == pytest.approx(0.5)
+    assert sleeps == [pytest.approx(0.5)]
+
+
+def test_an_idle_bucket_lets_a_burst_through(clock):
+    now, sleeps = clock
+    bucket = TokenBucket(rate=1000, burst=2000)
+    now[0] += 10
+    assert bucket.consume(2000) == 0.0
+    # The burst is spent, the next bytes wait for the rate
+    assert bucket.consume(1000) == pytest.approx(1.0)
+    assert sleeps == [pytest.approx(1.0)]
+
+
+def test_a_chunk_larger_than_the_burst_goes_into_debt(clock):
+    now, _ = clock
+    bucket = TokenBucket(rate=1000, burst=1000)
+    now[0] += 10
+    assert bucket.consume(3000) == pytest.approx(2.0)
+    # The debt was slept off, nothing is left
+    assert bucket.consume(1000) == pytest.approx(1.0)
+
+
+def test_limit_holds_a_stream_to_the_rate(clock):
+    now, sleeps = clock
+    bucket = TokenBucket(rate=1000)
+    start = now[0]
+    chunks = [b"x" * 250] * 8
+    assert list(throttle.limit(chunks, bucket)) == chunks
+    assert now[0] - start == pytest.approx(2.0)
+
+
+def test_lowering_the_rate_caps_the_stored_tokens(clock):
+    now, _ = clock
+    bucket = TokenBucket(rate=1000)
+    now[0] += 10
+    bucket.set_rate(100)
+    assert bucket.consume(100) == 0.0
+    assert bucket.consume(100) == pytest.approx(1.0)